@@ -0,0 +1,182 @@
+"""
+End to end benchmark suite of the IMAP and Graph API extraction against local stand-in servers.
+
+A synthetic mailbox (message count, body size, attachment mix) is served by a local IMAP server (imap_server.py)
+and a local Graph API server (graph_server.py) with an injected latency per request and, for the Graph API,
+a fraction of throttled (HTTP 429) requests. `ImapEmailFetcher.fetch` and `GraphEmailFetcher.fetch` then run
+end to end in several configurations, each in a fresh process, and the suite reports messages per second,
+server requests per message and the peak RSS of the process.
+
+With --save the results are stored as JSON, with --baseline they are compared to stored results and the exit
+code is 1 if a scenario is slower, sends more requests or uses more memory than the baseline by more than
+the tolerance, so regressions are caught before a release.
+
+Usage:
+    python benchmarks/end_to_end.py [--messages 500] [--body-kb 20] [--attachment-mix none=70,50=25,2000=5]
+        [--latency-ms 10] [--throttle-rate 0.02] [--scenarios imap-default,graph-batched]
+        [--save results.json] [--baseline results.json] [--tolerance 0.2]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), "src"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from graph_server import GraphBenchmarkServer  # noqa: E402
+from imap_server import ImapBenchmarkServer  # noqa: E402
+from synthetic_mailbox import generate_mailbox  # noqa: E402
+
+# Scenario name -> (protocol, configuration overrides)
+SCENARIOS = {
+    "imap-default": ("imap", {}),
+    "imap-chunked": ("imap", {"imap_fetch_chunk_size": 50}),
+    "imap-parallel": ("imap", {"imap_fetch_chunk_size": 50, "imap_connections": 4}),
+    "graph-default": ("graph", {}),
+    "graph-local-text": ("graph", {"graph_local_text_body": True}),
+    "graph-metadata": ("graph", {"columns": ["date", "from", "to", "subject", "attachment_names"]}),
+    "graph-batched": ("graph", {"graph_batch_requests": True, "graph_local_text_body": True}),
+    "graph-concurrent": ("graph", {"graph_concurrency": 8, "graph_local_text_body": True}),
+}
+
+# Result metrics compared with the baseline, True if higher values are better
+COMPARED_METRICS = {"messages_per_second": True, "requests_per_message": False, "peak_rss_mb": False}
+
+
+def run_scenario(protocol, server_address, overrides, output_dir):
+    """Run a single extraction in the current (fresh) process and return its results."""
+    from imap_tools import MailBoxUnencrypted
+    from keboola.component.dao import FileDefinition
+    from keboola.component.interface import register_csv_dialect
+
+    import graph_client
+    from configuration import CONNECTION_METHOD_GRAPH, Configuration
+    from graph_client import GraphEmailFetcher
+    from imap_client import ImapEmailFetcher
+    from metrics import RunMetrics
+
+    register_csv_dialect()
+    component = MagicMock()
+    component.state = {}
+    component.metrics = RunMetrics()
+    component.use_oauth_login = protocol == "graph"
+    component.get_access_token.return_value = "token"
+    component.create_out_file_definition.side_effect = lambda name, tags=None: FileDefinition(
+        os.path.join(output_dir, name), tags=tags
+    )
+    output_table = MagicMock()
+    output_table.full_path = os.path.join(output_dir, "emails.csv")
+
+    params = {"user_name": "user@example.com", "mark_seen": True, "download_attachments": True, **overrides}
+    start = time.perf_counter()
+    if protocol == "imap":
+        config = Configuration(**{"#password": "secret"}, host=server_address[0], port=server_address[1], **params)
+        fetcher = ImapEmailFetcher(component, config)
+        with patch("imap_client.MailBox", MailBoxUnencrypted):
+            results = fetcher.fetch(output_table, True, True, True)
+            fetcher.close()
+    else:
+        config = Configuration(connection_method=CONNECTION_METHOD_GRAPH, **params)
+        with patch.object(graph_client, "GRAPH_API_BASE", server_address):
+            fetcher = GraphEmailFetcher(component, config)
+            results = fetcher.fetch(output_table, True, True, True)
+            fetcher.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "wall_seconds": elapsed,
+        "messages": component.metrics.to_dict()["counters"].get("messages", 0),
+        "attachments": len(results) - 1,
+        # ru_maxrss is in kB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_isolated(protocol, server, overrides):
+    """Run a scenario in a spawned process, so that the peak RSS is measured for the scenario alone."""
+    server_address = server.server_address if protocol == "imap" else server.base_url
+    requests_before = server.commands if protocol == "imap" else server.requests
+    with tempfile.TemporaryDirectory() as output_dir:
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            result = pool.apply(run_scenario, (protocol, server_address, overrides, output_dir))
+    requests = (server.commands if protocol == "imap" else server.requests) - requests_before
+    result["messages_per_second"] = result["messages"] / result["wall_seconds"]
+    result["requests_per_message"] = requests / max(1, result["messages"])
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions of the results against the baseline results."""
+    regressions = []
+    for name, result in results.items():
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            expected = baseline.get(name, {}).get(metric)
+            if expected is None:
+                continue
+            limit = expected * (1 - tolerance) if higher_is_better else expected * (1 + tolerance)
+            if (result[metric] < limit) if higher_is_better else (result[metric] > limit):
+                regressions.append(f"{name}: {metric} {result[metric]:.2f} vs. baseline {expected:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--body-kb", type=int, default=20)
+    parser.add_argument("--attachment-mix", default="none=70,50=25,2000=5")
+    parser.add_argument("--latency-ms", type=float, default=10.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.02, help="Fraction of throttled Graph requests")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--save", help="Store the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare the results with the JSON results stored in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    mailbox = generate_mailbox(args.messages, args.body_kb, args.attachment_mix)
+    latency = args.latency_ms / 1000
+    print(
+        f"{args.messages} messages, {args.body_kb} kB bodies, attachments {args.attachment_mix}, "
+        f"{args.latency_ms:.0f} ms latency, {args.throttle_rate:.0%} throttled Graph requests"
+    )
+    print(
+        f"{'scenario':<20}{'wall time s':>12}{'msgs/s':>10}{'requests/msg':>14}{'attachments':>13}{'peak RSS MB':>13}"
+    )
+
+    results = {}
+    with (
+        ImapBenchmarkServer([message.to_mime() for message in mailbox], latency=latency) as imap_server,
+        GraphBenchmarkServer(mailbox, latency=latency, throttle_rate=args.throttle_rate) as graph_server,
+    ):
+        for name in args.scenarios.split(","):
+            protocol, overrides = SCENARIOS[name]
+            result = run_isolated(protocol, imap_server if protocol == "imap" else graph_server, overrides)
+            results[name] = result
+            print(
+                f"{name:<20}{result['wall_seconds']:>12.2f}{result['messages_per_second']:>10.1f}"
+                f"{result['requests_per_message']:>14.2f}{result['attachments']:>13}{result['peak_rss_mb']:>13.1f}"
+            )
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Minimal in-process Microsoft Graph API stand-in used by the benchmarks.
+
+Serves a single inbox of synthetic messages (see synthetic_mailbox.py) over plain HTTP on localhost and implements
+only the endpoints used by the extractor: message listing and delta pages, message details with expanded
+attachment metadata, raw attachment content ($value), mark as read (PATCH) and JSON batches ($batch).
+Every request is delayed by a fixed latency and a given fraction of the requests is throttled with HTTP 429.
+"""
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+API_PREFIX = "/v1.0"
+PAGE_SIZE = 100
+
+_LIST_RE = re.compile(r"^/me/mailFolders/(?P<folder>[^/]+)/messages(?P<delta>/delta)?$")
+_MESSAGE_RE = re.compile(r"^/me/messages/(?P<id>[^/]+)$")
+_ATTACHMENT_RE = re.compile(r"^/me/messages/(?P<id>[^/]+)/attachments/(?P<attachment_id>[^/]+)(?P<value>/\$value)?$")
+
+
+class GraphBenchmarkServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server holding the messages in memory.
+
+    Use as a context manager, the API root is `base_url` while the context is active.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, messages, latency=0.0, throttle_rate=0.0, seed=42):
+        """
+        Args:
+            messages: SyntheticMessage objects of the inbox
+            latency: Delay in seconds before each response (a $batch counts as a single request)
+            throttle_rate: Fraction of requests and batch sub-requests answered with HTTP 429
+            seed: Seed of the throttled request selection
+        """
+        super().__init__(("127.0.0.1", 0), _GraphHandler)
+        self.messages = {message.id: message for message in messages}
+        self.message_ids = [message.id for message in messages]
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}{API_PREFIX}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients closing their pooled connections at exit are not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def should_throttle(self):
+        with self._lock:
+            throttle = self._random.random() < self.throttle_rate
+            self.throttled += throttle
+            return throttle
+
+    def handle_api_request(self, method, path, query, headers, body):
+        """
+        Answer a single API request (also used for batch sub-requests).
+
+        Returns:
+            Tuple of the status code, response headers and the JSON body (dict) or the raw content (bytes)
+        """
+        if self.should_throttle():
+            return 429, {"Retry-After": "0"}, {"error": {"code": "TooManyRequests", "message": "Throttled"}}
+
+        match = _LIST_RE.match(path)
+        if match and method == "GET":
+            return 200, {}, self._list_page(path, query, bool(match["delta"]))
+
+        match = _MESSAGE_RE.match(path)
+        if match and match["id"] in self.messages:
+            message = self.messages[match["id"]]
+            if method == "PATCH":
+                return 200, {}, {"id": message.id, "isRead": True}
+            text_body = 'outlook.body-content-type="text"' in headers.get("Prefer", "")
+            expand = "attachments" in query.get("$expand", [""])[0]
+            return 200, {}, message.graph_resource(text_body=text_body, expand_attachments=expand)
+
+        match = _ATTACHMENT_RE.match(path)
+        if match and match["id"] in self.messages and self.messages[match["id"]].attachment is not None:
+            message = self.messages[match["id"]]
+            if match["value"]:
+                return 200, {"Content-Type": "application/octet-stream"}, message.attachment[1]
+            return 200, {}, message.graph_attachment()
+
+        return 404, {}, {"error": {"code": "ErrorItemNotFound", "message": f"{method} {path} not found"}}
+
+    def _list_page(self, path, query, delta):
+        skip = int(query.get("$skip", ["0"])[0])
+        page = [{"id": message_id} for message_id in self.message_ids[skip : skip + PAGE_SIZE]]
+        result = {"value": page}
+        if skip + PAGE_SIZE < len(self.message_ids):
+            result["@odata.nextLink"] = f"{self.base_url}{path}?$skip={skip + PAGE_SIZE}"
+        elif delta:
+            result["@odata.deltaLink"] = f"{self.base_url}{path}?$deltatoken=latest&$skip={len(self.message_ids)}"
+        return result
+
+
+class _GraphHandler(BaseHTTPRequestHandler):
+    server: GraphBenchmarkServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urlsplit(self.path)
+        path = url.path.removeprefix(API_PREFIX)
+
+        self.server.count_request()
+        time.sleep(self.server.latency)
+        if method == "POST" and path == "/$batch":
+            self._send(200, {}, {"responses": [self._sub_response(request) for request in body["requests"]]})
+        else:
+            self._send(*self.server.handle_api_request(method, path, parse_qs(url.query), self.headers, body))
+
+    def _sub_response(self, request):
+        url = urlsplit(request["url"])
+        status, headers, body = self.server.handle_api_request(
+            request["method"], url.path, parse_qs(url.query), request.get("headers", {}), request.get("body")
+        )
+        return {"id": request["id"], "status": status, "headers": headers, "body": body}
+
+    def _send(self, status, headers, body):
+        content = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", headers.pop("Content-Type", "application/json"))
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
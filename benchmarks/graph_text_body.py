@@ -0,0 +1,119 @@
+"""
+Benchmark of the Graph API message detail fetch: two requests (HTML + text body) vs. a single HTML request
+with the text body converted locally.
+
+The Graph API is simulated by an in-process session with a fixed per-request latency, so the numbers
+show the request count, transferred bytes and wall time of the detail fetch, not of the real service.
+
+Usage:
+    python benchmarks/graph_text_body.py [--messages 200] [--latency-ms 40] [--body-kb 30]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from configuration import CONNECTION_METHOD_GRAPH, Configuration  # noqa: E402
+from graph_client import GraphEmailFetcher  # noqa: E402
+from html_text import html_to_text  # noqa: E402
+
+PARAGRAPH = (
+    '<tr><td style="padding:8px;font-family:Arial"><p>Dear customer,&nbsp;your <b>weekly report</b> for '
+    '<a href="https://example.com/report">account 42</a> is ready. Total &amp; net revenue grew by 5%.</p>'
+    "</td></tr>\n"
+)
+
+
+def build_html_body(size_kb):
+    rows = PARAGRAPH * max(1, size_kb * 1024 // len(PARAGRAPH))
+    return f"<html><head><style>td {{ color: #333; }}</style></head><body><table>{rows}</table></body></html>"
+
+
+class SimulatedGraphSession:
+    """Minimal requests.Session stand-in answering message detail requests after a fixed latency."""
+
+    def __init__(self, html_body, latency):
+        self.html_body = html_body
+        self.text_body = html_to_text(html_body)
+        self.latency = latency
+        self.requests = 0
+        self.bytes = 0
+
+    def request(self, method, url, params=None, json=None, headers=None, stream=False):
+        time.sleep(self.latency)
+        wants_text = 'outlook.body-content-type="text"' in (headers or {}).get("Prefer", "")
+        payload = {
+            "id": url.rsplit("/", 1)[-1],
+            "subject": "Weekly report",
+            "from": {"emailAddress": {"address": "reports@example.com"}},
+            "toRecipients": [{"emailAddress": {"address": "user@example.com"}}],
+            "receivedDateTime": "2024-01-15T10:30:00Z",
+            "hasAttachments": False,
+            "isRead": True,
+            "body": {
+                "contentType": "text" if wants_text else "html",
+                "content": self.text_body if wants_text else self.html_body,
+            },
+            "internetMessageHeaders": [{"name": "Subject", "value": "Weekly report"}],
+        }
+        self.requests += 1
+        self.bytes += len(_dumps(payload))
+        response = MagicMock()
+        response.json.return_value = payload
+        return response
+
+
+def _dumps(payload):
+    return json.dumps(payload).encode()
+
+
+def run(local_text_body, messages, html_body, latency):
+    config = Configuration(
+        user_name="user@example.com",
+        connection_method=CONNECTION_METHOD_GRAPH,
+        graph_local_text_body=local_text_body,
+    )
+    fetcher = GraphEmailFetcher(MagicMock(), config)
+    session = SimulatedGraphSession(html_body, latency)
+    fetcher._graph_session = session
+
+    start = time.perf_counter()
+    for i in range(messages):
+        fetcher._fetch_message_detail(f"message-{i}")
+    elapsed = time.perf_counter() - start
+    return session.requests / messages, session.bytes / messages, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--body-kb", type=int, default=30)
+    args = parser.parse_args()
+
+    html_body = build_html_body(args.body_kb)
+    latency = args.latency_ms / 1000
+
+    convert_start = time.perf_counter()
+    for _ in range(args.messages):
+        html_to_text(html_body)
+    convert_ms = (time.perf_counter() - convert_start) * 1000 / args.messages
+
+    print(f"{args.messages} messages, {len(html_body) // 1024} kB HTML body, {args.latency_ms:.0f} ms latency")
+    print(f"Local HTML to text conversion: {convert_ms:.2f} ms/message")
+    print(f"{'mode':<24}{'requests/msg':>14}{'kB/msg':>10}{'wall time s':>14}{'msgs/s':>10}")
+    for label, local_text_body in (("two requests (default)", False), ("local text body", True)):
+        requests_per_msg, bytes_per_msg, elapsed = run(local_text_body, args.messages, html_body, latency)
+        print(
+            f"{label:<24}{requests_per_msg:>14.1f}{bytes_per_msg / 1024:>10.1f}"
+            f"{elapsed:>14.2f}{args.messages / elapsed:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
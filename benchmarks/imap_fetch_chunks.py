@@ -0,0 +1,76 @@
+"""
+Benchmark of the IMAP message download with different numbers of messages per FETCH command
+(`imap_fetch_chunk_size`).
+
+The messages are served by a local IMAP server (see imap_server.py) that delays every response by a fixed
+latency, so the numbers show the effect of the saved round trips, not of a particular provider.
+
+Usage:
+    python benchmarks/imap_fetch_chunks.py [--messages 1000] [--message-kb 20] [--latency-ms 20]
+        [--chunk-sizes 1,10,50,200,500] [--chunk-max-mb 100]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+from imap_tools import MailBoxUnencrypted
+from keboola.component.interface import register_csv_dialect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from imap_server import ImapBenchmarkServer, build_message  # noqa: E402
+
+from configuration import Configuration  # noqa: E402
+from imap_client import ImapEmailFetcher  # noqa: E402
+
+
+def run(server, chunk_size, chunk_max_mb, output_dir):
+    config = Configuration(
+        user_name="user@example.com",
+        **{"#password": "secret"},
+        host=server.server_address[0],
+        port=server.server_address[1],
+        mark_seen=False,
+        imap_fetch_chunk_size=chunk_size,
+        imap_fetch_chunk_max_mb=chunk_max_mb,
+    )
+    component = MagicMock()
+    component.use_oauth_login = False
+    fetcher = ImapEmailFetcher(component, config)
+    output_table = MagicMock()
+    output_table.full_path = os.path.join(output_dir, f"emails_{chunk_size}.csv")
+
+    commands_before = server.commands
+    start = time.perf_counter()
+    with patch("imap_client.MailBox", MailBoxUnencrypted):
+        fetcher.fetch(output_table, True, False, False)
+        fetcher.close()
+    return time.perf_counter() - start, server.commands - commands_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--message-kb", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--chunk-sizes", default="1,10,50,200,500")
+    parser.add_argument("--chunk-max-mb", type=int, default=100)
+    args = parser.parse_args()
+
+    register_csv_dialect()
+    messages = [build_message(uid, args.message_kb * 1024) for uid in range(1, args.messages + 1)]
+    print(f"{args.messages} messages of {args.message_kb} kB, {args.latency_ms:.0f} ms latency per command")
+    print(f"{'chunk size':>10}{'commands':>10}{'wall time s':>14}{'msgs/s':>10}")
+
+    with ImapBenchmarkServer(messages, latency=args.latency_ms / 1000) as server, tempfile.TemporaryDirectory() as tmp:
+        for chunk_size in (int(size) for size in args.chunk_sizes.split(",")):
+            elapsed, commands = run(server, chunk_size, args.chunk_max_mb, tmp)
+            print(f"{chunk_size:>10}{commands:>10}{elapsed:>14.2f}{args.messages / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Minimal in-process IMAP4rev1 server used by the benchmarks.
+
+Serves a single read-only folder of generated messages over plain TCP on localhost and implements only the
+commands issued by the extractor: CAPABILITY, LOGIN, SELECT, UID SEARCH, UID FETCH, UID STORE, NOOP and LOGOUT.
+Every response is delayed by a fixed latency to simulate the network round trip to a real server.
+"""
+
+import re
+import socketserver
+import threading
+import time
+
+_COMMAND_RE = re.compile(rb"^(?P<tag>\S+) (?:UID )?(?P<command>[A-Za-z]+) ?(?P<args>.*)$", re.IGNORECASE)
+_UID_SET_RE = re.compile(r"^(?P<uid_set>\S+) (?P<items>.*)$")
+
+
+def build_message(uid, size):
+    """Build a plain-text message of roughly the given size in bytes."""
+    header = (
+        f"From: sender{uid % 10}@example.com\r\n"
+        "To: recipient@example.com\r\n"
+        f"Subject: Benchmark message {uid}\r\n"
+        "Date: Mon, 15 Jan 2024 10:30:00 +0000\r\n"
+        f"Message-ID: <{uid}@example.com>\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "\r\n"
+    ).encode()
+    line = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n"
+    return header + line * max(1, (size - len(header)) // len(line))
+
+
+class ImapBenchmarkServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded IMAP server holding the messages in memory.
+
+    Use as a context manager, the server listens on `server_address` while the context is active.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, latency=0.0):
+        """
+        Args:
+            messages: Raw messages, the message at index i gets UID i + 1
+            latency: Delay in seconds before each tagged response
+        """
+        super().__init__(("127.0.0.1", 0), _ImapHandler)
+        self.messages = {str(uid): raw for uid, raw in enumerate(messages, start=1)}
+        self.latency = latency
+        self.commands = 0
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def uids(self, uid_set):
+        """Expand an IMAP UID set like "1,3:5,9:*" into the matching existing UIDs."""
+        last = max(map(int, self.messages), default=0)
+        uids = []
+        for item in uid_set.split(","):
+            start, _, end = item.partition(":")
+            start = last if start == "*" else int(start)
+            end = start if not end else last if end == "*" else int(end)
+            uids.extend(str(uid) for uid in range(min(start, end), max(start, end) + 1) if str(uid) in self.messages)
+        return uids
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    server: ImapBenchmarkServer
+
+    def handle(self):
+        self._send(b"* OK IMAP4rev1 benchmark server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            match = _COMMAND_RE.match(line.rstrip(b"\r\n"))
+            if not match:
+                self._send(b"* BAD Invalid command")
+                continue
+
+            tag, command, args = match["tag"], match["command"].upper(), match["args"].decode()
+            self.server.commands += 1
+            time.sleep(self.server.latency)
+            if command == b"LOGOUT":
+                self._send(b"* BYE Logging out", tag + b" OK LOGOUT completed")
+                return
+            handler = getattr(self, f"_handle_{command.decode().lower()}", None)
+            if handler is None:
+                self._send(tag + b" BAD Unsupported command")
+                continue
+            self._send(*handler(args), tag + b" OK " + command + b" completed")
+
+    def _send(self, *lines):
+        self.wfile.write(b"".join(line + b"\r\n" for line in lines))
+        self.wfile.flush()
+
+    def _handle_capability(self, args):
+        return [b"* CAPABILITY IMAP4rev1 AUTH=PLAIN"]
+
+    def _handle_login(self, args):
+        return []
+
+    def _handle_noop(self, args):
+        return []
+
+    def _handle_select(self, args):
+        return [f"* {len(self.server.messages)} EXISTS".encode(), b"* OK [UIDVALIDITY 1] UIDs valid"]
+
+    def _handle_search(self, args):
+        return [("* SEARCH " + " ".join(self.server.messages)).encode()]
+
+    def _handle_store(self, args):
+        return []
+
+    def _handle_fetch(self, args):
+        match = _UID_SET_RE.match(args)
+        items = match["items"].upper()
+        lines = []
+        for uid in self.server.uids(match["uid_set"]):
+            raw = self.server.messages[uid]
+            response = f"* {uid} FETCH (UID {uid} RFC822.SIZE {len(raw)}"
+            if "BODY[]" in items or "BODY.PEEK[]" in items:
+                lines.append(f"{response} FLAGS () BODY[] {{{len(raw)}}}".encode() + b"\r\n" + raw + b")")
+            else:
+                lines.append(f"{response})".encode())
+        return lines
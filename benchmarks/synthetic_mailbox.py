@@ -0,0 +1,99 @@
+"""
+Synthetic mailboxes for the benchmarks, served both as raw MIME messages (IMAP) and as Graph API resources.
+"""
+
+import random
+from email.message import EmailMessage
+
+_PARAGRAPH = (
+    '<p style="font-family:Arial">Dear customer,&nbsp;your <b>weekly report</b> for '
+    '<a href="https://example.com/report">account 42</a> is ready. Total &amp; net revenue grew by 5%.</p>\n'
+)
+_TEXT_LINE = "Dear customer, your weekly report for account 42 is ready. Total & net revenue grew by 5%.\n"
+
+
+def parse_attachment_mix(spec):
+    """
+    Parse an attachment mix like "none=60,20=30,500=10": weights of messages without an attachment
+    and with a single attachment of the given size in kB.
+
+    Returns:
+        List of (attachment size in kB or None, weight) tuples
+    """
+    mix = []
+    for item in spec.split(","):
+        size, _, weight = item.partition("=")
+        mix.append((None if size.strip() == "none" else int(size), float(weight or 1)))
+    return mix
+
+
+class SyntheticMessage:
+    """A generated message, the Graph API ID is `m{uid}` and the attachment ID `a{uid}`."""
+
+    def __init__(self, uid, body_kb, attachment_kb, rng):
+        self.uid = uid
+        self.id = f"m{uid}"
+        self.subject = f"Benchmark message {uid}"
+        self.sender = f"sender{uid % 10}@example.com"
+        self.date = "2024-01-15T10:30:00Z"
+        self.html = "<html><body>" + _PARAGRAPH * max(1, body_kb * 1024 // len(_PARAGRAPH)) + "</body></html>"
+        self.text = _TEXT_LINE * max(1, body_kb * 1024 // len(_TEXT_LINE))
+        self.attachment = None
+        if attachment_kb is not None:
+            self.attachment = (f"report_{uid}.pdf", rng.randbytes(attachment_kb * 1024))
+
+    def to_mime(self):
+        """Raw RFC 822 message with text and HTML alternatives and the attachment."""
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = "recipient@example.com"
+        message["Subject"] = self.subject
+        message["Date"] = "Mon, 15 Jan 2024 10:30:00 +0000"
+        message["Message-ID"] = f"<{self.uid}@example.com>"
+        message.set_content(self.text)
+        message.add_alternative(self.html, subtype="html")
+        if self.attachment is not None:
+            name, content = self.attachment
+            message.add_attachment(content, maintype="application", subtype="pdf", filename=name)
+        return message.as_bytes()
+
+    def graph_resource(self, text_body=False, expand_attachments=False):
+        """Graph API message resource, with the text or the HTML body."""
+        resource = {
+            "id": self.id,
+            "subject": self.subject,
+            "from": {"emailAddress": {"address": self.sender}},
+            "toRecipients": [{"emailAddress": {"address": "recipient@example.com"}}],
+            "receivedDateTime": self.date,
+            "hasAttachments": self.attachment is not None,
+            "isRead": False,
+            "body": {"contentType": "text", "content": self.text}
+            if text_body
+            else {"contentType": "html", "content": self.html},
+            "internetMessageHeaders": [
+                {"name": "Subject", "value": self.subject},
+                {"name": "Message-ID", "value": f"<{self.uid}@example.com>"},
+            ],
+        }
+        if expand_attachments:
+            resource["attachments"] = [self.graph_attachment()] if self.attachment is not None else []
+        return resource
+
+    def graph_attachment(self):
+        """Graph API attachment metadata, as expanded with the message."""
+        name, content = self.attachment
+        return {
+            "@odata.type": "#microsoft.graph.fileAttachment",
+            "id": f"a{self.uid}",
+            "name": name,
+            "contentType": "application/pdf",
+            "size": len(content),
+            "isInline": False,
+        }
+
+
+def generate_mailbox(messages, body_kb=20, attachment_mix="none=1", seed=42):
+    """Generate a reproducible list of synthetic messages with UIDs 1..messages."""
+    rng = random.Random(seed)
+    sizes, weights = zip(*parse_attachment_mix(attachment_mix), strict=True)
+    return [SyntheticMessage(uid, body_kb, rng.choices(sizes, weights)[0], rng) for uid in range(1, messages + 1)]
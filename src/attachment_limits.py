@@ -0,0 +1,60 @@
+"""
+Size and content type limits of the downloaded attachments, evaluated on the attachment metadata.
+"""
+
+import fnmatch
+import logging
+
+
+class AttachmentLimits:
+    """
+    Decides from the size and the content type of an attachment whether it is skipped.
+
+    Content types are matched case-insensitively as glob patterns (e.g. `application/pdf`, `image/*`),
+    the excluded types take precedence over the allowed ones. No limit is applied by default.
+    The names of the skipped attachments are collected for the summary of the run.
+    """
+
+    def __init__(self, max_size_mb=0, content_types=(), excluded_content_types=(), metrics=None):
+        self.max_size = max_size_mb * 1024 * 1024
+        self.content_types = [content_type.lower() for content_type in content_types]
+        self.excluded_content_types = [content_type.lower() for content_type in excluded_content_types]
+        self.metrics = metrics
+        # Names of the skipped attachments, appended by the workers
+        self.skipped: list[str] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_size or self.content_types or self.excluded_content_types)
+
+    def skip_reason(self, content_type: str, size: int) -> str | None:
+        """
+        Return why the attachment is skipped, None if it is downloaded.
+
+        Args:
+            content_type: MIME type of the attachment, parameters are ignored
+            size: Size of the attachment content in bytes
+        """
+        content_type = (content_type or "").split(";", 1)[0].strip().lower()
+        if self.max_size and size > self.max_size:
+            return f"{size / 1024 / 1024:.1f} MB over the size limit"
+        if any(fnmatch.fnmatchcase(content_type, pattern) for pattern in self.excluded_content_types):
+            return f"excluded content type {content_type}"
+        if self.content_types and not any(fnmatch.fnmatchcase(content_type, p) for p in self.content_types):
+            return f"content type {content_type} not allowed"
+        return None
+
+    def is_skipped(self, name: str, content_type: str, size: int) -> bool:
+        """Check the limits of an attachment, a skipped attachment is logged and counted in the run metrics."""
+        reason = self.skip_reason(content_type, size)
+        if reason is None:
+            return False
+        logging.debug(f"Skipping attachment '{name}': {reason}.")
+        self.skipped.append(name)
+        if self.metrics is not None:
+            self.metrics.count("attachments_skipped")
+        return True
+
+    def log_summary(self):
+        if self.skipped:
+            logging.info(f"Skipped {len(self.skipped)} attachments by the size and content type limits.")
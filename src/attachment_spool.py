@@ -0,0 +1,102 @@
+"""
+Bounded-memory storage of attachment content downloaded in slices.
+"""
+
+import binascii
+import quopri
+import shutil
+import tempfile
+import threading
+
+# Buffer size used when copying spooled content to the output files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_BASE64_WHITESPACE = b" \t\r\n"
+
+
+class MemoryBudget:
+    """Number of bytes that may be held in memory, shared by all workers of a run."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size) -> bool:
+        """Reserve `size` bytes, returns False if they do not fit into the budget."""
+        with self._lock:
+            if self.used + size > self.max_bytes:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+
+class AttachmentSpool:
+    """
+    Decoded content of a single attachment.
+
+    The content is kept in memory if its expected size fits into the memory budget, otherwise it is spilled
+    to a temporary file on disk. Close the spool to delete the file and release the reserved budget.
+    """
+
+    def __init__(self, budget: MemoryBudget, expected_size):
+        self._budget = budget
+        self._reserved = expected_size if budget.reserve(expected_size) else 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=max(self._reserved, 1))
+        if not self._reserved:
+            self._file.rollover()
+
+    def write(self, data: bytes):
+        self._file.write(data)
+
+    def iter_chunks(self):
+        """Iterate over the content in chunks of COPY_BUFFER_SIZE bytes."""
+        self._file.seek(0)
+        while chunk := self._file.read(COPY_BUFFER_SIZE):
+            yield chunk
+
+    def copy_to(self, out_file):
+        """Copy the content to a file object opened for binary writing."""
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, out_file, COPY_BUFFER_SIZE)
+
+    def close(self):
+        self._file.close()
+        self._budget.release(self._reserved)
+        self._reserved = 0
+
+
+class TransferDecoder:
+    """Incremental decoder of a Content-Transfer-Encoding, for content received in arbitrary slices."""
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "7bit").lower()
+        self._pending = b""
+
+    def decode(self, data: bytes) -> bytes:
+        """Decode the next slice, incomplete trailing input is kept until the next call."""
+        if self.encoding == "base64":
+            data = self._pending + data.translate(None, _BASE64_WHITESPACE)
+            complete = len(data) - len(data) % 4
+            self._pending = data[complete:]
+            return binascii.a2b_base64(data[:complete])
+        if self.encoding == "quoted-printable":
+            data = self._pending + data
+            complete = data.rfind(b"\n") + 1
+            self._pending = data[complete:]
+            return quopri.decodestring(data[:complete])
+        return data
+
+    def flush(self) -> bytes:
+        """Decode the remaining input at the end of the content."""
+        pending, self._pending = self._pending, b""
+        if not pending:
+            return b""
+        if self.encoding == "base64":
+            # Same tolerance to missing padding as the email package
+            return binascii.a2b_base64(pending + b"=" * (-len(pending) % 4))
+        return quopri.decodestring(pending)
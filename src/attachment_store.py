@@ -0,0 +1,146 @@
+"""
+Content-addressed storage of attachment files, deduplicated within and across runs.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from keboola.component.dao import FileDefinition
+from keboola.utils import header_normalizer
+from keboola.utils.header_normalizer import NormalizerStrategy
+
+# Columns of the table mapping the attachments of the emails to the content hashes of the attachment files
+ATTACHMENTS_TABLE_COLUMNS = ["email_pk", "attachment_id", "attachment_name", "content_hash", "file_name"]
+
+# Maximum number of attachments and of files remembered in the state, the oldest entries are dropped first.
+# The whole state is serialized at every checkpoint, the cap keeps it at a few MB.
+ATTACHMENT_STATE_MAX_ENTRIES = 10_000
+# Number of hex characters of the SHA-256 hash of the attachment key stored in the state
+ATTACHMENT_KEY_HASH_LENGTH = 16
+
+
+class AttachmentStore:
+    """
+    Writes each unique attachment content once, to a file named by its SHA-256 hash.
+
+    Every attachment is recorded as a row of the attachments table (email_pk, attachment_id -> content_hash).
+    The hashes of the attachments and the files written are kept in the component state, so that attachments
+    of messages processed again are not downloaded at all and content written by a previous run is not
+    written again. The store is shared by all fetchers of the run.
+    """
+
+    def __init__(self, component):
+        from component import KEY_STATE_ATTACHMENT_DEDUP
+
+        self.component = component
+        # The maps are part of the component state, they are changed under its lock
+        self._lock = component.state_lock
+        with self._lock:
+            state = component.state.setdefault(KEY_STATE_ATTACHMENT_DEDUP, {})
+            # Hash of the attachment key (email_pk/attachment_id) -> content hash
+            self._attachments = state.setdefault("attachments", {})
+            # Content hash -> file name
+            self._files = state.setdefault("files", {})
+        self.rows = []
+        self.written_count = 0
+        self.duplicate_count = 0
+        self.skipped_count = 0
+
+    def is_known(self, email_pk, attachment_id) -> bool:
+        """Check whether the content of the attachment is known from a previous run."""
+        with self._lock:
+            return self._attachments.get(self._attachment_key(email_pk, attachment_id)) in self._files
+
+    def add_known(self, email_pk, attachment_id, attachment_name) -> bool:
+        """
+        Record an attachment whose content is known from a previous run, without downloading it.
+
+        Returns:
+            True if the attachment is known and was recorded, False if it has to be downloaded and written
+        """
+        with self._lock:
+            content_hash = self._attachments.get(self._attachment_key(email_pk, attachment_id))
+            if content_hash is None or content_hash not in self._files:
+                return False
+            self._add_row(email_pk, attachment_id, attachment_name, content_hash)
+            self.skipped_count += 1
+            return True
+
+    def write(self, email_pk, attachment_id, attachment_name, content_chunks) -> FileDefinition | None:
+        """
+        Write the attachment content (an iterable of bytes chunks) unless a file with the same content exists.
+
+        The content is hashed while it is written to a temporary file in the output files folder, which is then
+        renamed to the final file or deleted if the content is a duplicate.
+
+        Returns:
+            FileDefinition of the written file, None for duplicate content
+        """
+        content_hash = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.component.files_out_path, prefix=".", delete=False) as tmp_file:
+            try:
+                for chunk in content_chunks:
+                    content_hash.update(chunk)
+                    tmp_file.write(chunk)
+            except BaseException:
+                tmp_file.close()
+                os.remove(tmp_file.name)
+                raise
+
+        digest = content_hash.hexdigest()
+        file_def = None
+        with self._lock:
+            if digest in self._files:
+                self.duplicate_count += 1
+                os.remove(tmp_file.name)
+            else:
+                file_name = self._build_file_name(digest, attachment_name)
+                file_def = self.component.create_out_file_definition(file_name, tags=[f"content_hash: {digest}"])
+                os.replace(tmp_file.name, file_def.full_path)
+                self._remember(self._files, digest, file_name)
+                self.written_count += 1
+            self._remember(self._attachments, self._attachment_key(email_pk, attachment_id), digest)
+            self._add_row(email_pk, attachment_id, attachment_name, digest)
+        return file_def
+
+    def log_summary(self):
+        logging.info(
+            f"Attachment deduplication: {self.written_count} files written, {self.duplicate_count} duplicates "
+            f"not written, {self.skipped_count} attachments known from previous runs not downloaded."
+        )
+
+    def _add_row(self, email_pk, attachment_id, attachment_name, content_hash):
+        self.rows.append(
+            {
+                "email_pk": email_pk,
+                "attachment_id": attachment_id,
+                "attachment_name": attachment_name,
+                "content_hash": content_hash,
+                "file_name": self._files[content_hash],
+            }
+        )
+
+    @staticmethod
+    def _attachment_key(email_pk, attachment_id):
+        """Shorten the attachment key to a prefix of its hash, Graph API attachment IDs are ~150 characters long."""
+        key = f"{email_pk}/{attachment_id}".encode()
+        return hashlib.sha256(key).hexdigest()[:ATTACHMENT_KEY_HASH_LENGTH]
+
+    @staticmethod
+    def _build_file_name(digest, attachment_name):
+        """Name the file by the content hash, keeping the extension of the attachment name."""
+        normalizer = header_normalizer.get_normalizer(
+            NormalizerStrategy.DEFAULT,
+            permitted_chars=header_normalizer.PERMITTED_CHARS + ".",
+        )
+        extension = os.path.splitext(attachment_name)[1]
+        return normalizer.normalize_header([f"{digest}{extension}"])[0]
+
+    @staticmethod
+    def _remember(entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        while len(entries) > ATTACHMENT_STATE_MAX_ENTRIES:
+            del entries[next(iter(entries))]
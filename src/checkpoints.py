@@ -0,0 +1,49 @@
+"""
+Resume positions of interrupted runs (checkpoint_interval), kept in the component state per mailbox.
+"""
+
+import logging
+
+
+class CheckpointStore:
+    """
+    Stores the resume position of the extraction of a mailbox in the component state and writes the state file.
+
+    A checkpoint holds the parameters that select the messages (e.g. the folder and the query) with the position,
+    it is used by the next run only if the selection did not change since.
+    """
+
+    def __init__(self, component, user_name):
+        self.component = component
+        self.user_name = user_name
+        # Whether a checkpoint was saved during this run
+        self.saved = False
+
+    def get(self, **selection) -> dict | None:
+        """Return the checkpoint of the previous run if its fields match the selection, None otherwise."""
+        checkpoint = self._get_checkpoints().get(self.user_name)
+        if not checkpoint:
+            return None
+        if any(checkpoint.get(name) != value for name, value in selection.items()):
+            logging.warning("The checkpoint of the previous run does not match the extraction, ignoring it.")
+            return None
+        return checkpoint
+
+    def save(self, checkpoint: dict):
+        """Store the resume position of the extraction and write the state file."""
+        with self.component.state_lock:
+            self._get_checkpoints()[self.user_name] = checkpoint
+        self.component.write_state_checkpoint()
+        self.saved = True
+
+    def clear(self):
+        """Drop the checkpoint of the mailbox, once the extraction is completed or the checkpoint is no longer valid."""
+        with self.component.state_lock:
+            self._get_checkpoints().pop(self.user_name, None)
+
+    def _get_checkpoints(self):
+        """Return the checkpoints of the interrupted runs of all mailboxes, stored in the component state."""
+        from component import KEY_STATE_CHECKPOINT
+
+        with self.component.state_lock:
+            return self.component.state.setdefault(KEY_STATE_CHECKPOINT, {})
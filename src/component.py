@@ -1,13 +1,25 @@
+import csv
+import imaplib
+import json
 import logging
+import os
+import socket
+import ssl
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-import msal
+import requests
 from keboola.component.base import ComponentBase
 from keboola.component.exceptions import UserException
 
+from attachment_store import ATTACHMENTS_TABLE_COLUMNS, AttachmentStore
 from configuration import CONNECTION_METHOD_GRAPH, CONNECTION_METHOD_IMAP, Configuration
-from graph_client import GraphEmailFetcher
+from graph_client import GraphEmailFetcher, GraphRequestError
 from imap_client import ImapEmailFetcher
+from metrics import RunMetrics
+from output_writer import SynchronizedWriter, open_output_writer
+from token_manager import TokenManager
 
 # Result columns for email output
 RESULT_COLUMNS = [
@@ -26,14 +38,41 @@ RESULT_COLUMNS = [
     "attachment_names",
 ]
 
+# Columns of the table of the message bodies stored separately from the emails table (separate_bodies)
+BODY_COLUMNS = ["pk", "body", "body_html"]
+
 # State keys (not config parameters)
 KEY_STATE_REFRESH_TOKEN = "#refresh_token"
+KEY_STATE_TOKEN_CACHE = "#msal_token_cache"
+KEY_STATE_IMAP_SYNC = "imap_sync"
+KEY_STATE_GRAPH_DELTA = "graph_delta"
+KEY_STATE_ATTACHMENT_DEDUP = "attachment_dedup"
+KEY_STATE_CHECKPOINT = "checkpoint"
 
 # Microsoft OAuth scopes
 MS_IMAP_SCOPE = ["https://outlook.office.com/IMAP.AccessAsUser.All"]
 
 REQUIRED_IMAGE_PARS = []
 
+# Network errors a run interrupted after a checkpoint ends with successfully, the next run resumes from the checkpoint
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.gaierror,
+    ssl.SSLError,
+    imaplib.IMAP4.abort,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def _is_transient_error(error):
+    """Check whether an error is expected to pass in a later run: a network error or a throttled Graph API request."""
+    if isinstance(error, GraphRequestError):
+        return isinstance(error.status_code, int) and (error.status_code == 429 or error.status_code >= 500)
+    # Connection errors are raised as UserException by the fetchers
+    return isinstance(error, TRANSIENT_ERRORS) or isinstance(error.__cause__, TRANSIENT_ERRORS)
+
 
 class Component(ComponentBase):
     def __init__(self):
@@ -43,6 +82,20 @@ class Component(ComponentBase):
             "ignore",
             message="The localize method is no longer necessary, as this time zone supports the fold attribute",
         )
+        self._state = None
+        self.metrics = RunMetrics()
+        # Access tokens shared by the fetchers of all mailboxes
+        # Guards the changes of the state by the fetchers, the token manager and the attachment store running in
+        # parallel, so that the state file is written from a consistent snapshot
+        self.state_lock = threading.RLock()
+        self.token_manager = TokenManager(self)
+
+    @property
+    def state(self):
+        """Component state loaded from the state file, updated in place during the run."""
+        if self._state is None:
+            self._state = self.get_state_file() or {}
+        return self._state
 
     @property
     def use_oauth_login(self):
@@ -67,56 +120,174 @@ class Component(ComponentBase):
         if self.use_oauth_login and not self.configuration.oauth_credentials:
             raise UserException("Component is not authorized. Please authorize the component in Keboola.")
 
-        output_table = self.create_out_table_definition("emails.csv", primary_key=["pk"], incremental=True)
+        output_columns = config.output_columns
+        output_table = self._create_output_table("emails.csv", output_columns, config)
+        body_columns = [column for column in BODY_COLUMNS if column in output_columns]
+        bodies_table = None
+        if config.separate_bodies and len(body_columns) > 1:
+            bodies_table = self._create_output_table("email_bodies.csv", body_columns, config)
 
+        attachment_store = AttachmentStore(self) if config.attachment_dedup else None
         if self._use_graph_api:
-            fetcher = GraphEmailFetcher(self, config)
-            results = fetcher.fetch(
-                output_table, config.download_content, config.download_attachments, config.mark_seen
-            )
-            fetcher.close()
+            fetchers = [
+                GraphEmailFetcher(self, mailbox_config, shared_mailbox=i > 0, attachment_store=attachment_store)
+                for i, mailbox_config in enumerate(config.mailbox_configs())
+            ]
         else:
-            fetcher = ImapEmailFetcher(self, config)
-            results = fetcher.fetch(
-                output_table, config.download_content, config.download_attachments, config.mark_seen
-            )
-            fetcher.close()
+            fetchers = [
+                ImapEmailFetcher(self, mailbox_config, attachment_store=attachment_store)
+                for mailbox_config in config.mailbox_configs()
+            ]
+
+        try:
+            results = self._fetch_all(fetchers, output_table, bodies_table, config)
+            if bodies_table is not None:
+                results.append(bodies_table)
+            if attachment_store is not None:
+                attachment_store.log_summary()
+                results.append(self._write_attachments_table(attachment_store))
+            self.write_manifests(results)
+            # With mark_seen_after_run, messages are marked only once the output is complete
+            for fetcher in fetchers:
+                fetcher.mark_processed_as_seen()
+        finally:
+            for fetcher in fetchers:
+                fetcher.close()
 
-        self.write_manifests(results)
+        self.write_state_file(self.state)
+        self._write_run_metrics(config)
         logging.info("Extraction finished.")
 
-    def get_access_token(self, refresh_token, scopes=None):
+    def _fetch_all(self, fetchers, output_table, bodies_table, config):
         """
-        Acquire an OAuth access token using MSAL.
+        Fetch all mailboxes into the output tables.
 
-        Args:
-            refresh_token: OAuth refresh token
-            scopes: List of OAuth scopes (defaults to MS_IMAP_SCOPE)
+        With checkpoint_interval, a run interrupted by a transient error (network, throttling) keeps the output
+        written so far and ends successfully if every interrupted mailbox got past a new checkpoint, so that the state
+        with the checkpoints is stored and the next run resumes from them. Other errors, and transient errors before
+        a new checkpoint (the error would repeat in every run), are raised.
 
         Returns:
-            Access token string
+            List of FileDefinition objects (output_table + attachments of all mailboxes)
         """
-        scopes = scopes or MS_IMAP_SCOPE
-        authority = self.configuration.image_parameters.get("authority") or "https://login.microsoftonline.com/common"
-        app = msal.ConfidentialClientApplication(
-            self.configuration.oauth_credentials.appKey,
-            authority=authority,
-            client_credential=self.configuration.oauth_credentials.appSecret,
-        )
+        try:
+            with open_output_writer(
+                output_table,
+                slice_size_mb=config.output_slice_size_mb,
+                bodies_table=bodies_table,
+                body_min_size_kb=config.separate_body_min_kb,
+                columns=config.output_columns,
+            ) as writer:
+                if len(fetchers) == 1:
+                    return fetchers[0].fetch(
+                        output_table,
+                        config.download_content,
+                        config.download_attachments,
+                        config.mark_seen,
+                        writer=writer,
+                    )
+                return self._fetch_mailboxes(fetchers, output_table, config, writer)
+        except Exception as e:
+            if not _is_transient_error(e) or not all(fetcher.completed or fetcher.checkpointed for fetcher in fetchers):
+                raise
+            logging.error(
+                f"The extraction was interrupted: {e}. The messages processed so far are written to the output, "
+                f"the next run resumes from the last checkpoint.",
+                exc_info=True,
+            )
+            return [output_table] + [file_def for fetcher in fetchers for file_def in fetcher.results[1:]]
 
-        result = app.acquire_token_by_refresh_token(refresh_token, scopes)
+    def write_state_checkpoint(self):
+        """Write the current state to the state file during the run, replacing the previous file atomically."""
+        with self.state_lock:
+            content = json.dumps(self.state)
+            path = os.path.join(self.configuration.data_dir, "out", "state.json")
+            with open(f"{path}.tmp", "w") as state_file:
+                state_file.write(content)
+            os.replace(f"{path}.tmp", path)
 
-        if "access_token" not in result:
-            raise UserException(
-                f"Failed to login with oAuth. "
-                f"Try to clear state and reauthorize the application.\n"
-                f"Got error {result.get('error')}. "
-                f"Error description : {result.get('error_description')}. "
-                f"Correlation ID : {result.get('correlation_id')}"
+    def _create_output_table(self, name, columns, config):
+        """Create the definition of an incremental output table with the `pk` primary key."""
+        if config.output_slice_size_mb:
+            # Written as gzip compressed header-less slices, the columns are listed in the manifest
+            return self.create_out_table_definition(
+                name, is_sliced=True, schema=columns, primary_key=["pk"], incremental=True
             )
+        return self.create_out_table_definition(name, primary_key=["pk"], incremental=True)
+
+    def _fetch_mailboxes(self, fetchers, output_table, config, writer=None):
+        """
+        Fetch several mailboxes concurrently into the same output table.
+
+        Up to mailbox_concurrency mailboxes are processed at a time, their rows are written to a single
+        emails.csv (or the given writer) as they are fetched, each mailbox keeps its own state.
+
+        Returns:
+            List of FileDefinition objects (output_table + attachments of all mailboxes)
+        """
+        logging.info(
+            f"Extracting {len(fetchers)} mailboxes, {min(config.mailbox_concurrency, len(fetchers))} at a time."
+        )
+        results = [output_table]
+        with open_output_writer(
+            output_table, writer, config.output_slice_size_mb, columns=config.output_columns
+        ) as writer:
+            shared_writer = SynchronizedWriter(writer)
+
+            def fetch_mailbox(fetcher):
+                logging.info(f"Extracting mailbox {fetcher.config.user_name}.")
+                return fetcher.fetch(
+                    output_table,
+                    config.download_content,
+                    config.download_attachments,
+                    config.mark_seen,
+                    writer=shared_writer,
+                )
+
+            with ThreadPoolExecutor(max_workers=config.mailbox_concurrency, thread_name_prefix="mailbox") as executor:
+                for mailbox_results in executor.map(fetch_mailbox, fetchers):
+                    results.extend(mailbox_results[1:])
+        return results
+
+    def _write_run_metrics(self, config):
+        """Log the summary of the run metrics and, with write_run_metrics, write them to a JSON output file."""
+        metrics = self.metrics.to_dict()
+        phases = ", ".join(f"{name} {stats['total_seconds']:.1f} s" for name, stats in metrics["phases"].items())
+        logging.info(
+            f"Run metrics: {metrics['counters'].get('messages', 0)} messages in {metrics['wall_seconds']:.1f} s "
+            f"({metrics['messages_per_second']:.1f} messages/s). Time per phase (summed over all workers): {phases}."
+        )
+        if config.write_run_metrics:
+            file_def = self.create_out_file_definition("run_metrics.json", tags=["run_metrics"])
+            self.metrics.write(file_def.full_path)
+            self.write_manifest(file_def)
+
+    def _write_attachments_table(self, attachment_store):
+        """Write the attachments table mapping the email attachments to the deduplicated attachment files."""
+        table = self.create_out_table_definition(
+            "attachments.csv", primary_key=["email_pk", "attachment_id"], incremental=True
+        )
+        with open(table.full_path, "w+", encoding="utf-8") as output:
+            writer = csv.DictWriter(output, fieldnames=ATTACHMENTS_TABLE_COLUMNS, dialect="kbc")
+            writer.writeheader()
+            writer.writerows(attachment_store.rows)
+        return table
 
-        self.write_state_file({KEY_STATE_REFRESH_TOKEN: result["refresh_token"]})
-        return result["access_token"]
+    def get_access_token(self, scopes=None, rejected_token=None):
+        """
+        Get an OAuth access token from the token manager of the run.
+
+        The token is shared by the fetchers of all mailboxes and refreshed ahead of its expiry, so it is
+        valid for at least a few minutes whenever it is returned.
+
+        Args:
+            scopes: List of OAuth scopes (defaults to MS_IMAP_SCOPE)
+            rejected_token: Token rejected by the server, refreshed even if it has not expired yet
+
+        Returns:
+            Access token string
+        """
+        return self.token_manager.get_access_token(scopes or MS_IMAP_SCOPE, rejected_token=rejected_token)
 
     def get_refresh_token(self):
         """
@@ -125,9 +296,8 @@ class Component(ComponentBase):
         Returns:
             Refresh token string
         """
-        state = self.get_state_file() or {}
         data = self.configuration.oauth_credentials.data
-        return state.get(KEY_STATE_REFRESH_TOKEN) or data.get("refresh_token")
+        return self.state.get(KEY_STATE_REFRESH_TOKEN) or data.get("refresh_token")
 
 
 """
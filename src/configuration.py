@@ -2,6 +2,7 @@
 Configuration schema for Email Content Extractor.
 """
 
+import re
 from typing import Any
 
 from keboola.component.exceptions import UserException
@@ -11,6 +12,16 @@ CONNECTION_METHOD_IMAP = "imap"
 CONNECTION_METHOD_GRAPH = "graph_api"
 
 
+class Mailbox(BaseModel):
+    """Additional mailbox extracted in the same run."""
+
+    user_name: str
+    password: str = Field(default="", alias="#password")
+
+    class Config:
+        populate_by_name = True
+
+
 class Configuration(BaseModel):
     """Configuration for Email Content Extractor."""
 
@@ -19,6 +30,8 @@ class Configuration(BaseModel):
     host: str = Field(default="")
     port: int = Field(default=993)
     connection_method: str = Field(default=CONNECTION_METHOD_IMAP)
+    mailboxes: list[Mailbox] = Field(default_factory=list)
+    mailbox_concurrency: int = Field(default=1, ge=1, le=10)
 
     query: str = Field(default="(ALL)")
     graph_filter: str = Field(default="")
@@ -28,7 +41,28 @@ class Configuration(BaseModel):
     download_content: bool = Field(default=True)
     download_attachments: bool = Field(default=False)
     mark_seen: bool = Field(default=True)
+    mark_seen_after_run: bool = Field(default=False)
     attachment_pattern: str = Field(default="")
+    attachment_dedup: bool = Field(default=False)
+    attachment_max_size_mb: int = Field(default=0, ge=0)
+    attachment_content_types: list[str] = Field(default_factory=list)
+    attachment_excluded_content_types: list[str] = Field(default_factory=list)
+    incremental_fetch: bool = Field(default=False)
+    graph_batch_requests: bool = Field(default=False)
+    graph_local_text_body: bool = Field(default=False)
+    graph_concurrency: int = Field(default=1, ge=1, le=16)
+    imap_connections: int = Field(default=1, ge=1, le=10)
+    imap_selective_fetch: bool = Field(default=False)
+    imap_fetch_chunk_size: int = Field(default=1, ge=1, le=500)
+    imap_fetch_chunk_max_mb: int = Field(default=100, ge=1)
+    imap_memory_budget_mb: int = Field(default=0, ge=0)
+    write_run_metrics: bool = Field(default=False)
+    output_slice_size_mb: int = Field(default=0, ge=0)
+    separate_bodies: bool = Field(default=False)
+    separate_body_min_kb: int = Field(default=0, ge=0)
+    checkpoint_interval: int = Field(default=0, ge=0)
+    columns: list[str] = Field(default_factory=list)
+    header_fields: list[str] = Field(default_factory=list)
 
     def __init__(self, **data: Any) -> None:
         try:
@@ -64,11 +98,62 @@ class Configuration(BaseModel):
                     "#some-limitations-apply-to-query-parameters"
                 )
 
+        if self.connection_method == CONNECTION_METHOD_GRAPH and self.incremental_fetch:
+            if self.graph_search or self.graph_filter:
+                raise ValueError(
+                    "Fetch only new messages cannot be combined with Graph API Search or Graph API Filter. "
+                    "The Graph API delta query supports filtering by Period from date only."
+                )
+
+        user_names = [self.user_name.lower()] + [m.user_name.lower() for m in self.mailboxes]
+        duplicates = sorted({name for name in user_names if user_names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Mailboxes must be unique, listed more than once: {', '.join(duplicates)}")
+
+        from component import RESULT_COLUMNS
+
+        unknown_columns = [column for column in self.columns if column not in RESULT_COLUMNS]
+        if unknown_columns:
+            raise ValueError(
+                f"Unknown output columns: {', '.join(unknown_columns)}. Available columns: {', '.join(RESULT_COLUMNS)}"
+            )
+
+        if (
+            self.connection_method == CONNECTION_METHOD_IMAP
+            and self.imap_memory_budget_mb
+            and not self.imap_selective_fetch
+        ):
+            raise ValueError(
+                "Attachment memory budget requires Download only required message parts (imap_selective_fetch), "
+                "attachments of whole downloaded messages cannot be processed in slices."
+            )
+
+        invalid_fields = [name for name in self.header_fields if not name or re.search(r"[\s:]", name)]
+        if invalid_fields:
+            raise ValueError(
+                f"Invalid header fields: {', '.join(repr(name) for name in invalid_fields)}. "
+                "Use header field names or glob patterns without spaces and colons, e.g. subject or x-ms-*."
+            )
+
         if not self.download_content and not self.download_attachments:
             raise ValueError(
                 "Nothing selected for download, please select at least one of the options Attachments or Content!"
             )
         return self
 
+    @property
+    def output_columns(self) -> list[str]:
+        """Columns of the emails table: the selected columns (all if none) in the table order, always with `pk`."""
+        from component import RESULT_COLUMNS
+
+        return [column for column in RESULT_COLUMNS if not self.columns or column in self.columns or column == "pk"]
+
+    def mailbox_configs(self) -> list["Configuration"]:
+        """Return the configurations of all mailboxes to extract, the main mailbox (user_name) first."""
+        return [self] + [
+            self.model_copy(update={"user_name": m.user_name, "password": m.password, "mailboxes": []})
+            for m in self.mailboxes
+        ]
+
     class Config:
         populate_by_name = True
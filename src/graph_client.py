@@ -1,10 +1,12 @@
 import base64
-import csv
 import hashlib
+import itertools
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
+from urllib.parse import quote, urlencode
 
 import requests
 from keboola.component.dao import FileDefinition
@@ -12,6 +14,14 @@ from keboola.component.exceptions import UserException
 from keboola.utils import header_normalizer
 from keboola.utils.date import parse_datetime_interval
 from keboola.utils.header_normalizer import NormalizerStrategy
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+from attachment_limits import AttachmentLimits
+from checkpoints import CheckpointStore
+from header_fields import HeaderFieldFilter
+from html_text import html_to_text
+from output_writer import open_output_writer
+from throttling import AdaptiveRateLimiter, get_retry_delay
 
 if TYPE_CHECKING:
     from configuration import Configuration
@@ -19,6 +29,30 @@ if TYPE_CHECKING:
 # Graph API constants
 GRAPH_API_BASE = "https://graph.microsoft.com/v1.0"
 GRAPH_PAGE_SIZE = 100
+# Attachment metadata expanded inline with the message, without the attachment content
+GRAPH_ATTACHMENTS_EXPAND = "attachments($select=id,name,contentType,size,isInline)"
+# Message properties of the detail requests, internetMessageHeaders only if the headers column is selected
+GRAPH_DETAIL_PROPERTIES = (
+    "id",
+    "subject",
+    "from",
+    "toRecipients",
+    "receivedDateTime",
+    "body",
+    "hasAttachments",
+    "internetMessageHeaders",
+    "isRead",
+)
+# Maximum number of sub-requests in a single JSON batch request
+GRAPH_BATCH_SIZE = 20
+# Throttling responses that are retried, see https://learn.microsoft.com/en-us/graph/throttling
+GRAPH_RETRY_STATUS_CODES = (429, 503, 504)
+GRAPH_MAX_RETRIES = 8
+# Responses to a stored nextLink or deltaLink that is no longer valid, the listing is then started again
+GRAPH_STALE_LINK_STATUS_CODES = (400, 404, 410)
+# Attachment content is streamed to the output files in chunks of this size (bytes)
+GRAPH_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+GRAPH_FILE_ATTACHMENT_TYPE = "#microsoft.graph.fileAttachment"
 MS_GRAPH_SCOPE = ["https://graph.microsoft.com/Mail.ReadWrite.Shared"]
 
 # Graph API well-known folder name mapping
@@ -36,22 +70,72 @@ GRAPH_WELL_KNOWN_FOLDERS = {
 }
 
 
+class GraphRequestError(UserException):
+    """Raised when a Graph API request fails, with the HTTP status code of the response."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GraphSyncStateExpiredError(GraphRequestError):
+    """Raised when a stored delta link is no longer valid (HTTP 410 Gone)."""
+
+    def __init__(self, message, status_code=410):
+        super().__init__(message, status_code)
+
+
 class GraphEmailFetcher:
     """Handles Microsoft Graph API email fetching with OAuth authentication."""
 
-    def __init__(self, component, config: "Configuration"):
+    def __init__(self, component, config: "Configuration", shared_mailbox=False, attachment_store=None):
         """
         Initialize Graph API email fetcher.
 
         Args:
             component: Component instance (for access to create_out_file_definition, OAuth methods, etc.)
             config: Configuration object with all parameters
+            shared_mailbox: Whether the mailbox (user_name) is accessed via the /users endpoints on behalf of
+                the signed-in user, instead of the /me endpoints of the signed-in user's own mailbox
+            attachment_store: AttachmentStore writing deduplicated attachments (attachment_dedup)
         """
         self.component = component
         self.config = config
+        if shared_mailbox:
+            self._mailbox_url = f"{GRAPH_API_BASE}/users/{quote(config.user_name, safe='@')}"
+        else:
+            self._mailbox_url = f"{GRAPH_API_BASE}/me"
         self._graph_session: requests.Session | None = None
-
-    def fetch(self, output_table, download_content, download_attachments, mark_seen):
+        self._executor: ThreadPoolExecutor | None = None
+        self._rate_limiter = AdaptiveRateLimiter(max_limit=config.graph_concurrency)
+        self._attachment_store = attachment_store
+        # Columns of the emails table, only the data needed for them is requested
+        self._columns = config.output_columns
+        self._header_filter = HeaderFieldFilter(config.header_fields)
+        self._attachment_limits = AttachmentLimits(
+            config.attachment_max_size_mb,
+            config.attachment_content_types,
+            config.attachment_excluded_content_types,
+            metrics=component.metrics,
+        )
+        # Unread messages to mark as read once the output is written (mark_seen_after_run)
+        self._unread_message_ids: list[str] = []
+        # Messages marked as read by this run and the folder of the delta round (incremental_fetch)
+        self._marked_read_ids: set[str] = set()
+        self._delta_folder = None
+        # Output table and attachment files written by `fetch`, also when it is interrupted
+        self.results = []
+        # Resume position of the extraction (checkpoint_interval)
+        self._checkpoints = CheckpointStore(component, config.user_name)
+        # Whether `fetch` completed
+        self.completed = False
+
+    @property
+    def checkpointed(self) -> bool:
+        """Whether a checkpoint was saved during this run (checkpoint_interval)."""
+        return self._checkpoints.saved
+
+    def fetch(self, output_table, download_content, download_attachments, mark_seen, writer=None):
         """
         Fetch emails via Microsoft Graph API and write to output table.
 
@@ -60,78 +144,269 @@ class GraphEmailFetcher:
             download_content: Whether to download email content
             download_attachments: Whether to download attachments
             mark_seen: Whether to mark emails as read
+            writer: Writer of the output table rows shared with other mailboxes, the output table is written
+                by this fetcher if not set
 
         Returns:
             List of FileDefinition objects (output_table + attachments)
         """
-        from component import RESULT_COLUMNS
-
         logging.info("Logging in via Microsoft Graph API..")
         self._init_graph_session()
 
         folder = self.config.imap_folder or "inbox"
         graph_folder = self._resolve_graph_folder(folder)
 
-        # Build the messages URL with folder
-        messages_url = f"{GRAPH_API_BASE}/me/mailFolders/{graph_folder}/messages"
-
-        # Build query parameters
-        query_params = self._build_query_params()
+        resume_link = self._get_resume_link(folder) if self.config.checkpoint_interval else None
+        pages = None
+        if self.config.incremental_fetch:
+            self._delta_folder = folder
+            pages = self._iter_delta_pages(folder, graph_folder, resume_link)
+        elif resume_link:
+            pages = self._iter_stored_link_pages(resume_link)
+            if pages is None:
+                logging.warning("The checkpoint of the previous run is no longer valid, listing all messages again.")
+                self._checkpoints.clear()
+        if pages is None:
+            # Build the messages URL with folder
+            messages_url = f"{self._mailbox_url}/mailFolders/{graph_folder}/messages"
+            pages = self._iter_pages(messages_url, self._build_query_params())
 
         count = 0
-        results = [output_table]
+        checkpoint_count = 0
+        results = self.results = [output_table]
+        deferred_mark_seen = mark_seen and self.config.mark_seen_after_run
+        if deferred_mark_seen:
+            mark_seen = False
+
+        concurrency = self.config.graph_concurrency
+        if concurrency > 1:
+            logging.info(f"Processing messages with {concurrency} concurrent workers.")
+            self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="graph")
+        processed_pages = (
+            (page, self._process_page(page.get("value", []), download_attachments, mark_seen)) for page in pages
+        )
 
-        with open(output_table.full_path, "w+", encoding="utf-8") as output:
-            writer = csv.DictWriter(output, fieldnames=RESULT_COLUMNS, dialect="kbc")
-            writer.writeheader()
+        try:
+            # The workers only fetch data and write attachment files; rows are written by this thread
+            # in the order of the listing, so the output is the same as with sequential processing.
+            with open_output_writer(
+                output_table, writer, self.config.output_slice_size_mb, columns=self._columns
+            ) as writer:
+                for page, processed in processed_pages:
+                    for msg_detail, attachments, file_defs in processed:
+                        if deferred_mark_seen and not msg_detail.get("isRead", False):
+                            self._unread_message_ids.append(msg_detail["id"])
+
+                        if download_content:
+                            with self.component.metrics.timer("row_build"):
+                                row = self._build_email_row(msg_detail, attachments)
+                            with self.component.metrics.timer("csv_write"):
+                                writer.writerow(row)
+
+                        results.extend(file_defs)
+
+                        self.component.metrics.count("messages")
+                        count += 1
+                        if count % 10 == 0:
+                            logging.info(f"Processing messages {count - 10} - {count}")
+                            logging.info(f"Processed {len(results) - 1} attachments matching the pattern so far.")
+
+                    # Checkpoints are taken between pages, the next page is where the extraction resumes
+                    next_link = page.get("@odata.nextLink")
+                    if (
+                        self.config.checkpoint_interval
+                        and next_link
+                        and count - checkpoint_count >= self.config.checkpoint_interval
+                    ):
+                        self._checkpoints.save(
+                            {"folder": folder, "query": self._checkpoint_query(), "next_link": next_link}
+                        )
+                        checkpoint_count = count
+        finally:
+            processed_pages.close()
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
 
-            url = messages_url
-            first_request = True
+        logging.info(f"Processed {count} messages in total.")
+        logging.info(f"Processed {len(results) - 1} attachments matching the pattern in total.")
+        self._attachment_limits.log_summary()
+        if count == 0:
+            logging.warning("No messages matched the specified filter")
+        self._rate_limiter.log_summary("Microsoft Graph API")
+        if not deferred_mark_seen:
+            self._skip_own_read_changes()
+        if self.config.checkpoint_interval:
+            self._checkpoints.clear()
+        self.completed = True
 
-            while url:
-                if first_request:
-                    response = self._request("GET", url, params=query_params)
-                    first_request = False
-                else:
-                    # Pagination: @odata.nextLink already contains all query params
-                    response = self._request("GET", url)
+        return results
 
-                data = response.json()
-                messages = data.get("value", [])
+    def mark_processed_as_seen(self):
+        """
+        Mark the unread messages processed by `fetch` as read, with batched requests.
 
-                for msg_data in messages:
-                    # Fetch full message with headers and body (both text and html)
-                    msg_detail = self._fetch_message_detail(msg_data["id"])
+        Used with mark_seen_after_run, to be called once the output is fully written.
+        """
+        if not self._unread_message_ids:
+            return
+        logging.info(f"Marking {len(self._unread_message_ids)} processed messages as read.")
+        self._mark_as_read_batched(self._unread_message_ids)
+        self._unread_message_ids = []
+        self._skip_own_read_changes()
+
+    def _map(self, func, items):
+        """Apply func to items on the worker pool if concurrency is enabled. Results keep the order of items."""
+        if self._executor is None:
+            return map(func, items)
+        return self._executor.map(func, items)
+
+    def _iter_pages(self, url, query_params, extra_headers=None):
+        """Iterate over response pages of a Graph API collection, following @odata.nextLink."""
+        params = query_params
+        while url:
+            response = self._request("GET", url, params=params, extra_headers=extra_headers)
+            # Pagination: @odata.nextLink already contains all query params
+            params = None
+
+            data = response.json()
+            yield data
+
+            # Follow pagination
+            url = data.get("@odata.nextLink")
+
+    def _iter_stored_link_pages(self, link, extra_headers=None):
+        """
+        Return an iterator over the pages of a nextLink or deltaLink stored by a previous run, None if the link
+        is no longer valid (rejected with one of GRAPH_STALE_LINK_STATUS_CODES).
 
-                    # Fetch attachments metadata
-                    attachments = []
-                    if msg_detail.get("hasAttachments"):
-                        attachments = self._fetch_attachments_metadata(msg_data["id"])
+        The first page is requested right away, so that the caller can fall back to a fresh listing.
+        """
+        pages = self._iter_pages(link, None, extra_headers=extra_headers)
+        try:
+            return itertools.chain([next(pages)], pages)
+        except GraphRequestError as e:
+            if e.status_code not in GRAPH_STALE_LINK_STATUS_CODES:
+                raise
+            return None
 
-                    if download_content:
-                        row = self._build_email_row(msg_detail, attachments)
-                        writer.writerow(row)
+    def _iter_delta_pages(self, folder, graph_folder, resume_link=None):
+        """
+        Iterate over response pages of the messages delta query of the folder.
 
-                    if download_attachments:
-                        results.extend(self._download_and_write_attachments(msg_data["id"], msg_detail, attachments))
+        Continues the delta round of an interrupted run from its checkpoint (resume_link), or starts from
+        the deltaLink stored in the component state if available, otherwise runs the initial (full) delta round.
+        Deleted messages are dropped from the pages. The new deltaLink is stored in the state once all pages
+        are consumed.
+        """
+        delta_link = self._get_delta_state().get(folder, {}).get("delta_link")
+        extra_headers = {"Prefer": f"odata.maxpagesize={GRAPH_PAGE_SIZE}"}
+
+        pages = None
+        if resume_link:
+            pages = self._iter_stored_link_pages(resume_link, extra_headers)
+            if pages is None:
+                logging.warning("The checkpoint of the previous run is no longer valid, ignoring it.")
+                self._checkpoints.clear()
+        if pages is None and delta_link:
+            logging.info(f"Fetching messages added or changed since the last run from folder {folder}.")
+            pages = self._iter_stored_link_pages(delta_link, extra_headers)
+            if pages is None:
+                logging.warning(f"Stored delta link for folder {folder} is no longer valid, running full sync.")
+
+        if pages is None:
+            logging.info(f"No valid sync state found for folder {folder}, running full sync.")
+            url = f"{self._mailbox_url}/mailFolders/{graph_folder}/messages/delta"
+            pages = self._iter_pages(url, self._build_delta_query_params(), extra_headers=extra_headers)
+
+        for page in pages:
+            page["value"] = [m for m in page.get("value", []) if "@removed" not in m]
+            yield page
+            delta_link = page.get("@odata.deltaLink", delta_link)
+
+        with self.component.state_lock:
+            self._get_delta_state()[folder] = {"delta_link": delta_link}
+
+    def _skip_own_read_changes(self):
+        """
+        Move the stored deltaLink past the changes made by marking the messages as read in this run, so that
+        the next delta round does not fetch them again.
 
-                    if mark_seen and not msg_detail.get("isRead", False):
-                        self._mark_as_read(msg_data["id"])
+        The changes since the stored deltaLink are requested right away. The new deltaLink is stored only if all
+        of them are messages marked as read by this run, otherwise the next run fetches the changes as usual.
+        """
+        folder_state = self._get_delta_state().get(self._delta_folder) if self._delta_folder else None
+        if not self._marked_read_ids or not folder_state or not folder_state.get("delta_link"):
+            return
+        extra_headers = {"Prefer": f"odata.maxpagesize={GRAPH_PAGE_SIZE}"}
+        delta_link = None
+        try:
+            for page in self._iter_pages(folder_state["delta_link"], None, extra_headers=extra_headers):
+                for message in page.get("value", []):
+                    if "@removed" in message:
+                        continue
+                    if message.get("id") not in self._marked_read_ids or not message.get("isRead", False):
+                        return
+                delta_link = page.get("@odata.deltaLink", delta_link)
+        except UserException as e:
+            logging.warning(f"Changes made by marking the messages as read not skipped in the delta sync: {e}")
+            return
+        if delta_link:
+            with self.component.state_lock:
+                folder_state["delta_link"] = delta_link
+
+    def _checkpoint_query(self):
+        """Parameters that select the messages, a checkpoint is valid only for the same selection."""
+        return [
+            self.config.incremental_fetch,
+            self.config.graph_filter,
+            self.config.graph_search,
+            self.config.date_since,
+        ]
+
+    def _get_resume_link(self, folder):
+        """
+        Return the link of the next page to process left by an interrupted previous run, None if there is none.
 
-                    count += 1
-                    if count % 10 == 0:
-                        logging.info(f"Processing messages {count - 10} - {count}")
-                        logging.info(f"Processed {len(results) - 1} attachments matching the pattern so far.")
+        The checkpoint is used only if the folder and the message selection did not change since.
+        """
+        checkpoint = self._checkpoints.get(folder=folder, query=self._checkpoint_query())
+        if not checkpoint:
+            return None
+        logging.info("Resuming the previous run from its checkpoint.")
+        return checkpoint["next_link"]
 
-                # Follow pagination
-                url = data.get("@odata.nextLink")
+    def _get_delta_state(self):
+        """Return the per-folder delta sync state of the current mailbox, stored in the component state."""
+        from component import KEY_STATE_GRAPH_DELTA
 
-        logging.info(f"Processed {count} messages in total.")
-        logging.info(f"Processed {len(results) - 1} attachments matching the pattern in total.")
-        if count == 0:
-            logging.warning("No messages matched the specified filter")
+        with self.component.state_lock:
+            mailboxes = self.component.state.setdefault(KEY_STATE_GRAPH_DELTA, {})
+            return mailboxes.setdefault(self.config.user_name, {})
 
-        return results
+    def _build_delta_query_params(self):
+        """
+        Build OData query parameters for the initial messages delta request.
+
+        The delta endpoint supports only $select, a receivedDateTime $filter and $orderby=receivedDateTime desc.
+        The page size is controlled by the Prefer: odata.maxpagesize header instead of $top.
+        """
+        query_params = {
+            "$select": "id,subject,from,toRecipients,receivedDateTime,hasAttachments,isRead",
+            "$orderby": "receivedDateTime desc",
+        }
+        date_since_filter = self._build_date_since_filter()
+        if date_since_filter:
+            query_params["$filter"] = date_since_filter
+        return query_params
+
+    def _build_date_since_filter(self):
+        """Build the receivedDateTime $filter expression from date_since, empty string if not set."""
+        date_since_str = self.config.date_since
+        if not date_since_str:
+            return ""
+        since, _ = parse_datetime_interval(date_since_str, "now", strformat="%Y-%m-%dT00:00:00Z")
+        return f"receivedDateTime ge {since}"
 
     def _build_query_params(self):
         """Build OData query parameters for the Graph API messages endpoint."""
@@ -154,10 +429,9 @@ class GraphEmailFetcher:
             if graph_filter:
                 filters.append(graph_filter)
 
-            date_since_str = self.config.date_since
-            if date_since_str:
-                since, _ = parse_datetime_interval(date_since_str, "now", strformat="%Y-%m-%dT00:00:00Z")
-                filters.append(f"receivedDateTime ge {since}")
+            date_since_filter = self._build_date_since_filter()
+            if date_since_filter:
+                filters.append(date_since_filter)
 
             if filters:
                 query_params["$filter"] = " and ".join(filters)
@@ -173,46 +447,141 @@ class GraphEmailFetcher:
 
         return query_params
 
-    def _fetch_message_detail(self, message_id):
-        """Fetch a single message with full body (both text and html) and headers."""
-        url = f"{GRAPH_API_BASE}/me/messages/{message_id}"
-        params = {
-            "$select": (
-                "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,internetMessageHeaders,isRead"
-            ),
-        }
+    def _process_page(self, messages, download_attachments, mark_seen):
+        """Process the messages of a page with batch requests or one message at a time (on the worker pool)."""
+        if self.config.graph_batch_requests:
+            return self._process_messages_batched(messages, download_attachments, mark_seen)
+        return self._map(lambda m: self._process_message(m["id"], download_attachments, mark_seen), messages)
 
-        # First fetch HTML body (default)
-        response_html = self._request("GET", url, params=params)
-        msg_html = response_html.json()
+    def _process_message(self, message_id, download_attachments, mark_seen):
+        """
+        Fetch everything needed for a single message, one request at a time.
 
-        # Then fetch text body
-        response_text = self._request(
-            "GET",
-            url,
-            params=params,
-            extra_headers={"Prefer": 'outlook.body-content-type="text"'},
+        Returns:
+            Tuple of the message detail, attachment metadata and written attachment FileDefinitions
+        """
+        # Fetch full message with headers, body (both text and html) and attachments metadata
+        msg_detail = self._fetch_message_detail(message_id)
+        attachments = msg_detail.pop("attachments", [])
+
+        file_defs = []
+        if download_attachments:
+            file_defs = self._download_and_write_attachments(message_id, msg_detail, attachments)
+
+        if mark_seen and not msg_detail.get("isRead", False):
+            self._mark_as_read(message_id)
+
+        return msg_detail, attachments, file_defs
+
+    def _process_messages_batched(self, messages, download_attachments, mark_seen):
+        """
+        Fetch everything needed for a page of messages using JSON batch requests.
+
+        The per-message calls of `_process_message` are grouped by kind (details, mark as read) and each group
+        is sent as $batch requests. Attachment content is downloaded by single streamed requests.
+
+        Returns:
+            List of tuples of the message detail, attachment metadata and written attachment FileDefinitions,
+            in the order of the input messages
+        """
+        detail_requests = []
+        for msg_data in messages:
+            detail_requests.extend(self._message_detail_requests(msg_data["id"]))
+        detail_responses = self._batch_request(detail_requests)
+        per_message = len(detail_requests) // len(messages) if messages else 1
+        details = [
+            self._merge_message_detail(*detail_responses[i : i + per_message])
+            for i in range(0, len(detail_responses), per_message)
+        ]
+
+        attachments_by_id = {d["id"]: d.pop("attachments", []) for d in details}
+
+        file_defs_by_id = {}
+        if download_attachments:
+            to_download = [
+                (msg_detail, att)
+                for msg_detail in details
+                for att in self._attachments_to_download(msg_detail, attachments_by_id.get(msg_detail["id"], []))
+            ]
+            # Attachment content is streamed by single requests, a batch response holds it whole in memory
+            file_defs = self._map(lambda item: self._download_attachment(item[0]["id"], *item), to_download)
+            for (msg_detail, _), file_def in zip(to_download, file_defs, strict=True):
+                if file_def is not None:
+                    file_defs_by_id.setdefault(msg_detail["id"], []).append(file_def)
+
+        if mark_seen:
+            self._mark_as_read_batched([d["id"] for d in details if not d.get("isRead", False)])
+
+        return [(d, attachments_by_id.get(d["id"], []), file_defs_by_id.get(d["id"], [])) for d in details]
+
+    def _message_detail_requests(self, message_id):
+        """
+        Build the requests for a single message with the body, headers and attachments metadata.
+
+        The HTML body is requested together with the attachments metadata expanded inline.
+        The text body is requested separately unless it is derived locally from the HTML body
+        (graph_local_text_body). The headers, the attachments metadata and the text body are requested only
+        if their output columns are selected (or the attachments are downloaded). The HTML body is always requested,
+        the size column and the pk are computed from it.
+        """
+        url = f"{self._mailbox_url}/messages/{message_id}"
+        properties = [
+            name for name in GRAPH_DETAIL_PROPERTIES if name != "internetMessageHeaders" or "headers" in self._columns
+        ]
+        params = {"$select": ",".join(properties)}
+        with_attachments = (
+            self.config.download_attachments
+            or "number_of_attachments" in self._columns
+            or "attachment_names" in self._columns
         )
-        msg_text = response_text.json()
+        # HTML body (default)
+        detail_requests = [
+            {
+                "method": "GET",
+                "url": url,
+                "params": {**params, "$expand": GRAPH_ATTACHMENTS_EXPAND} if with_attachments else params,
+            },
+        ]
+        if "body" in self._columns and not self.config.graph_local_text_body:
+            # Text body
+            detail_requests.append(
+                {
+                    "method": "GET",
+                    "url": url,
+                    "params": params,
+                    "extra_headers": {"Prefer": 'outlook.body-content-type="text"'},
+                }
+            )
+        return detail_requests
+
+    @staticmethod
+    def _merge_message_detail(msg_html, msg_text=None):
+        """
+        Merge the html and text message responses: keep the HTML response as base, add text body separately.
 
-        # Merge: keep the HTML response as base, add text body separately
-        msg_html["_body_text"] = msg_text.get("body", {}).get("content", "")
+        Without a text response the text body is converted locally from the HTML body.
+        """
+        if msg_text is not None:
+            msg_html["_body_text"] = msg_text.get("body", {}).get("content", "")
+        else:
+            body = msg_html.get("body", {})
+            content = body.get("content", "")
+            # Plain text messages are returned as text even without the Prefer header
+            msg_html["_body_text"] = html_to_text(content) if body.get("contentType") == "html" else content
         return msg_html
 
-    def _fetch_attachments_metadata(self, message_id):
-        """Fetch attachment metadata for a message."""
-        url = f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments"
-        params = {"$select": "id,name,contentType,size,isInline"}
-        response = self._request("GET", url, params=params)
-        return response.json().get("value", [])
+    def _fetch_message_detail(self, message_id):
+        """Fetch a single message with full body (both text and html) and headers."""
+        responses = [self._request(**request).json() for request in self._message_detail_requests(message_id)]
+        return self._merge_message_detail(*responses)
 
-    def _download_and_write_attachments(self, message_id, msg_detail, attachments) -> list[FileDefinition]:
-        """Download and write Graph API attachments, filtered by pattern."""
-        from_addr, to_addrs, _, _, size = self._extract_message_fields(msg_detail)
+    def _filter_attachments(self, attachments):
+        """
+        Return attachments to download: named, not inline, matching the attachment pattern and within the size
+        and content type limits (by the attachment metadata, before any content is requested).
+        """
         pattern = self.config.attachment_pattern
-        email_pk = self._build_email_pk(msg_detail, from_addr, to_addrs, size)
-
-        results = []
+        selected = []
         for att in attachments:
             att_name = att.get("name", "")
             if not att_name:
@@ -223,36 +592,124 @@ class GraphEmailFetcher:
             # Apply pattern filter
             if pattern and not re.fullmatch(pattern, att_name):
                 continue
+            if self._attachment_limits.enabled and self._attachment_limits.is_skipped(
+                att_name, att.get("contentType"), att.get("size", 0)
+            ):
+                continue
+            selected.append(att)
+        return selected
+
+    def _attachments_to_download(self, msg_detail, attachments):
+        """
+        Return the attachments to download: filtered by `_filter_attachments` and, with attachment_dedup,
+        not known from a previous run. Known attachments are recorded in the attachment store right away.
+        """
+        selected = self._filter_attachments(attachments)
+        if self._attachment_store is None:
+            return selected
+        email_pk = self._message_pk(msg_detail)
+        return [att for att in selected if not self._attachment_store.add_known(email_pk, att["id"], att["name"])]
+
+    def _attachment_content_request(self, message_id, attachment_id):
+        """Build the request for the full attachment including its content."""
+        return {"method": "GET", "url": f"{self._mailbox_url}/messages/{message_id}/attachments/{attachment_id}"}
+
+    def _attachment_value_request(self, message_id, attachment_id):
+        """Build the request for the raw content of a file attachment, streamed from the response."""
+        return {
+            "method": "GET",
+            "url": f"{self._mailbox_url}/messages/{message_id}/attachments/{attachment_id}/$value",
+            "stream": True,
+        }
+
+    def _download_and_write_attachments(self, message_id, msg_detail, attachments) -> list[FileDefinition]:
+        """Download and write Graph API attachments, filtered by pattern."""
+        file_defs = [
+            self._download_attachment(message_id, msg_detail, att)
+            for att in self._attachments_to_download(msg_detail, attachments)
+        ]
+        return [file_def for file_def in file_defs if file_def is not None]
 
-            # Fetch full attachment content
-            att_url = f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments/{att['id']}"
-            att_response = self._request("GET", att_url)
-            att_data = att_response.json()
+    def _download_attachment(self, message_id, msg_detail, att) -> FileDefinition | None:
+        """
+        Download a single attachment to an output file.
 
+        File attachments are streamed from the raw $value endpoint in chunks of GRAPH_DOWNLOAD_CHUNK_SIZE,
+        so the memory used does not depend on the attachment size.
+        """
+        if att.get("@odata.type", GRAPH_FILE_ATTACHMENT_TYPE) != GRAPH_FILE_ATTACHMENT_TYPE:
+            # Item and reference attachments have no raw content, keep the content of the attachment resource
+            att_data = self._request(**self._attachment_content_request(message_id, att["id"])).json()
             content_bytes = base64.b64decode(att_data.get("contentBytes", ""))
+            return self._write_attachment(msg_detail, att, [content_bytes])
+
+        with self.component.metrics.timer("attachment_download"):
+            response = self._request(**self._attachment_value_request(message_id, att["id"]))
+            try:
+                chunks = self._count_downloaded(response.iter_content(GRAPH_DOWNLOAD_CHUNK_SIZE))
+                return self._write_attachment(msg_detail, att, chunks)
+            finally:
+                response.close()
+
+    def _count_downloaded(self, chunks):
+        """Pass through the chunks of a streamed response, counting the bytes downloaded in the run metrics."""
+        for chunk in chunks:
+            self.component.metrics.count("bytes_downloaded", len(chunk))
+            yield chunk
+
+    def _write_attachment(self, msg_detail, att, content_chunks) -> FileDefinition | None:
+        """
+        Write attachment content (an iterable of bytes chunks) to an output file prefixed by the email PK.
 
-            normalizer = header_normalizer.get_normalizer(
-                NormalizerStrategy.DEFAULT,
-                permitted_chars=header_normalizer.PERMITTED_CHARS + ".",
-            )
-            file_path = normalizer.normalize_header([f"{email_pk}_{att_name}"])[0]
-            file_def = self.component.create_out_file_definition(
-                file_path,
-                tags=[
-                    f"email_pk: {email_pk}",
-                    f"email_date: {msg_detail.get('receivedDateTime', '')}",
-                ],
-            )
-            with open(file_def.full_path, "wb") as out_file:
-                out_file.write(content_bytes)
-            results.append(file_def)
+        With attachment_dedup the content is written by the attachment store instead, None is returned
+        for content that was already written.
+        """
+        email_pk = self._message_pk(msg_detail)
+        att_name = att["name"]
+        if self._attachment_store is not None:
+            return self._attachment_store.write(email_pk, att["id"], att_name, content_chunks)
+
+        normalizer = header_normalizer.get_normalizer(
+            NormalizerStrategy.DEFAULT,
+            permitted_chars=header_normalizer.PERMITTED_CHARS + ".",
+        )
+        file_path = normalizer.normalize_header([f"{email_pk}_{att_name}"])[0]
+        file_def = self.component.create_out_file_definition(
+            file_path,
+            tags=[
+                f"email_pk: {email_pk}",
+                f"email_date: {msg_detail.get('receivedDateTime', '')}",
+            ],
+        )
+        with open(file_def.full_path, "wb") as out_file:
+            for chunk in content_chunks:
+                out_file.write(chunk)
+        return file_def
 
-        return results
+    def _mark_as_read_request(self, message_id):
+        """Build the request marking a message as read."""
+        return {"method": "PATCH", "url": f"{self._mailbox_url}/messages/{message_id}", "json_body": {"isRead": True}}
 
     def _mark_as_read(self, message_id):
         """Mark a message as read via Graph API."""
-        url = f"{GRAPH_API_BASE}/me/messages/{message_id}"
-        self._request("PATCH", url, json_body={"isRead": True})
+        self._request(**self._mark_as_read_request(message_id))
+        self._marked_read_ids.add(message_id)
+
+    def _mark_as_read_batched(self, message_ids):
+        """
+        Mark messages as read via Graph API, with batched requests.
+
+        Messages not found (moved or deleted since they were fetched) are skipped.
+        """
+        sub_requests = [self._mark_as_read_request(message_id) for message_id in message_ids]
+        responses = self._batch_request(sub_requests, skip_not_found=True)
+        marked_ids = [message_id for message_id, body in zip(message_ids, responses, strict=True) if body is not None]
+        if len(marked_ids) < len(message_ids):
+            logging.warning(
+                f"{len(message_ids) - len(marked_ids)} messages not marked as read, "
+                f"they were moved or deleted since they were fetched."
+            )
+        self._marked_read_ids.update(marked_ids)
 
     def _resolve_graph_folder(self, folder_name):
         """Resolve a folder name to a Graph API well-known folder name or folder ID."""
@@ -263,7 +720,7 @@ class GraphEmailFetcher:
             return GRAPH_WELL_KNOWN_FOLDERS[normalized]
 
         # Try to find the folder by display name
-        url = f"{GRAPH_API_BASE}/me/mailFolders"
+        url = f"{self._mailbox_url}/mailFolders"
         escaped = folder_name.replace("'", "''")
         params = {"$filter": f"displayName eq '{escaped}'"}
         try:
@@ -281,64 +738,181 @@ class GraphEmailFetcher:
         )
 
     def _init_graph_session(self):
-        """Initialize an authenticated requests.Session for Graph API calls."""
-        refresh_token = self.component.get_refresh_token()
-        access_token = self.component.get_access_token(refresh_token=refresh_token, scopes=MS_GRAPH_SCOPE)
+        """
+        Initialize the requests.Session for Graph API calls.
+
+        The access token is acquired once here to fail early, each request then sets the current token.
+        """
+        self.component.get_access_token(scopes=MS_GRAPH_SCOPE)
 
         self._graph_session = requests.Session()
+        # One pooled connection per worker so concurrent requests do not wait for a free connection
+        adapter = HTTPAdapter(pool_maxsize=max(self.config.graph_concurrency, DEFAULT_POOLSIZE))
+        self._graph_session.mount("https://", adapter)
         self._graph_session.headers.update(
             {
-                "Authorization": f"Bearer {access_token}",
                 "Content-Type": "application/json",
             }
         )
 
-    def _request(self, method, url, params=None, json_body=None, extra_headers=None):
-        """Make an authenticated Graph API request with error handling."""
+    def _request(self, method, url, params=None, json_body=None, extra_headers=None, stream=False):
+        """
+        Make an authenticated Graph API request with error handling.
+
+        Throttled requests (HTTP 429, 503 and 504) are retried up to GRAPH_MAX_RETRIES times, honoring
+        the Retry-After header, and lower the number of concurrent requests of the rate limiter.
+        With stream=True the response body is not read, the caller consumes it and closes the response.
+        The current access token is sent with every attempt, a request rejected with HTTP 401 is retried once
+        with a refreshed token.
+        """
         headers = {}
         if extra_headers:
             headers.update(extra_headers)
 
-        try:
-            response = self._graph_session.request(
-                method=method,
-                url=url,
-                params=params,
-                json=json_body,
-                headers=headers,
-            )
-            response.raise_for_status()
-            return response
-        except requests.exceptions.HTTPError as e:
-            status_code = e.response.status_code if e.response is not None else "unknown"
-            error_body = ""
-            if e.response is not None:
-                try:
-                    error_data = e.response.json()
-                    error_body = error_data.get("error", {}).get("message", e.response.text)
-                except (ValueError, KeyError):
-                    error_body = e.response.text
-
-            if status_code == 401:
-                raise UserException(
-                    "Authentication failed with Microsoft Graph API. Please re-authorize the application."
-                ) from e
-            elif status_code == 403:
+        rejected_token = None
+        for attempt in itertools.count():
+            access_token = self.component.get_access_token(scopes=MS_GRAPH_SCOPE, rejected_token=rejected_token)
+            try:
+                with self._rate_limiter, self.component.metrics.timer("graph_request"):
+                    response = self._graph_session.request(
+                        method=method,
+                        url=url,
+                        params=params,
+                        json=json_body,
+                        headers={**headers, "Authorization": f"Bearer {access_token}"},
+                        stream=stream,
+                    )
+                if response.status_code in GRAPH_RETRY_STATUS_CODES and attempt < GRAPH_MAX_RETRIES:
+                    self.component.metrics.count("graph_retries")
+                    response.close()
+                    delay = get_retry_delay(response.headers, attempt)
+                    self._rate_limiter.throttled(delay, reason=f"HTTP {response.status_code}")
+                    continue
+                if response.status_code == 401 and rejected_token is None:
+                    logging.info("The Graph API rejected the access token, refreshing it.")
+                    response.close()
+                    rejected_token = access_token
+                    continue
+                response.raise_for_status()
+                self._rate_limiter.succeeded()
+                if not stream:
+                    self.component.metrics.count("bytes_downloaded", len(response.content))
+                return response
+            except requests.exceptions.HTTPError as e:
+                status_code = e.response.status_code if e.response is not None else "unknown"
+                error_body = ""
+                if e.response is not None:
+                    try:
+                        error_data = e.response.json()
+                        error_body = error_data.get("error", {}).get("message", e.response.text)
+                    except (ValueError, KeyError):
+                        error_body = e.response.text
+
+                raise self._build_request_error(status_code, error_body) from e
+            except requests.exceptions.ConnectionError as e:
                 raise UserException(
-                    "Access denied by Microsoft Graph API. "
-                    "Ensure the application has Mail.ReadWrite permissions. "
-                    f"Details: {error_body}"
+                    "Failed to connect to Microsoft Graph API. Please check your network connection."
                 ) from e
-            elif status_code == 404:
-                raise UserException(f"Resource not found in Microsoft Graph API. Details: {error_body}") from e
-            else:
-                raise UserException(
-                    f"Microsoft Graph API request failed (HTTP {status_code}). Details: {error_body}"
-                ) from e
-        except requests.exceptions.ConnectionError as e:
-            raise UserException(
-                "Failed to connect to Microsoft Graph API. Please check your network connection."
-            ) from e
+
+    def _batch_request(self, sub_requests, skip_not_found=False):
+        """
+        Send requests as Graph API JSON batches of up to GRAPH_BATCH_SIZE sub-requests.
+
+        Throttled sub-requests are retried in a new batch after the longest Retry-After of the batch.
+
+        Args:
+            sub_requests: List of request dicts with the `_request` keyword arguments
+                (method, url, params, json_body, extra_headers)
+            skip_not_found: Return None for sub-requests failing with 404 Not Found instead of raising
+
+        Returns:
+            List of response bodies in the order of the sub-requests. Failed sub-requests raise
+            the same UserException as the corresponding single request would.
+        """
+        chunks = [
+            sub_requests[start : start + GRAPH_BATCH_SIZE] for start in range(0, len(sub_requests), GRAPH_BATCH_SIZE)
+        ]
+
+        results = []
+        for chunk, responses in zip(chunks, self._map(self._send_batch, chunks), strict=True):
+            for i in range(len(chunk)):
+                sub_response = responses.get(str(i), {})
+                status_code = sub_response.get("status", "unknown")
+                body = sub_response.get("body") or {}
+                if status_code == 404 and skip_not_found:
+                    results.append(None)
+                    continue
+                if not isinstance(status_code, int) or status_code >= 400:
+                    error_body = (
+                        body.get("error", {}).get("message", json.dumps(body)) if isinstance(body, dict) else body
+                    )
+                    raise self._build_request_error(status_code, error_body)
+                results.append(body)
+        return results
+
+    def _send_batch(self, chunk):
+        """
+        Send a single $batch request, retrying throttled sub-requests.
+
+        Returns:
+            Dict of sub-responses keyed by the sub-request id (index in the chunk)
+        """
+        responses = {}
+        pending = list(range(len(chunk)))
+        for attempt in itertools.count():
+            batch = {"requests": [self._build_batch_sub_request(str(i), chunk[i]) for i in pending]}
+            response = self._request("POST", f"{GRAPH_API_BASE}/$batch", json_body=batch)
+
+            pending = []
+            delay = 0.0
+            for sub_response in response.json().get("responses", []):
+                status_code = sub_response.get("status")
+                if status_code in GRAPH_RETRY_STATUS_CODES and attempt < GRAPH_MAX_RETRIES:
+                    pending.append(int(sub_response["id"]))
+                    delay = max(delay, get_retry_delay(sub_response.get("headers"), attempt))
+                else:
+                    responses[sub_response["id"]] = sub_response
+
+            if not pending:
+                return responses
+            self._rate_limiter.throttled(delay, reason=f"{len(pending)} throttled batch sub-requests")
+            pending.sort()
+
+    @staticmethod
+    def _build_batch_sub_request(request_id, request):
+        """Convert `_request` keyword arguments into a $batch sub-request with a URL relative to the API root."""
+        url = request["url"][len(GRAPH_API_BASE) :]
+        if request.get("params"):
+            url = f"{url}?{urlencode(request['params'])}"
+
+        sub_request = {"id": request_id, "method": request["method"], "url": url}
+        headers = dict(request.get("extra_headers") or {})
+        if request.get("json_body") is not None:
+            sub_request["body"] = request["json_body"]
+            headers["Content-Type"] = "application/json"
+        if headers:
+            sub_request["headers"] = headers
+        return sub_request
+
+    @staticmethod
+    def _build_request_error(status_code, error_body):
+        """Map a failed Graph API response to a UserException."""
+        if status_code == 401:
+            return UserException("Authentication failed with Microsoft Graph API. Please re-authorize the application.")
+        elif status_code == 403:
+            return UserException(
+                "Access denied by Microsoft Graph API. "
+                "Ensure the application has Mail.ReadWrite permissions. "
+                f"Details: {error_body}"
+            )
+        elif status_code == 404:
+            return GraphRequestError(f"Resource not found in Microsoft Graph API. Details: {error_body}", status_code)
+        elif status_code == 410:
+            return GraphSyncStateExpiredError(f"Microsoft Graph API sync state has expired. Details: {error_body}")
+        else:
+            return GraphRequestError(
+                f"Microsoft Graph API request failed (HTTP {status_code}). Details: {error_body}", status_code
+            )
 
     def _extract_message_fields(self, msg):
         """Extract common fields from a Graph API message dict."""
@@ -354,7 +928,7 @@ class GraphEmailFetcher:
         return from_addr, to_addrs, body_html, body_text, size
 
     def _build_email_row(self, msg, attachments):
-        """Build an email row dict from a Graph API message response, matching IMAP output format."""
+        """Build an email row dict of the output columns from a Graph API message, matching IMAP output format."""
         from_addr, to_addrs, body_html, body_text, size = self._extract_message_fields(msg)
 
         headers_list = msg.get("internetMessageHeaders", [])
@@ -373,7 +947,7 @@ class GraphEmailFetcher:
 
         att_names = [a.get("name", "") for a in attachments if not a.get("isInline", False)]
 
-        return {
+        row = {
             "pk": self._build_email_pk(msg, from_addr, to_addrs, size),
             "uid": msg.get("id", ""),
             "mail_box": self.config.user_name,
@@ -383,11 +957,17 @@ class GraphEmailFetcher:
             "subject": msg.get("subject", ""),
             "body": body_text,
             "body_html": body_html,
-            "headers": json.dumps(headers_dict),
+            "headers": self._header_filter.serialize(headers_dict),
             "number_of_attachments": len(att_names),
             "attachment_names": att_names,
             "size": size,
         }
+        return {column: row[column] for column in self._columns}
+
+    def _message_pk(self, msg):
+        """Build the primary key of a Graph API message."""
+        from_addr, to_addrs, _, _, size = self._extract_message_fields(msg)
+        return self._build_email_pk(msg, from_addr, to_addrs, size)
 
     def _build_email_pk(self, msg, from_addr, to_addrs, size):
         """Build a primary key hash from a Graph API message, matching IMAP PK logic."""
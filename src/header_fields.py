@@ -0,0 +1,48 @@
+"""
+Allow-list of the message header fields written to the headers column (header_fields).
+"""
+
+import fnmatch
+import json
+import re
+
+# Header field names that can be listed in an IMAP HEADER.FIELDS section as they are
+_FIELD_NAME_RE = re.compile(r"[A-Za-z0-9!#$&'+\-.^_`|~]+")
+
+
+class HeaderFieldFilter:
+    """
+    Selects the header fields by case-insensitive glob patterns (e.g. `subject`, `x-ms-*`), all if there are none.
+
+    The result of the patterns is cached per field name, the same few names repeat in every message.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self._matches: dict[str, bool] = {}
+
+    @property
+    def field_names(self) -> list[str] | None:
+        """
+        Return the field names to fetch from the server, None if the whole header is needed:
+        there is no allow-list or a pattern is not a plain field name (e.g. a glob).
+        """
+        if not self.patterns or not all(_FIELD_NAME_RE.fullmatch(pattern) for pattern in self.patterns):
+            return None
+        return self.patterns
+
+    def matches(self, name: str) -> bool:
+        """Check whether a header field is written to the output."""
+        if not self.patterns:
+            return True
+        matches = self._matches.get(name)
+        if matches is None:
+            lower_name = name.lower()
+            matches = self._matches[name] = any(fnmatch.fnmatchcase(lower_name, p) for p in self.patterns)
+        return matches
+
+    def serialize(self, headers: dict) -> str:
+        """Serialize the allowed fields of a header dict to the JSON of the headers column."""
+        if self.patterns:
+            headers = {name: value for name, value in headers.items() if self.matches(name)}
+        return json.dumps(headers)
@@ -0,0 +1,49 @@
+"""
+Fast HTML to plain text conversion for email bodies.
+"""
+
+import html
+import re
+
+# Elements whose content is never rendered as text
+_INVISIBLE_ELEMENTS_RE = re.compile(r"<(head|script|style|title)\b[^>]*>.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+# Tags that end a line of text
+_LINE_BREAK_RE = re.compile(
+    r"<br\s*/?>|</?(?:p|div|tr|li|ul|ol|table|blockquote|pre|h[1-6]|hr)\b[^>]*>",
+    re.IGNORECASE,
+)
+_CELL_END_RE = re.compile(r"</t[dh]\s*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_HORIZONTAL_SPACE_RE = re.compile(r"[ \t\f\v\xa0]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def html_to_text(html_body: str) -> str:
+    """
+    Convert an HTML email body to plain text.
+
+    Block level elements and line breaks are converted to new lines, all other tags are dropped
+    and HTML entities are decoded. Runs of whitespace are collapsed.
+
+    Args:
+        html_body: HTML document or fragment
+
+    Returns:
+        Plain text representation of the body
+    """
+    if not html_body:
+        return ""
+
+    text = _COMMENT_RE.sub("", html_body)
+    text = _INVISIBLE_ELEMENTS_RE.sub("", text)
+    # Source line breaks are not significant in HTML
+    text = text.replace("\r", "").replace("\n", " ")
+    text = _LINE_BREAK_RE.sub("\n", text)
+    text = _CELL_END_RE.sub(" ", text)
+    text = _TAG_RE.sub("", text)
+    text = html.unescape(text)
+
+    lines = (_HORIZONTAL_SPACE_RE.sub(" ", line).strip() for line in text.split("\n"))
+    text = "\n".join(lines)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
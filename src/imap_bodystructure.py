@@ -0,0 +1,246 @@
+"""
+IMAP FETCH response parsing and assembly of messages from selectively downloaded body parts.
+
+The message is assembled as an `email.message.Message` tree that mirrors the BODYSTRUCTURE of the
+message, so that the text, HTML and attachments of the resulting `MailMessage` are derived by
+imap_tools exactly as for a fully downloaded message. Parts that were not downloaded have an empty payload.
+"""
+
+import email
+from email.message import Message
+from functools import cached_property
+from typing import NamedTuple
+
+from imap_tools import MailMessage  # type: ignore[attr-defined]
+
+_WHITESPACE = b" \t\r\n"
+_ATOM_END = b" \t\r\n()"
+
+
+class FetchResponseParseError(ValueError):
+    """Raised when the FETCH response does not follow the IMAP syntax."""
+
+
+class BodyPart(NamedTuple):
+    """Non-multipart part of a message tree built by `build_message_tree`."""
+
+    number: str
+    message: Message
+    size: int
+
+
+def parse_fetch_response(data) -> list[dict]:
+    """
+    Parse the data of an IMAP FETCH response, as returned by imaplib.
+
+    Args:
+        data: List of response lines, literals are passed by imaplib as (line, literal) tuples
+
+    Returns:
+        One dict per message response, mapping the upper-cased data item names (e.g. "UID", "BODY[HEADER]")
+        to their values. Lists are returned as lists, strings and atoms as bytes and NIL as None.
+    """
+    raw = b"".join(item[0] + b"\r\n" + item[1] if isinstance(item, tuple) else item for item in data if item)
+
+    responses = []
+    pos = _skip_whitespace(raw, 0)
+    while pos < len(raw):
+        _, pos = _parse_value(raw, pos)  # message sequence number
+        items, pos = _parse_value(raw, _skip_whitespace(raw, pos))
+        if not isinstance(items, list) or len(items) % 2:
+            raise FetchResponseParseError(f"Unexpected FETCH response: {raw[:200]!r}")
+        responses.append({items[i].decode().upper(): items[i + 1] for i in range(0, len(items), 2)})
+        pos = _skip_whitespace(raw, pos)
+    return responses
+
+
+def _skip_whitespace(raw, pos):
+    while pos < len(raw) and raw[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _parse_value(raw, pos):
+    """Parse a single value (list, quoted string, literal, NIL or atom) starting at the given position."""
+    if pos >= len(raw):
+        raise FetchResponseParseError("Unexpected end of the FETCH response")
+    char = raw[pos : pos + 1]
+
+    if char == b"(":
+        values = []
+        pos = _skip_whitespace(raw, pos + 1)
+        while raw[pos : pos + 1] != b")":
+            if pos >= len(raw):
+                raise FetchResponseParseError("Unterminated list in the FETCH response")
+            value, pos = _parse_value(raw, pos)
+            values.append(value)
+            pos = _skip_whitespace(raw, pos)
+        return values, pos + 1
+
+    if char == b'"':
+        value = bytearray()
+        pos += 1
+        while raw[pos : pos + 1] != b'"':
+            if pos >= len(raw):
+                raise FetchResponseParseError("Unterminated string in the FETCH response")
+            if raw[pos : pos + 1] == b"\\":
+                pos += 1
+            value += raw[pos : pos + 1]
+            pos += 1
+        return bytes(value), pos + 1
+
+    if char == b"{":
+        end = raw.index(b"}", pos)
+        size = int(raw[pos + 1 : end])
+        start = end + 1
+        if raw[start : start + 2] == b"\r\n":
+            start += 2
+        return raw[start : start + size], start + size
+
+    # Atom, section specifiers like BODY[HEADER.FIELDS (FROM)] may contain spaces and parentheses
+    start = pos
+    depth = 0
+    while pos < len(raw) and (depth or raw[pos] not in _ATOM_END):
+        if raw[pos : pos + 1] == b"[":
+            depth += 1
+        elif raw[pos : pos + 1] == b"]":
+            depth -= 1
+        pos += 1
+    atom = raw[start:pos]
+    return (None if atom.upper() == b"NIL" else atom), pos
+
+
+def build_message_tree(header: bytes, body_structure: list) -> tuple[Message, list[BodyPart]]:
+    """
+    Build an email message tree from the message header and its BODYSTRUCTURE.
+
+    Args:
+        header: Raw header of the message (BODY[HEADER])
+        body_structure: Parsed BODYSTRUCTURE of the message
+
+    Returns:
+        Tuple of the root message and a list of all non-multipart parts with their part number and
+        transfer encoded size, in the order of `Message.walk()`. Payloads are set with `set_part_payload`.
+    """
+    root = email.message_from_bytes(header)
+    parts: list[BodyPart] = []
+    if _is_multipart(body_structure):
+        root.set_payload(None)
+        for number, child in enumerate(_multipart_children(body_structure), start=1):
+            root.attach(_build_part(child, str(number), parts))
+    else:
+        root.set_payload("")
+        parts.append(BodyPart("1", root, _size(body_structure)))
+    return root, parts
+
+
+def set_part_payload(part: Message, content: bytes):
+    """Set the downloaded (still transfer encoded) content of a part built by `build_message_tree`."""
+    if part.get_content_type() == "message/rfc822":
+        part.set_payload([email.message_from_bytes(content)])
+    else:
+        # Same representation as produced by the email parser for raw bytes
+        part.set_payload(content.decode("ascii", "surrogateescape"))
+
+
+def _is_multipart(body_structure):
+    return bool(body_structure) and isinstance(body_structure[0], list)
+
+
+def _multipart_children(body_structure):
+    return [child for child in body_structure if isinstance(child, list)]
+
+
+def _build_part(body_structure, number, parts):
+    """Build the part (and its subparts) described by the BODYSTRUCTURE with the given part number."""
+    part = Message()
+
+    if _is_multipart(body_structure):
+        children = _multipart_children(body_structure)
+        subtype, *extension = body_structure[len(children) :]
+        part["Content-Type"] = _format_header(f"multipart/{_text(subtype).lower()}", extension[:1])
+        part.set_payload(None)
+        for child_number, child in enumerate(children, start=1):
+            part.attach(_build_part(child, f"{number}.{child_number}", parts))
+        return part
+
+    main_type, subtype, params, content_id, _, encoding = (body_structure + [None] * 6)[:6]
+    content_type = f"{_text(main_type)}/{_text(subtype)}".lower()
+    part["Content-Type"] = _format_header(content_type, [params])
+    if content_id:
+        part["Content-ID"] = _text(content_id)
+    if encoding:
+        part["Content-Transfer-Encoding"] = _text(encoding)
+
+    # Extension data follows the fields specific to the content type
+    if content_type == "message/rfc822":
+        disposition_index = 11
+    elif content_type.startswith("text/"):
+        disposition_index = 9
+    else:
+        disposition_index = 8
+    disposition = body_structure[disposition_index] if len(body_structure) > disposition_index else None
+    if isinstance(disposition, list) and disposition and disposition[0]:
+        part["Content-Disposition"] = _format_header(_text(disposition[0]).lower(), disposition[1:2])
+
+    parts.append(BodyPart(number, part, _size(body_structure)))
+
+    if content_type == "message/rfc822" and len(body_structure) > 8 and isinstance(body_structure[8], list):
+        # Parts of an attached message are numbered relative to the attachment
+        nested = body_structure[8]
+        nested_number = number if _is_multipart(nested) else f"{number}.1"
+        part.set_payload([_build_part(nested, nested_number, parts)])
+    else:
+        part.set_payload("")
+    return part
+
+
+def _size(body_structure):
+    try:
+        return int(body_structure[6])
+    except (IndexError, TypeError, ValueError):
+        return 0
+
+
+def _format_header(value, params):
+    """Format a header value with the parameters of a BODYSTRUCTURE parameter list."""
+    params = params[0] if params else None
+    if isinstance(params, list):
+        for key, param_value in zip(params[::2], params[1::2], strict=False):
+            escaped = _text(param_value).replace("\\", "\\\\").replace('"', '\\"')
+            value += f'; {_text(key).lower()}="{escaped}"'
+    return value
+
+
+def _text(value):
+    if value is None:
+        return ""
+    # Same representation as produced by the email parser for raw 8 bit headers
+    return value.decode("ascii", "surrogateescape") if isinstance(value, bytes) else str(value)
+
+
+class PartialMailMessage(MailMessage):
+    """
+    MailMessage assembled from the header, BODYSTRUCTURE and selectively downloaded parts of a message.
+
+    All attributes are derived by imap_tools from the message tree. The size is the RFC822.SIZE reported by the server.
+    Content of attachments downloaded in slices is not part of the tree, it is kept in `attachment_spools`
+    (AttachmentSpool by part) until the message is closed. Attachment parts left out by the size and content type
+    limits are listed in `skipped_parts`.
+    """
+
+    def __init__(self, uid, size, obj: Message, attachment_spools=None):
+        super().__init__([(f"UID {uid} RFC822.SIZE {size}".encode(), b"")])
+        self.obj = obj
+        self.attachment_spools = attachment_spools or {}
+        self.skipped_parts: list[Message] = []
+
+    def close(self):
+        """Release the spooled attachment content."""
+        for spool in self.attachment_spools.values():
+            spool.close()
+        self.attachment_spools = {}
+
+    @cached_property
+    def size(self) -> int:
+        return self.size_rfc822
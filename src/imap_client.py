@@ -1,42 +1,121 @@
-import csv
+import collections
 import hashlib
 import imaplib
-import json
+import itertools
 import logging
 import re
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
-from imap_tools import MailBox, MailboxFolderSelectError, MailboxLoginError, MailMessage  # type: ignore[attr-defined]
+from imap_tools import (  # type: ignore[attr-defined]
+    MailAttachment,
+    MailBox,
+    MailboxFolderSelectError,
+    MailboxLoginError,
+    MailMessage,
+)
+from imap_tools.errors import MailboxFetchError, MailboxFlagError
+from imap_tools.utils import check_command_status
 from keboola.component.dao import FileDefinition
 from keboola.component.exceptions import UserException
 from keboola.utils import header_normalizer
 from keboola.utils.date import parse_datetime_interval
 from keboola.utils.header_normalizer import NormalizerStrategy
 
+from attachment_limits import AttachmentLimits
+from attachment_spool import AttachmentSpool, MemoryBudget, TransferDecoder
+from checkpoints import CheckpointStore
+from header_fields import HeaderFieldFilter
+from imap_bodystructure import PartialMailMessage, build_message_tree, parse_fetch_response, set_part_payload
+from output_writer import open_output_writer
+
 if TYPE_CHECKING:
     from configuration import Configuration
 
 # Microsoft OAuth scope for IMAP
 MS_IMAP_SCOPE = ["https://outlook.office.com/IMAP.AccessAsUser.All"]
 
+# Number of consecutive UIDs fetched by a single worker when using parallel connections
+IMAP_PARALLEL_CHUNK_SIZE = 25
+
+# Number of messages whose structure and header are fetched by a single command in the selective fetch mode
+IMAP_STRUCTURE_CHUNK_SIZE = 50
+
+# Number of message sizes requested by a single command when planning the bulk fetch chunks
+IMAP_SIZE_CHUNK_SIZE = 1000
+
+# Maximum number of UID ranges in a single command, keeps the command line length reasonable
+IMAP_UID_SET_MAX_RANGES = 500
+
+# Header fields of the row columns and the MIME fields of the message structure, fetched instead of
+# the whole header when the headers column is not selected
+IMAP_ROW_HEADER_FIELDS = (
+    "DATE",
+    "FROM",
+    "TO",
+    "SUBJECT",
+    "MIME-VERSION",
+    "CONTENT-TYPE",
+    "CONTENT-TRANSFER-ENCODING",
+    "CONTENT-DISPOSITION",
+)
+
+# Bounds of the slice size in which attachments are downloaded with a memory budget (bytes)
+IMAP_STREAM_SLICE_MIN_SIZE = 64 * 1024
+IMAP_STREAM_SLICE_MAX_SIZE = 8 * 1024 * 1024
+
 
 class ImapEmailFetcher:
     """Handles IMAP email fetching with OAuth or username/password authentication."""
 
-    def __init__(self, component, config: "Configuration"):
+    def __init__(self, component, config: "Configuration", attachment_store=None):
         """
         Initialize IMAP email fetcher.
 
         Args:
             component: Component instance (for access to create_out_file_definition, OAuth methods, etc.)
             config: Configuration object with all parameters
+            attachment_store: AttachmentStore writing deduplicated attachments (attachment_dedup)
         """
         self.component = component
         self.config = config
+        self._attachment_store = attachment_store
+        # Columns of the emails table, only the data needed for them is fetched
+        self._columns = config.output_columns
+        self._header_filter = HeaderFieldFilter(config.header_fields)
+        self._attachment_limits = AttachmentLimits(
+            config.attachment_max_size_mb,
+            config.attachment_content_types,
+            config.attachment_excluded_content_types,
+            metrics=component.metrics,
+        )
         self._imap_client = None
-
-    def fetch(self, output_table, download_content, download_attachments, mark_seen):
+        # Access tokens the OAuth connections logged in with, to log them in again once the token is refreshed
+        self._login_tokens = {}
+        # Messages to flag \Seen once the output is written (mark_seen_after_run)
+        self._processed_uids: list[str] = []
+        # Output table and attachment files written by `fetch`, also when it is interrupted
+        self.results = []
+        # Resume position of the extraction (checkpoint_interval)
+        self._checkpoints = CheckpointStore(component, config.user_name)
+        # Whether `fetch` completed
+        self.completed = False
+
+        # Half of the memory budget holds the downloaded attachments, the rest the slices being downloaded
+        budget = config.imap_memory_budget_mb * 1024 * 1024
+        self._memory_budget = MemoryBudget(budget // 2)
+        self._stream_slice_size = min(
+            IMAP_STREAM_SLICE_MAX_SIZE, max(IMAP_STREAM_SLICE_MIN_SIZE, budget // (4 * config.imap_connections))
+        )
+
+    @property
+    def checkpointed(self) -> bool:
+        """Whether a checkpoint was saved during this run (checkpoint_interval)."""
+        return self._checkpoints.saved
+
+    def fetch(self, output_table, download_content, download_attachments, mark_seen, writer=None):
         """
         Fetch emails via IMAP and write to output table.
 
@@ -45,12 +124,12 @@ class ImapEmailFetcher:
             download_content: Whether to download email content
             download_attachments: Whether to download attachments
             mark_seen: Whether to mark emails as read
+            writer: Writer of the output table rows shared with other mailboxes, the output table is written
+                by this fetcher if not set
 
         Returns:
             List of FileDefinition objects (output_table + attachments)
         """
-        from component import RESULT_COLUMNS
-
         logging.info("Logging in via IMAP..")
         self._init_imap_client()
 
@@ -63,29 +142,73 @@ class ImapEmailFetcher:
         if self.config.date_since:
             query = f"{query} {since_search}"
 
-        logging.info(f"Getting messages with query {query} from folder {self._imap_client.folder.get()}")
-        msgs = self._imap_client.fetch(criteria=query, mark_seen=mark_seen)
+        folder = self._imap_client.folder.get()
+        last_uid = 0
+        uid_validity = None
+        if self.config.incremental_fetch:
+            uid_validity, last_uid = self._get_sync_start(folder)
+            if last_uid:
+                query = f"{query} UID {last_uid + 1}:*"
+
+        resume_uid = 0
+        if self.config.checkpoint_interval:
+            if uid_validity is None:
+                uid_validity = self._imap_client.folder.status(folder, ["UIDVALIDITY"])["UIDVALIDITY"]
+            resume_uid = self._get_resume_uid(folder, uid_validity)
+
+        logging.info(f"Getting messages with query {query} from folder {folder}")
 
         count = -1
-        results = [output_table]
+        max_uid = max(last_uid, resume_uid)
+        results = self.results = [output_table]
+        deferred_mark_seen = mark_seen and self.config.mark_seen_after_run
+        if deferred_mark_seen:
+            mark_seen = False
         try:
-            with open(output_table.full_path, "w+", encoding="utf-8") as output:
-                writer = csv.DictWriter(output, fieldnames=RESULT_COLUMNS, dialect="kbc")
-                writer.writeheader()
+            with self.component.metrics.timer("imap_search"):
+                uids = self._imap_client.uids(criteria=query)
+            # "UID n:*" always matches the newest message, even if its UID is lower than n
+            # Messages up to the checkpoint were processed by the interrupted previous run
+            uids = [uid for uid in uids if int(uid) > max(last_uid, resume_uid)]
+
+            with open_output_writer(
+                output_table, writer, self.config.output_slice_size_mb, columns=self._columns
+            ) as writer:
+                for count, msg in enumerate(self._iter_messages(uids, mark_seen)):
+                    self.component.metrics.count("messages")
+                    max_uid = max(max_uid, int(msg.uid))
+                    if deferred_mark_seen:
+                        self._processed_uids.append(msg.uid)
 
-                for count, msg in enumerate(msgs):
                     if download_content:
                         self._write_message_content(writer, msg)
 
                     if download_attachments:
-                        results.extend(self._write_message_attachments(msg))
+                        with self.component.metrics.timer("attachment_write"):
+                            results.extend(self._write_message_attachments(msg))
+
+                    if isinstance(msg, PartialMailMessage):
+                        msg.close()
+
+                    # Messages are processed in UID order, all messages up to this one are in the output
+                    if self.config.checkpoint_interval and (count + 1) % self.config.checkpoint_interval == 0:
+                        self._checkpoints.save(
+                            {
+                                "folder": folder,
+                                "query": self.config.query,
+                                "uid_validity": uid_validity,
+                                "last_uid": max_uid,
+                            }
+                        )
 
                     if count % 10 == 0:
                         logging.info(f"Processing messages {count + 1} - {count + 10}")
                         logging.info(f"Processed {len(results) - 1} attachments matching the pattern so far.")
         except imaplib.IMAP4.error as e:
             if "SEARCH command error" in str(e):
-                raise UserException(f'Invalid search query, please check the syntax: "{query}"')
+                raise UserException(f'Invalid search query, please check the syntax: "{query}"') from e
+            # Dropped connections (IMAP4.abort) and failed commands interrupt the run, nothing is marked as done
+            raise
         except UnicodeError as e:
             raise UserException(
                 "UnicodeError Encountered\n\n"
@@ -100,24 +223,407 @@ class ImapEmailFetcher:
 
         logging.info(f"Processed {count + 1} messages in total.")
         logging.info(f"Processed {len(results) - 1} attachments matching the pattern in total.")
+        self._attachment_limits.log_summary()
         if count == -1:
             logging.warning("No messages matched the specified filter")
 
+        if self.config.incremental_fetch:
+            self._save_sync_state(folder, uid_validity, max_uid)
+        if self.config.checkpoint_interval:
+            self._checkpoints.clear()
+        self.completed = True
+
         return results
 
-    def _init_imap_client(self):
-        """Initialize the IMAP client - dispatches to OAuth or username/password."""
+    def mark_processed_as_seen(self):
+        """
+        Flag the messages processed by `fetch` as \\Seen with UID STORE commands on compact UID sets.
+
+        Used with mark_seen_after_run, to be called once the output is fully written.
+        """
+        if not self._processed_uids:
+            return
+        logging.info(f"Marking {len(self._processed_uids)} processed messages as seen.")
+        for uid_set in self._build_uid_sets(self._processed_uids):
+            self._uid_command(self._imap_client, "STORE", uid_set, "+FLAGS", "(\\Seen)")
+        self._processed_uids = []
+
+    @staticmethod
+    def _build_uid_sets(uids):
+        """Compress UIDs into IMAP UID sets of ranges (e.g. "1:5,7"), at most IMAP_UID_SET_MAX_RANGES ranges each."""
+        ranges = []
+        for uid in sorted(set(map(int, uids))):
+            if ranges and ranges[-1][1] == uid - 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        items = [str(start) if start == end else f"{start}:{end}" for start, end in ranges]
+        return [",".join(items[i : i + IMAP_UID_SET_MAX_RANGES]) for i in range(0, len(items), IMAP_UID_SET_MAX_RANGES)]
+
+    def _iter_messages(self, uids, mark_seen):
+        """
+        Fetch messages with the given UIDs.
+
+        With imap_connections > 1 the UID list is split into ranges of IMAP_PARALLEL_CHUNK_SIZE (or
+        imap_fetch_chunk_size, if larger) consecutive UIDs that are fetched over parallel connections,
+        one per worker. Messages are still yielded in UID order.
+        """
+        connections = self.config.imap_connections
+        range_size = max(IMAP_PARALLEL_CHUNK_SIZE, self.config.imap_fetch_chunk_size)
+        if connections == 1 or len(uids) <= range_size:
+            yield from self._fetch_uids(self._imap_client, uids, mark_seen)
+            return
+
+        chunks = [uids[i : i + range_size] for i in range(0, len(uids), range_size)]
+        logging.info(f"Fetching {len(uids)} messages in {len(chunks)} UID ranges over {connections} connections.")
+
+        worker = threading.local()
+        clients = []
+        clients_lock = threading.Lock()
+
+        def fetch_chunk(chunk):
+            if getattr(worker, "client", None) is None:
+                worker.client = self._connect()
+                with clients_lock:
+                    clients.append(worker.client)
+            return list(self._fetch_uids(worker.client, chunk, mark_seen))
+
+        executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="imap")
+        try:
+            # Keep only a bounded number of fetched chunks in memory while the rows are being written
+            pending = collections.deque()
+            chunks_iter = iter(chunks)
+            for chunk in itertools.islice(chunks_iter, connections * 2):
+                pending.append(executor.submit(fetch_chunk, chunk))
+            while pending:
+                messages = pending.popleft().result()
+                next_chunk = next(chunks_iter, None)
+                if next_chunk is not None:
+                    pending.append(executor.submit(fetch_chunk, next_chunk))
+                yield from messages
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for client in clients:
+                client.logout()
+
+    def _fetch_uids(self, client, uids, mark_seen):
+        """Fetch messages with the given UIDs over the client connection."""
+        if not uids:
+            # imap_tools searches the whole folder when the UID list is empty
+            return iter(())
+        if self.config.imap_selective_fetch:
+            return self._fetch_uids_selective(client, uids, mark_seen)
+        return self._fetch_uids_bulk(client, uids, mark_seen)
+
+    def _header_section(self):
+        """
+        Return the BODY.PEEK section of the header fetched with the BODYSTRUCTURE: the fields of the row columns
+        and of the header_fields allow-list, the whole header for the headers column without a plain allow-list.
+        """
+        fields = IMAP_ROW_HEADER_FIELDS
+        if "headers" in self._columns:
+            allowed_fields = self._header_filter.field_names
+            if allowed_fields is None:
+                return "HEADER"
+            fields = dict.fromkeys([*IMAP_ROW_HEADER_FIELDS, *(name.upper() for name in allowed_fields)])
+        return f"HEADER.FIELDS ({' '.join(fields)})"
+
+    def _fetch_uids_bulk(self, client, uids, mark_seen):
+        """
+        Fetch whole messages with the given UIDs, up to imap_fetch_chunk_size messages per FETCH command.
+
+        A chunk also holds at most imap_fetch_chunk_max_mb of raw message data (a larger message is fetched alone),
+        so that only a bounded amount of data is kept in memory while the messages of the chunk are processed.
+        """
+        # Same data items as MailBox.fetch, BODY[] sets the \Seen flag as a side effect
+        message_parts = f"(BODY{'' if mark_seen else '.PEEK'}[] UID FLAGS RFC822.SIZE)"
+        for chunk in self._plan_fetch_chunks(client, uids):
+            result = self._uid_command(client, "FETCH", ",".join(chunk), message_parts)
+            for fetch_item in self._split_fetch_items(result[1]):
+                with self.component.metrics.timer("mime_parse"):
+                    msg = MailMessage(fetch_item)
+                yield msg
+
+    def _plan_fetch_chunks(self, client, uids):
+        """Split the UIDs into chunks limited by the number of messages and their total size."""
+        chunk_size = self.config.imap_fetch_chunk_size
+        if chunk_size == 1:
+            return [[uid] for uid in uids]
+
+        max_bytes = self.config.imap_fetch_chunk_max_mb * 1024 * 1024
+        sizes = self._fetch_sizes(client, uids)
+        chunks = []
+        chunk: list[str] = []
+        chunk_bytes = 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if chunk and (len(chunk) >= chunk_size or chunk_bytes + size > max_bytes):
+                chunks.append(chunk)
+                chunk, chunk_bytes = [], 0
+            chunk.append(uid)
+            chunk_bytes += size
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _fetch_sizes(self, client, uids):
+        """Return the RFC822.SIZE of the messages with the given UIDs."""
+        sizes = {}
+        for i in range(0, len(uids), IMAP_SIZE_CHUNK_SIZE):
+            result = self._uid_command(
+                client, "FETCH", ",".join(uids[i : i + IMAP_SIZE_CHUNK_SIZE]), "(UID RFC822.SIZE)"
+            )
+            for item in parse_fetch_response(result[1]):
+                if "UID" in item and "RFC822.SIZE" in item:
+                    sizes[item["UID"].decode()] = int(item["RFC822.SIZE"])
+        return sizes
+
+    def _uid_command(self, client, command, *args):
+        """
+        Issue a UID FETCH or STORE command over the client connection and check its status.
+
+        The duration of the command and the size of the response are recorded in the run metrics.
+        """
         if self.component.use_oauth_login:
-            self._init_client_from_oauth()
-        else:
-            self._init_client_from_username_and_pass()
+            self._renew_login(client)
+        with self.component.metrics.timer(f"imap_{command.lower()}"):
+            result = client.client.uid(command, *args)
+        check_command_status(result, MailboxFlagError if command == "STORE" else MailboxFetchError)
+        response_size = sum(
+            len(line[0]) + len(line[1]) if isinstance(line, tuple) else len(line or b"") for line in result[1]
+        )
+        self.component.metrics.count("bytes_downloaded", response_size)
+        return result
+
+    def _renew_login(self, client):
+        """
+        Log the OAuth connection in again once the access token it logged in with was refreshed.
+
+        Tokens are refreshed ahead of their expiry, so the connection is replaced before the server closes it.
+        The MailBox object is kept, only its underlying imaplib connection is swapped for a new one.
+        """
+        login_token = self._login_tokens.get(client)
+        if login_token is None or self.component.get_access_token(scopes=MS_IMAP_SCOPE) == login_token:
+            return
+        logging.info(f"Access token refreshed, logging the IMAP connection of '{self.config.user_name}' in again.")
+        renewed = self._connect()
+        stale_connection = client.client
+        client.client = renewed.client
+        self._login_tokens[client] = self._login_tokens.pop(renewed)
+        try:
+            stale_connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            # The server may have closed the connection already
+            pass
+
+    @staticmethod
+    def _split_fetch_items(data):
+        """Group the lines of a FETCH response by message, in the form expected by MailMessage."""
+        fetch_items = []
+        for line in data:
+            if isinstance(line, tuple):
+                fetch_items.append([line])
+            elif line is not None and fetch_items:
+                fetch_items[-1].append(line)
+        return fetch_items
+
+    def _fetch_uids_selective(self, client, uids, mark_seen):
+        """
+        Fetch messages with the given UIDs, downloading only the body parts that are written to the output.
+
+        The BODYSTRUCTURE and the header of the messages are fetched first (only the header fields of the row
+        without the headers column), then a single BODY.PEEK command per message downloads the text and HTML
+        bodies of the selected columns (with download_content) and the attachments matching the attachment
+        pattern (with download_attachments). Used also when neither bodies nor attachments are written.
+
+        With a memory budget (imap_memory_budget_mb) the attachments are instead downloaded in slices,
+        decoded incrementally and spooled in memory or on disk, see `_download_attachment_part`.
+        """
+        header_section = self._header_section()
+        for i in range(0, len(uids), IMAP_STRUCTURE_CHUNK_SIZE):
+            chunk = uids[i : i + IMAP_STRUCTURE_CHUNK_SIZE]
+            result = self._uid_command(
+                client, "FETCH", ",".join(chunk), f"(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[{header_section}])"
+            )
+
+            for item in parse_fetch_response(result[1]):
+                if "BODYSTRUCTURE" not in item:
+                    # Unsolicited FETCH responses, e.g. flag changes of other messages
+                    continue
+                uid = item["UID"].decode()
+                with self.component.metrics.timer("mime_parse"):
+                    # Servers may echo the header field list of the section differently
+                    header = next((v for k, v in item.items() if k.startswith("BODY[HEADER")), None)
+                    root, parts = build_message_tree(header or b"", item["BODYSTRUCTURE"])
+                msg = PartialMailMessage(uid, int(item["RFC822.SIZE"]), root)
+
+                known = self._known_attachment_parts(msg)
+                selected = [part for part in parts if part.message not in known and self._is_part_needed(part.message)]
+                if self._attachment_limits.enabled:
+                    msg.skipped_parts = [part.message for part in selected if self._is_part_skipped(part)]
+                    selected = [part for part in selected if part.message not in msg.skipped_parts]
+                spooled = []
+                if self.config.imap_memory_budget_mb:
+                    spooled = [part for part in selected if not self._is_body_part(part.message)]
+                    selected = [part for part in selected if self._is_body_part(part.message)]
+
+                if selected:
+                    sections = " ".join(f"BODY.PEEK[{part.number}]" for part in selected)
+                    result = self._uid_command(client, "FETCH", uid, f"({sections})")
+                    for part_item in parse_fetch_response(result[1]):
+                        for part in selected:
+                            content = part_item.get(f"BODY[{part.number}]")
+                            if content is not None:
+                                set_part_payload(part.message, content)
+
+                try:
+                    for part in spooled:
+                        msg.attachment_spools[part.message] = self._download_attachment_part(client, uid, part)
+                except BaseException:
+                    msg.close()
+                    raise
+                yield msg
+
+            if mark_seen:
+                self._uid_command(client, "STORE", ",".join(chunk), "+FLAGS", "(\\Seen)")
+
+    def _download_attachment_part(self, client, uid, part) -> AttachmentSpool:
+        """
+        Download a message part in slices of at most `_stream_slice_size` bytes (BODY.PEEK[part]<offset.size>).
+
+        Each slice is decoded right away and written to a spool that stays in memory while the shared memory
+        budget allows it and is spilled to a temporary file otherwise.
+        """
+        spool = AttachmentSpool(self._memory_budget, part.size)
+        decoder = TransferDecoder(part.message.get("Content-Transfer-Encoding"))
+        offset = 0
+        try:
+            while True:
+                result = self._uid_command(
+                    client, "FETCH", uid, f"(BODY.PEEK[{part.number}]<{offset}.{self._stream_slice_size}>)"
+                )
+                data = b"".join(
+                    item.get(f"BODY[{part.number}]<{offset}>") or b"" for item in parse_fetch_response(result[1])
+                )
+                spool.write(decoder.decode(data))
+                offset += len(data)
+                if len(data) < self._stream_slice_size:
+                    break
+            spool.write(decoder.flush())
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    def _is_part_skipped(self, part):
+        """Check the limits of an attachment part on its BODYSTRUCTURE, with the decoded size of base64 content."""
+        if self.config.download_content and self._is_body_part(part.message):
+            return False
+        size = part.size
+        if (part.message.get("Content-Transfer-Encoding") or "").lower() == "base64":
+            size = size * 3 // 4
+        return self._attachment_limits.is_skipped(
+            MailAttachment(part.message).filename, part.message.get_content_type(), size
+        )
+
+    def _known_attachment_parts(self, msg):
+        """Return the attachment parts whose content is known to the attachment store from a previous run."""
+        if self._attachment_store is None:
+            return []
+        email_pk = self._build_email_pk(msg)
+        return [
+            a.part for index, a in enumerate(msg.attachments) if self._attachment_store.is_known(email_pk, str(index))
+        ]
+
+    @staticmethod
+    def _is_body_part(part):
+        """Check whether a message part is a text or HTML body (see MailMessage.text/html)."""
+        return part.get_content_type() in ("text/plain", "text/", "text/html") and not part.get_filename()
+
+    def _is_part_needed(self, part):
+        """Check whether the content of a message part is written to the output (see MailMessage.text/attachments)."""
+        if self.config.download_content and self._is_body_part(part):
+            if ("body_html" if part.get_content_type() == "text/html" else "body") in self._columns:
+                return True
+        if not self.config.download_attachments:
+            return False
+        if (
+            part.get_filename() is None
+            and part.get("Content-ID") is None
+            and part.get_content_type() != "message/rfc822"
+        ):
+            return False
+        pattern = self.config.attachment_pattern
+        return not pattern or re.fullmatch(pattern, MailAttachment(part).filename) is not None
+
+    def _get_sync_state(self):
+        """Return the per-folder IMAP sync state of the current mailbox, stored in the component state."""
+        from component import KEY_STATE_IMAP_SYNC
+
+        with self.component.state_lock:
+            mailboxes = self.component.state.setdefault(KEY_STATE_IMAP_SYNC, {})
+            return mailboxes.setdefault(self.config.user_name, {})
+
+    def _get_sync_start(self, folder):
+        """
+        Determine where the incremental sync of the folder should continue.
+
+        Returns:
+            Tuple of the current UIDVALIDITY of the folder and the last already processed UID.
+            The UID is 0 (full sync) on the first run or when the UIDVALIDITY has changed since the last run.
+        """
+        uid_validity = self._imap_client.folder.status(folder, ["UIDVALIDITY"])["UIDVALIDITY"]
+        folder_state = self._get_sync_state().get(folder)
+
+        if not folder_state:
+            logging.info(f"No previous sync state found for folder {folder}, running full sync.")
+            return uid_validity, 0
+
+        if folder_state.get("uid_validity") != uid_validity:
+            logging.warning(
+                f"UIDVALIDITY of folder {folder} changed ({folder_state.get('uid_validity')} -> {uid_validity}), "
+                f"previously stored UIDs are no longer valid. Running full sync."
+            )
+            return uid_validity, 0
+
+        last_uid = folder_state.get("last_uid", 0)
+        logging.info(f"Fetching only messages with UID greater than {last_uid} from folder {folder}.")
+        return uid_validity, last_uid
+
+    def _save_sync_state(self, folder, uid_validity, last_uid):
+        """Store the UIDVALIDITY and the highest processed UID of the folder in the component state."""
+        with self.component.state_lock:
+            self._get_sync_state()[folder] = {"uid_validity": uid_validity, "last_uid": last_uid}
+
+    def _get_resume_uid(self, folder, uid_validity):
+        """
+        Return the last UID processed by an interrupted previous run of the same extraction, 0 if there is none.
+
+        The checkpoint is used only if the folder, the query and the UIDVALIDITY did not change since.
+        """
+        checkpoint = self._checkpoints.get(folder=folder, query=self.config.query, uid_validity=uid_validity)
+        if not checkpoint:
+            return 0
+        logging.info(f"Resuming the previous run from the checkpoint after UID {checkpoint['last_uid']}.")
+        return checkpoint["last_uid"]
+
+    def _init_imap_client(self):
+        """Initialize the IMAP client of the fetcher."""
+        self._imap_client = self._connect()
+
+    def _connect(self):
+        """Open a new authenticated IMAP connection - dispatches to OAuth or username/password."""
+        with self.component.metrics.timer("imap_login"):
+            if self.component.use_oauth_login:
+                return self._init_client_from_oauth()
+            else:
+                return self._init_client_from_username_and_pass()
 
     def _init_client_from_oauth(self):
         """Initialize IMAP client using OAuth authentication."""
-        refresh_token = self.component.get_refresh_token()
-        access_token = self.component.get_access_token(refresh_token=refresh_token, scopes=MS_IMAP_SCOPE)
+        access_token = self.component.get_access_token(scopes=MS_IMAP_SCOPE)
         try:
-            self._imap_client = MailBox(self.config.host, self.config.port).xoauth2(self.config.user_name, access_token)
+            client = MailBox(self.config.host, self.config.port).xoauth2(self.config.user_name, access_token)
         except imaplib.IMAP4.error as e:
             raise UserException(
                 f"IMAP OAuth login failed for '{self.config.user_name}' on '{self.config.host}': {e}"
@@ -126,7 +632,9 @@ class ImapEmailFetcher:
             raise UserException(f"Failed to connect to IMAP server '{self.config.host}:{self.config.port}': {e}") from e
 
         imap_folder = self.config.imap_folder or "INBOX"
-        self._set_client_inbox(imap_folder)
+        self._set_client_inbox(client, imap_folder)
+        self._login_tokens[client] = access_token
+        return client
 
     def _init_client_from_username_and_pass(self):
         """Initialize IMAP client using username and password authentication."""
@@ -139,7 +647,7 @@ class ImapEmailFetcher:
             raise UserException("#password is required for IMAP username/password authentication")
 
         try:
-            self._imap_client = MailBox(self.config.host, self.config.port)
+            client = MailBox(self.config.host, self.config.port)
         except Exception as e:
             raise UserException(
                 f"Failed to login, please check your credentials and connection settings. Details: {e}"
@@ -147,7 +655,7 @@ class ImapEmailFetcher:
 
         imap_folder = self.config.imap_folder or "INBOX"
         try:
-            self._imap_client.login(
+            client.login(
                 username=self.config.user_name,
                 password=self.config.password,
                 initial_folder=imap_folder,
@@ -158,20 +666,30 @@ class ImapEmailFetcher:
             ) from e
         except (MailboxLoginError, imaplib.IMAP4.error) as e:
             raise UserException("Failed to login, please check your credentials and connection settings.") from e
+        return client
 
-    def _set_client_inbox(self, imap_folder):
+    @staticmethod
+    def _set_client_inbox(client, imap_folder):
         """Set the IMAP folder to read from."""
         try:
-            self._imap_client.folder.set(imap_folder)
+            client.folder.set(imap_folder)
         except MailboxFolderSelectError as e:
             raise UserException(f"Failed to login to inbox {imap_folder}. Make sure it exists") from e
 
     def _filter_attachments_by_pattern(self, msg: MailMessage):
-        """Filter message attachments by regex pattern."""
+        """Filter message attachments by regex pattern and the attachment size and content type limits."""
         pattern = self.config.attachment_pattern
         attachments = msg.attachments
         if pattern:
             attachments = [a for a in attachments if re.fullmatch(pattern, a.filename)]
+        if self._attachment_limits.enabled:
+            if isinstance(msg, PartialMailMessage):
+                # Decided on the BODYSTRUCTURE, the content of the skipped parts was not downloaded
+                attachments = [a for a in attachments if a.part not in msg.skipped_parts]
+            else:
+                attachments = [
+                    a for a in attachments if not self._attachment_limits.is_skipped(a.filename, a.content_type, a.size)
+                ]
 
         return attachments
 
@@ -182,6 +700,17 @@ class ImapEmailFetcher:
         results = []
         for a in attachments:
             email_pk = self._build_email_pk(msg)
+            spool = msg.attachment_spools.get(a.part) if isinstance(msg, PartialMailMessage) else None
+            if self._attachment_store is not None:
+                # Attachments are identified by their position among all attachments of the message
+                attachment_id = str(msg.attachments.index(a))
+                if not self._attachment_store.add_known(email_pk, attachment_id, a.filename):
+                    content_chunks = spool.iter_chunks() if spool is not None else [a.payload]
+                    file_def = self._attachment_store.write(email_pk, attachment_id, a.filename, content_chunks)
+                    if file_def is not None:
+                        results.append(file_def)
+                continue
+
             normalizer = header_normalizer.get_normalizer(
                 NormalizerStrategy.DEFAULT,
                 permitted_chars=header_normalizer.PERMITTED_CHARS + ".",
@@ -191,17 +720,22 @@ class ImapEmailFetcher:
                 file_path, tags=[f"email_pk: {email_pk}", f"email_date: {msg.date}"]
             )
             with open(file_def.full_path, "wb") as out_file:
-                out_file.write(a.payload)
+                if spool is not None:
+                    spool.copy_to(out_file)
+                else:
+                    out_file.write(a.payload)
             results.append(file_def)
         return results
 
     def _write_message_content(self, writer, msg: MailMessage):
         """Write single email message content to CSV."""
-        row = self._build_email_row(msg)
-        writer.writerow(row)
+        with self.component.metrics.timer("row_build"):
+            row = self._build_email_row(msg)
+        with self.component.metrics.timer("csv_write"):
+            writer.writerow(row)
 
     def _build_email_row(self, msg: MailMessage):
-        """Build email row dict from IMAP MailMessage."""
+        """Build email row dict of the output columns from IMAP MailMessage."""
         row = {
             "pk": self._build_email_pk(msg),
             "uid": msg.uid,
@@ -212,13 +746,13 @@ class ImapEmailFetcher:
             "subject": msg.subject,
             "body": msg.text,
             "body_html": msg.html,
-            "headers": json.dumps(msg.headers),
+            "headers": self._header_filter.serialize(msg.headers),
             "number_of_attachments": len(msg.attachments),
             "attachment_names": [a.filename for a in msg.attachments],
             "size": msg.size,
         }
 
-        return row
+        return {column: row[column] for column in self._columns}
 
     def _build_email_pk(self, msg: MailMessage):
         """Build primary key hash from IMAP MailMessage."""
@@ -0,0 +1,89 @@
+"""
+Per-phase timing and request metrics of a run.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (milliseconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _PhaseStats:
+    """Latency statistics of a single phase."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        milliseconds = seconds * 1000
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if milliseconds <= bound), -1)
+        self.buckets[index] += 1
+
+    def to_dict(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 3),
+            "mean_ms": round(self.total_seconds * 1000 / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+            "histogram": {label: n for label, n in zip(labels, self.buckets, strict=True) if n},
+        }
+
+
+class RunMetrics:
+    """
+    Collects the durations of the phases of a run (authentication, search, requests, parsing, writing)
+    together with counters such as the number of messages, bytes transferred and retries.
+
+    Shared by all fetchers and worker threads of the run. Phase durations are summed over all threads,
+    so the total time of a phase may exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self._started_at = time.monotonic()
+        self._phases: dict[str, _PhaseStats] = {}
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase):
+        """Measure the duration of the enclosed block as one occurrence of the phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            self._phases.setdefault(phase, _PhaseStats()).add(seconds)
+
+    def count(self, name, value=1):
+        """Add the value to the counter of the given name (e.g. messages, bytes_downloaded)."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            wall_seconds = time.monotonic() - self._started_at
+            messages = self._counters.get("messages", 0)
+            return {
+                "wall_seconds": round(wall_seconds, 3),
+                "messages_per_second": round(messages / wall_seconds, 2) if wall_seconds else 0.0,
+                "counters": dict(sorted(self._counters.items())),
+                "phases": {name: stats.to_dict() for name, stats in sorted(self._phases.items())},
+            }
+
+    def write(self, path):
+        """Write the metrics as a JSON document."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
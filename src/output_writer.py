@@ -0,0 +1,138 @@
+"""
+Writers of the emails output table rows.
+"""
+
+import csv
+import gzip
+import io
+import os
+import threading
+from contextlib import ExitStack, contextmanager
+
+
+class SynchronizedWriter:
+    """Row writer shared by fetchers running in multiple threads, rows of each call are written as a whole."""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._lock = threading.Lock()
+
+    def writerow(self, row):
+        with self._lock:
+            self._writer.writerow(row)
+
+
+class BodySplittingWriter:
+    """
+    Moves the bodies of the rows to the table of message bodies, the emails table rows keep empty bodies.
+
+    Only rows whose text and HTML bodies together have at least the minimum size are moved, the rows of the
+    bodies table are written by the same call as the emails table row.
+    """
+
+    def __init__(self, writer, body_writer, min_size_kb=0):
+        self._writer = writer
+        self._body_writer = body_writer
+        self.min_size = min_size_kb * 1024
+
+    def writerow(self, row):
+        # Only the body columns selected for the output are in the row
+        bodies = {column: row[column] or "" for column in ("body", "body_html") if column in row}
+        size = sum(len(body.encode("utf-8")) for body in bodies.values())
+        if any(bodies.values()) and size >= self.min_size:
+            self._body_writer.writerow({"pk": row["pk"], **bodies})
+            row = {**row, **dict.fromkeys(bodies, "")}
+        self._writer.writerow(row)
+
+
+class SlicedGzipWriter:
+    """
+    Writes the rows to gzip compressed, header-less CSV slices in the folder of a sliced output table.
+
+    A new slice is started once the compressed size of the current slice reaches the slice size, so every slice
+    is at most one row (plus the compressor buffer) over the limit. The columns are listed in the table manifest.
+    """
+
+    def __init__(self, folder, fieldnames, slice_size_mb):
+        self.folder = folder
+        self.fieldnames = fieldnames
+        self.slice_size = slice_size_mb * 1024 * 1024
+        self.slice_count = 0
+        self._file = None
+        self._text = None
+        self._writer = None
+        os.makedirs(folder, exist_ok=True)
+
+    def writerow(self, row):
+        if self._writer is None or self._file.tell() >= self.slice_size:
+            self._next_slice()
+        self._writer.writerow(row)
+
+    def close(self):
+        """Finish the last slice, an empty slice is written if there are no rows at all."""
+        if self._writer is None and self.slice_count == 0:
+            self._next_slice()
+        self._close_slice()
+
+    def _close_slice(self):
+        if self._text is not None:
+            # Closes the gzip stream as well, the underlying file is not closed by it
+            self._text.close()
+            self._file.close()
+            self._file = self._text = self._writer = None
+
+    def _next_slice(self):
+        self._close_slice()
+        self.slice_count += 1
+        self._file = open(os.path.join(self.folder, f"part-{self.slice_count:05d}.csv.gz"), "wb")
+        compressed = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6)
+        self._text = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+        self._writer = csv.DictWriter(self._text, fieldnames=self.fieldnames, dialect="kbc")
+
+
+@contextmanager
+def open_output_writer(output_table, writer=None, slice_size_mb=0, bodies_table=None, body_min_size_kb=0, columns=None):
+    """
+    Open the emails output table for writing rows.
+
+    Args:
+        output_table: Output table definition
+        writer: Writer of an already opened output (e.g. shared by several mailboxes), used as is
+        slice_size_mb: When set, the tables are written as gzip compressed slices of about this size (in MB)
+            to the folders of the sliced output tables
+        bodies_table: Output table definition of the message bodies, when set the bodies of at least
+            body_min_size_kb are written to this table instead of the emails table
+
+    Yields:
+        Writer with a `writerow(row_dict)` method
+    """
+    if writer is not None:
+        yield writer
+        return
+
+    from component import BODY_COLUMNS, RESULT_COLUMNS
+
+    columns = columns or RESULT_COLUMNS
+    with ExitStack() as stack:
+        writer = stack.enter_context(_open_table_writer(output_table, columns, slice_size_mb))
+        if bodies_table is not None:
+            body_columns = [column for column in BODY_COLUMNS if column == "pk" or column in columns]
+            body_writer = stack.enter_context(_open_table_writer(bodies_table, body_columns, slice_size_mb))
+            writer = BodySplittingWriter(writer, body_writer, body_min_size_kb)
+        yield writer
+
+
+@contextmanager
+def _open_table_writer(table, columns, slice_size_mb):
+    if slice_size_mb:
+        writer = SlicedGzipWriter(table.full_path, columns, slice_size_mb)
+        try:
+            yield writer
+        finally:
+            writer.close()
+        return
+
+    with open(table.full_path, "w+", encoding="utf-8") as output:
+        writer = csv.DictWriter(output, fieldnames=columns, dialect="kbc")
+        writer.writeheader()
+        yield writer
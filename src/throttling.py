@@ -0,0 +1,105 @@
+"""
+Adaptive client side rate control for throttled APIs.
+"""
+
+import logging
+import random
+import threading
+import time
+
+# Exponential backoff used when the server does not send a Retry-After header
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+
+def get_retry_delay(headers, attempt):
+    """
+    Compute how long to wait before retrying a throttled request.
+
+    Honors the Retry-After header (in seconds) with a small random jitter, so that concurrent workers
+    do not retry at the same instant. Without the header, exponential backoff with full jitter is used.
+
+    Args:
+        headers: Response headers (any mapping, header names are matched case-insensitively)
+        attempt: Zero based number of the retry
+
+    Returns:
+        Delay in seconds
+    """
+    retry_after = {k.lower(): v for k, v in (headers or {}).items()}.get("retry-after")
+    try:
+        return float(retry_after) + random.uniform(0, BACKOFF_BASE_SECONDS)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt))
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits the number of in-flight requests shared by all worker threads and adapts it to throttling.
+
+    The limit follows additive increase / multiplicative decrease: every throttled response halves it
+    and pauses all requests for the requested delay, while each `limit` consecutive successful responses
+    raise it by one, up to `max_limit`. This keeps the request rate just under the throttling threshold.
+
+    Use as a context manager around each request and report the outcome with `succeeded` or `throttled`.
+    """
+
+    def __init__(self, max_limit=1, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.throttled_count = 0
+        self.wait_seconds = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        wait_start = time.monotonic()
+        with self._condition:
+            while True:
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._in_flight >= self.limit:
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+            self.wait_seconds += time.monotonic() - wait_start
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def succeeded(self):
+        """Record a successful (not throttled) response."""
+        with self._condition:
+            self._successes += 1
+            if self.limit < self.max_limit and self._successes >= self.limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttled(self, delay, reason=""):
+        """Record a throttled response: lower the limit and pause all requests for `delay` seconds."""
+        with self._condition:
+            self.throttled_count += 1
+            self._successes = 0
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit != self.limit:
+                logging.info(f"Lowering the number of concurrent requests from {self.limit} to {new_limit}.")
+                self.limit = new_limit
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        logging.info(f"Request throttled ({reason}), retrying in {delay:.1f} s.")
+
+    def log_summary(self, api_name):
+        """Log retry and waiting statistics of the run."""
+        logging.info(
+            f"{api_name} rate control: {self.throttled_count} throttled requests retried, "
+            f"{self.wait_seconds:.1f} s spent waiting (summed over all workers), "
+            f"final concurrency limit {self.limit}/{self.max_limit}."
+        )
@@ -0,0 +1,113 @@
+"""
+OAuth access tokens of a run, refreshed ahead of their expiry, with the MSAL token cache kept in the component state.
+"""
+
+import logging
+import threading
+import time
+
+import msal
+from keboola.component.exceptions import UserException
+
+# Access tokens are refreshed when they expire in less than this number of seconds
+TOKEN_REFRESH_MARGIN = 300
+
+
+class TokenManager:
+    """
+    Acquires the access tokens of all fetchers of the run.
+
+    The MSAL token cache (access and refresh tokens) is serialized to the component state, so a run started
+    while the access token of the previous run is still valid uses it without redeeming the refresh token.
+    A token is refreshed when it expires within TOKEN_REFRESH_MARGIN seconds, so the callers asking for
+    the token before each request (Graph API) or command (IMAP) always get a valid one, also in long runs.
+    """
+
+    def __init__(self, component):
+        self.component = component
+        self._cache = msal.SerializableTokenCache()
+        self._app = None
+        # Scopes -> (access token, monotonic time of its expiry)
+        self._tokens: dict[tuple, tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get_access_token(self, scopes, rejected_token=None):
+        """
+        Return an access token for the scopes that is valid for at least TOKEN_REFRESH_MARGIN seconds.
+
+        Args:
+            scopes: List of OAuth scopes
+            rejected_token: Token rejected by the server (HTTP 401), refreshed even if it has not expired yet.
+                Concurrent callers rejected with the same token refresh it only once.
+        """
+        scopes = tuple(scopes)
+        with self._lock:
+            token = self._tokens.get(scopes)
+            if token and token[0] != rejected_token and token[1] - time.monotonic() > TOKEN_REFRESH_MARGIN:
+                return token[0]
+
+            with self.component.metrics.timer("auth"):
+                # A known token is refreshed, the MSAL cache would return the same expiring or rejected one
+                result = self._acquire(list(scopes), refresh=token is not None)
+            self._tokens[scopes] = (result["access_token"], time.monotonic() + int(result.get("expires_in", 0)))
+            self._save_cache()
+            return result["access_token"]
+
+    def _acquire(self, scopes, refresh):
+        """
+        Take the token from the cache or refresh it with the cached refresh token, redeem the refresh token
+        from the state (or the authorization) if the cache has none.
+        """
+        app = self._get_app()
+        result = None
+        accounts = app.get_accounts()
+        if accounts:
+            result = app.acquire_token_silent(scopes, account=accounts[0], force_refresh=refresh)
+            if result and int(result.get("expires_in", 0)) <= TOKEN_REFRESH_MARGIN and not refresh:
+                result = app.acquire_token_silent(scopes, account=accounts[0], force_refresh=True)
+
+        if result and "access_token" in result:
+            logging.info(f"Access token acquired ({result.get('token_source', 'cache')}).")
+        else:
+            result = app.acquire_token_by_refresh_token(self.component.get_refresh_token(), scopes)
+
+        if "access_token" not in result:
+            raise UserException(
+                f"Failed to login with oAuth. "
+                f"Try to clear state and reauthorize the application.\n"
+                f"Got error {result.get('error')}. "
+                f"Error description : {result.get('error_description')}. "
+                f"Correlation ID : {result.get('correlation_id')}"
+            )
+        return result
+
+    def _get_app(self):
+        """Create the MSAL application with the token cache loaded from the state on the first use."""
+        from component import KEY_STATE_TOKEN_CACHE
+
+        if self._app is None:
+            if serialized := self.component.state.get(KEY_STATE_TOKEN_CACHE):
+                self._cache.deserialize(serialized)
+            configuration = self.component.configuration
+            authority = configuration.image_parameters.get("authority") or "https://login.microsoftonline.com/common"
+            self._app = msal.ConfidentialClientApplication(
+                configuration.oauth_credentials.appKey,
+                authority=authority,
+                client_credential=configuration.oauth_credentials.appSecret,
+                token_cache=self._cache,
+            )
+        return self._app
+
+    def _save_cache(self):
+        """Keep the token cache and the current refresh token in the state and write the state file."""
+        from component import KEY_STATE_REFRESH_TOKEN, KEY_STATE_TOKEN_CACHE
+
+        if not self._cache.has_state_changed:
+            return
+        refresh_tokens = list(self._cache.search(msal.TokenCache.CredentialType.REFRESH_TOKEN))
+        with self.component.state_lock:
+            if refresh_tokens:
+                self.component.state[KEY_STATE_REFRESH_TOKEN] = refresh_tokens[0]["secret"]
+            self.component.state[KEY_STATE_TOKEN_CACHE] = self._cache.serialize()
+        self._cache.has_state_changed = False
+        self.component.write_state_checkpoint()
@@ -1,18 +1,58 @@
+import base64
+import csv
+import email
+import email.policy
+import gzip
+import hashlib
+import imaplib
 import json
 import os
+import quopri
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from email.message import EmailMessage
 from unittest import mock
 from unittest.mock import MagicMock, PropertyMock, patch
 
+import msal
+import requests
 from freezegun import freeze_time
+from imap_tools import MailMessage
 from keboola.component.exceptions import UserException
 
+from attachment_limits import AttachmentLimits
+from attachment_spool import AttachmentSpool, MemoryBudget, TransferDecoder
+from attachment_store import AttachmentStore
 from component import (
+    KEY_STATE_REFRESH_TOKEN,
+    KEY_STATE_TOKEN_CACHE,
     RESULT_COLUMNS,
     Component,
 )
 from configuration import CONNECTION_METHOD_GRAPH, CONNECTION_METHOD_IMAP, Configuration
-from graph_client import GraphEmailFetcher
+from graph_client import (
+    GRAPH_API_BASE,
+    GRAPH_ATTACHMENTS_EXPAND,
+    GRAPH_MAX_RETRIES,
+    MS_GRAPH_SCOPE,
+    GraphEmailFetcher,
+    GraphRequestError,
+    GraphSyncStateExpiredError,
+)
+from header_fields import HeaderFieldFilter
+from html_text import html_to_text
+from imap_bodystructure import parse_fetch_response
+from imap_client import IMAP_UID_SET_MAX_RANGES, MS_IMAP_SCOPE, ImapEmailFetcher
+from metrics import RunMetrics
+from output_writer import SlicedGzipWriter, open_output_writer
+from throttling import AdaptiveRateLimiter, get_retry_delay
+from token_manager import TOKEN_REFRESH_MARGIN, TokenManager
 
 
 class TestComponent(unittest.TestCase):
@@ -81,6 +121,7 @@ class _GraphTestBase(unittest.TestCase):
     def setUp(self):
         # Create a mock component
         self.mock_component = MagicMock()
+        self.mock_component.state_lock = threading.RLock()
         self.mock_component.environment_variables = MagicMock()
         self.mock_component.environment_variables.component_id = "kds-team.ex-ms-outlook-email-content"
 
@@ -104,11 +145,7 @@ class _GraphTestBase(unittest.TestCase):
     def _create_fetcher(self, config_overrides=None):
         """Create a GraphEmailFetcher with a Configuration object."""
         config = self._create_config(config_overrides)
-        fetcher = GraphEmailFetcher.__new__(GraphEmailFetcher)
-        fetcher.component = self.mock_component
-        fetcher.config = config
-        fetcher._graph_session = None
-        return fetcher
+        return GraphEmailFetcher(self.mock_component, config)
 
 
 class TestGraphApiRowBuilder(_GraphTestBase):
@@ -256,6 +293,669 @@ class TestGraphApiQueryParams(_GraphTestBase):
         self.assertIn(" and ", params["$filter"])
 
 
+class TestGraphDeltaSync(_GraphTestBase):
+    """Test delta query based incremental Graph API sync."""
+
+    DELTA_URL = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta"
+
+    def setUp(self):
+        super().setUp()
+        self.mock_component.state = {}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_table = MagicMock()
+        self.output_table.full_path = os.path.join(self.tmp_dir.name, "emails.csv")
+
+    def _create_delta_fetcher(self, pages):
+        """Create a fetcher whose GET requests return the given pages keyed by URL."""
+        fetcher = self._create_fetcher({"incremental_fetch": True, "mark_seen": False})
+        fetcher._init_graph_session = MagicMock()
+        fetcher._fetch_message_detail = MagicMock(side_effect=lambda msg_id: dict(SAMPLE_GRAPH_MESSAGE, id=msg_id))
+
+        def request(method, url, params=None, json_body=None, extra_headers=None):
+            page = pages[url]
+            if isinstance(page, Exception):
+                raise page
+            response = MagicMock()
+            response.json.return_value = page
+            return response
+
+        fetcher._request = MagicMock(side_effect=request)
+        return fetcher
+
+    def _fetched_ids(self):
+        with open(self.output_table.full_path, encoding="utf-8") as f:
+            return [r["uid"] for r in csv.DictReader(f)]
+
+    def test_initial_round_follows_pages_and_stores_delta_link(self):
+        fetcher = self._create_delta_fetcher(
+            {
+                self.DELTA_URL: {"value": [{"id": "m1"}], "@odata.nextLink": "next_page"},
+                "next_page": {
+                    "value": [{"id": "m2"}, {"id": "m0", "@removed": {"reason": "deleted"}}],
+                    "@odata.deltaLink": "delta_token_1",
+                },
+            }
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(self._fetched_ids(), ["m1", "m2"])
+        first_call = fetcher._request.call_args_list[0]
+        self.assertNotIn("$top", first_call.kwargs["params"])
+        self.assertEqual(first_call.kwargs["extra_headers"], {"Prefer": "odata.maxpagesize=100"})
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_1"}
+        )
+
+    def test_next_run_starts_from_stored_delta_link(self):
+        self.mock_component.state = {"graph_delta": {"test@example.com": {"inbox": {"delta_link": "delta_token_1"}}}}
+        fetcher = self._create_delta_fetcher(
+            {"delta_token_1": {"value": [{"id": "m3"}], "@odata.deltaLink": "delta_token_2"}}
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(self._fetched_ids(), ["m3"])
+        self.assertEqual(fetcher._request.call_count, 1)
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_2"}
+        )
+
+    def test_expired_delta_link_falls_back_to_full_sync(self):
+        self.mock_component.state = {"graph_delta": {"test@example.com": {"inbox": {"delta_link": "expired"}}}}
+        fetcher = self._create_delta_fetcher(
+            {
+                "expired": GraphSyncStateExpiredError("expired"),
+                self.DELTA_URL: {"value": [{"id": "m1"}], "@odata.deltaLink": "delta_token_3"},
+            }
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(self._fetched_ids(), ["m1"])
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_3"}
+        )
+
+    def test_own_read_changes_skipped_by_next_delta_round(self):
+        fetcher = self._create_delta_fetcher(
+            {
+                self.DELTA_URL: {"value": [{"id": "m1"}, {"id": "m2"}], "@odata.deltaLink": "delta_token_1"},
+                "https://graph.microsoft.com/v1.0/me/messages/m1": {},
+                "https://graph.microsoft.com/v1.0/me/messages/m2": {},
+                "delta_token_1": {
+                    "value": [{"id": "m1", "isRead": True}, {"id": "m3", "@removed": {"reason": "deleted"}}],
+                    "@odata.nextLink": "delta_token_1_page_2",
+                },
+                "delta_token_1_page_2": {"value": [{"id": "m2", "isRead": True}], "@odata.deltaLink": "delta_token_2"},
+            }
+        )
+        fetcher.fetch(self.output_table, True, False, True)
+
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_2"}
+        )
+
+    def test_other_changes_keep_delta_link(self):
+        for change in ({"id": "m9", "isRead": False}, {"id": "m1", "isRead": False}):
+            with self.subTest(change=change):
+                self.mock_component.state = {}
+                fetcher = self._create_delta_fetcher(
+                    {
+                        self.DELTA_URL: {"value": [{"id": "m1"}], "@odata.deltaLink": "delta_token_1"},
+                        "https://graph.microsoft.com/v1.0/me/messages/m1": {},
+                        "delta_token_1": {"value": [{"id": "m1", "isRead": True}, change]},
+                    }
+                )
+                fetcher.fetch(self.output_table, True, False, True)
+
+                self.assertEqual(
+                    self.mock_component.state["graph_delta"]["test@example.com"]["inbox"],
+                    {"delta_link": "delta_token_1"},
+                )
+
+    def test_own_read_changes_skipped_after_deferred_marking(self):
+        fetcher = self._create_delta_fetcher(
+            {
+                self.DELTA_URL: {"value": [{"id": "m1"}], "@odata.deltaLink": "delta_token_1"},
+                "delta_token_1": {"value": [{"id": "m1", "isRead": True}], "@odata.deltaLink": "delta_token_2"},
+            }
+        )
+        fetcher.config.mark_seen_after_run = True
+        fetcher._batch_request = MagicMock(side_effect=lambda sub_requests, **kwargs: [{}] * len(sub_requests))
+        fetcher.fetch(self.output_table, True, False, True)
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_1"}
+        )
+
+        fetcher.mark_processed_as_seen()
+
+        self.assertEqual(len(fetcher._batch_request.call_args.args[0]), 1)
+        self.assertEqual(
+            self.mock_component.state["graph_delta"]["test@example.com"]["inbox"], {"delta_link": "delta_token_2"}
+        )
+
+    def test_rejected_checkpoint_link_falls_back_to_stored_delta_link(self):
+        self.mock_component.state = {
+            "graph_delta": {"test@example.com": {"inbox": {"delta_link": "delta_token_1"}}},
+            "checkpoint": {"test@example.com": {"next_link": "stale"}},
+        }
+        fetcher = self._create_delta_fetcher(
+            {
+                "stale": GraphRequestError("Invalid skip token", 400),
+                "delta_token_1": {"value": [{"id": "m3"}], "@odata.deltaLink": "delta_token_2"},
+            }
+        )
+
+        pages = list(fetcher._iter_delta_pages("inbox", "inbox", resume_link="stale"))
+
+        self.assertEqual([m["id"] for page in pages for m in page["value"]], ["m3"])
+        self.assertEqual(self.mock_component.state["checkpoint"], {})
+
+    def test_incremental_fetch_cannot_be_combined_with_graph_filter(self):
+        with self.assertRaises(UserException) as cm:
+            self._create_config({"incremental_fetch": True, "graph_filter": "hasAttachments eq true"})
+        self.assertIn("cannot be combined", str(cm.exception))
+
+
+class TestGraphBatchRequests(_GraphTestBase):
+    """Test grouping of per-message Graph API calls into JSON batch requests."""
+
+    def _create_batch_fetcher(self, handler):
+        """Create a fetcher whose $batch endpoint answers each sub-request with handler(sub_request)."""
+        fetcher = self._create_fetcher({"graph_batch_requests": True})
+        fetcher.component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(
+            full_path=os.path.join(self.tmp_dir.name, name)
+        )
+        self.batches = []
+        self.streamed = []
+
+        def request(method, url, params=None, json_body=None, extra_headers=None, stream=False):
+            if url.endswith("/$value"):
+                self.streamed.append(url)
+                response = MagicMock()
+                response.iter_content.return_value = [b"col_a,col_b\n", b"1,2\n"]
+                return response
+            self.assertEqual((method, url), ("POST", "https://graph.microsoft.com/v1.0/$batch"))
+            self.batches.append(json_body["requests"])
+            responses = [dict(handler(r), id=r["id"]) for r in json_body["requests"]]
+            response = MagicMock()
+            response.json.return_value = {"responses": list(reversed(responses))}
+            return response
+
+        fetcher._request = MagicMock(side_effect=request)
+        return fetcher
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_sub_request_url_is_relative_with_params(self):
+        sub_request = GraphEmailFetcher._build_batch_sub_request(
+            "1",
+            {
+                "method": "GET",
+                "url": "https://graph.microsoft.com/v1.0/me/messages/abc",
+                "params": {"$select": "id,body"},
+                "extra_headers": {"Prefer": 'outlook.body-content-type="text"'},
+            },
+        )
+        self.assertEqual(sub_request["url"], "/me/messages/abc?%24select=id%2Cbody")
+        self.assertEqual(sub_request["headers"], {"Prefer": 'outlook.body-content-type="text"'})
+        self.assertNotIn("body", sub_request)
+
+    def test_sub_request_with_json_body_sets_content_type(self):
+        fetcher = self._create_fetcher()
+        sub_request = GraphEmailFetcher._build_batch_sub_request("2", fetcher._mark_as_read_request("abc"))
+        self.assertEqual(sub_request["method"], "PATCH")
+        self.assertEqual(sub_request["body"], {"isRead": True})
+        self.assertEqual(sub_request["headers"], {"Content-Type": "application/json"})
+
+    def test_batch_request_chunks_and_keeps_order(self):
+        fetcher = self._create_batch_fetcher(lambda r: {"status": 200, "body": {"url": r["url"]}})
+        sub_requests = [
+            {"method": "GET", "url": f"https://graph.microsoft.com/v1.0/me/messages/{i}"} for i in range(45)
+        ]
+        responses = fetcher._batch_request(sub_requests)
+
+        self.assertEqual([len(b) for b in self.batches], [20, 20, 5])
+        self.assertEqual([r["url"] for r in responses], [f"/me/messages/{i}" for i in range(45)])
+
+    def test_batch_sub_request_error_maps_to_user_exception(self):
+        fetcher = self._create_batch_fetcher(lambda r: {"status": 403, "body": {"error": {"message": "denied"}}})
+        with self.assertRaises(UserException) as cm:
+            fetcher._batch_request([{"method": "GET", "url": "https://graph.microsoft.com/v1.0/me/messages/1"}])
+        self.assertIn("Access denied by Microsoft Graph API", str(cm.exception))
+        self.assertIn("denied", str(cm.exception))
+
+    def test_messages_not_found_are_not_marked_as_read(self):
+        fetcher = self._create_batch_fetcher(
+            lambda r: (
+                {"status": 404, "body": {"error": {"message": "Not found"}}}
+                if r["url"].endswith("/m2")
+                else {"status": 200, "body": {"id": r["url"]}}
+            )
+        )
+
+        with self.assertLogs(level="WARNING") as logs:
+            fetcher._mark_as_read_batched(["m1", "m2", "m3"])
+
+        self.assertEqual(fetcher._marked_read_ids, {"m1", "m3"})
+        self.assertIn("1 messages not marked as read", logs.output[0])
+
+    def test_process_messages_batched(self):
+        def handler(sub_request):
+            url = sub_request["url"]
+            if sub_request["method"] == "PATCH":
+                return {"status": 200, "body": {}}
+            msg_id = url.split("/")[3].split("?")[0]
+            if "headers" in sub_request:
+                return {"status": 200, "body": dict(SAMPLE_GRAPH_MESSAGE, id=msg_id, body={"content": "Hello"})}
+            attachments = [SAMPLE_GRAPH_ATTACHMENT, SAMPLE_GRAPH_INLINE_ATTACHMENT] if msg_id == "m2" else []
+            return {
+                "status": 200,
+                "body": dict(
+                    SAMPLE_GRAPH_MESSAGE, id=msg_id, body={"content": "<p>Hello</p>"}, attachments=attachments
+                ),
+            }
+
+        fetcher = self._create_batch_fetcher(handler)
+        processed = fetcher._process_messages_batched([{"id": "m1"}, {"id": "m2"}], True, True)
+
+        self.assertEqual([d["id"] for d, _, _ in processed], ["m1", "m2"])
+        self.assertEqual(processed[0][0]["_body_text"], "Hello")
+        self.assertEqual(processed[0][1:], ([], []))
+        self.assertEqual([a["id"] for a in processed[1][1]], ["att_123", "att_inline_456"])
+        self.assertEqual(len(processed[1][2]), 1)
+        self.assertNotIn("attachments", processed[1][0])
+        # details (with expanded attachment metadata), mark as read
+        self.assertEqual([len(b) for b in self.batches], [4, 2])
+        # attachment content is streamed by a single request
+        self.assertEqual(self.streamed, [f"{GRAPH_API_BASE}/me/messages/m2/attachments/att_123/$value"])
+
+
+class TestGraphMarkSeenAfterRun(_GraphTestBase):
+    """Test marking the processed Graph messages as read after the run."""
+
+    def setUp(self):
+        super().setUp()
+        self.mock_component.state = {}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_table = MagicMock()
+        self.output_table.full_path = os.path.join(self.tmp_dir.name, "emails.csv")
+
+    def _create_fetcher_with_messages(self, config_overrides):
+        fetcher = self._create_fetcher(config_overrides)
+        fetcher._init_graph_session = MagicMock()
+        fetcher._resolve_graph_folder = MagicMock(return_value="inbox")
+        fetcher._iter_pages = MagicMock(return_value=iter([{"value": [{"id": "m1"}, {"id": "m2"}, {"id": "m3"}]}]))
+        fetcher._fetch_message_detail = MagicMock(
+            side_effect=lambda msg_id: dict(SAMPLE_GRAPH_MESSAGE, id=msg_id, isRead=msg_id == "m2")
+        )
+        fetcher._mark_as_read = MagicMock()
+        fetcher._batch_request = MagicMock(side_effect=lambda sub_requests, **kwargs: [{}] * len(sub_requests))
+        return fetcher
+
+    def test_unread_messages_marked_in_batch_after_run(self):
+        fetcher = self._create_fetcher_with_messages({"mark_seen_after_run": True})
+        fetcher.fetch(self.output_table, True, False, True)
+
+        fetcher._mark_as_read.assert_not_called()
+        fetcher._batch_request.assert_not_called()
+
+        fetcher.mark_processed_as_seen()
+        fetcher._batch_request.assert_called_once_with(
+            [fetcher._mark_as_read_request("m1"), fetcher._mark_as_read_request("m3")], skip_not_found=True
+        )
+
+        fetcher.mark_processed_as_seen()
+        fetcher._batch_request.assert_called_once()
+
+    def test_messages_marked_during_fetch_by_default(self):
+        fetcher = self._create_fetcher_with_messages({})
+        fetcher.fetch(self.output_table, True, False, True)
+        fetcher.mark_processed_as_seen()
+
+        self.assertEqual([c.args[0] for c in fetcher._mark_as_read.call_args_list], ["m1", "m3"])
+        fetcher._batch_request.assert_not_called()
+
+
+class _GeneratedStream:
+    """File-like raw response body producing `size` bytes without holding them in memory."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, amount=-1):
+        amount = self.remaining if amount is None or amount < 0 else min(amount, self.remaining)
+        self.remaining -= amount
+        return b"x" * amount
+
+
+class TestGraphAttachmentStreaming(_GraphTestBase):
+    """Test streaming of attachment content to the output files."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.mock_component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(
+            full_path=os.path.join(self.tmp_dir.name, name)
+        )
+
+    def test_file_attachment_streamed_with_bounded_memory(self):
+        size = 64 * 1024 * 1024
+        raw = _GeneratedStream(size)
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = raw
+        fetcher = self._create_fetcher()
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.return_value = response
+
+        tracemalloc.start()
+        try:
+            file_def = fetcher._download_attachment("m1", SAMPLE_GRAPH_MESSAGE, SAMPLE_GRAPH_ATTACHMENT)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        request_kwargs = fetcher._graph_session.request.call_args.kwargs
+        self.assertEqual(request_kwargs["url"], f"{GRAPH_API_BASE}/me/messages/m1/attachments/att_123/$value")
+        self.assertTrue(request_kwargs["stream"])
+        self.assertEqual(os.path.getsize(file_def.full_path), size)
+        self.assertLess(peak, 8 * 1024 * 1024)
+        self.assertEqual(raw.remaining, 0)
+
+    def test_item_attachment_uses_attachment_resource(self):
+        fetcher = self._create_fetcher()
+        fetcher._request = MagicMock(return_value=_mock_http_response(200, {"contentBytes": "aGVsbG8="}))
+        item_attachment = dict(SAMPLE_GRAPH_ATTACHMENT, **{"@odata.type": "#microsoft.graph.itemAttachment"})
+
+        file_def = fetcher._download_attachment("m1", SAMPLE_GRAPH_MESSAGE, item_attachment)
+
+        self.assertEqual(
+            fetcher._request.call_args.kwargs["url"], f"{GRAPH_API_BASE}/me/messages/m1/attachments/att_123"
+        )
+        with open(file_def.full_path, "rb") as f:
+            self.assertEqual(f.read(), b"hello")
+
+
+class TestGraphAttachmentsExpand(_GraphTestBase):
+    """Test that attachment metadata is expanded inline with the message detail."""
+
+    def test_detail_request_expands_attachments(self):
+        fetcher = self._create_fetcher()
+        html_request, text_request = fetcher._message_detail_requests("abc")
+        self.assertEqual(html_request["params"]["$expand"], "attachments($select=id,name,contentType,size,isInline)")
+        self.assertNotIn("$expand", text_request["params"])
+
+    def test_process_message_uses_expanded_attachments(self):
+        fetcher = self._create_fetcher()
+        response = MagicMock()
+        response.json.return_value = dict(SAMPLE_GRAPH_MESSAGE, attachments=[SAMPLE_GRAPH_ATTACHMENT])
+        fetcher._request = MagicMock(return_value=response)
+
+        msg_detail, attachments, file_defs = fetcher._process_message("abc", False, False)
+
+        # html and text body only, no separate attachment metadata request
+        self.assertEqual(fetcher._request.call_count, 2)
+        self.assertEqual(attachments, [SAMPLE_GRAPH_ATTACHMENT])
+        self.assertNotIn("attachments", msg_detail)
+        self.assertEqual(fetcher._build_email_row(msg_detail, attachments)["attachment_names"], ["report.csv"])
+
+
+class TestGraphConcurrency(_GraphTestBase):
+    """Test concurrent processing of Graph API messages."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_table = MagicMock()
+        self.output_table.full_path = os.path.join(self.tmp_dir.name, "emails.csv")
+
+    def test_rows_and_files_keep_listing_order(self):
+        fetcher = self._create_fetcher({"graph_concurrency": 4})
+        fetcher._init_graph_session = MagicMock()
+        page = MagicMock()
+        page.json.return_value = {"value": [{"id": f"m{i}"} for i in range(12)]}
+        fetcher._request = MagicMock(return_value=page)
+        threads = set()
+
+        def process_message(message_id, download_attachments, mark_seen):
+            threads.add(threading.current_thread().name)
+            # earlier messages finish later
+            time.sleep(0.002 * (12 - int(message_id[1:])))
+            return dict(SAMPLE_GRAPH_MESSAGE, id=message_id), [], [f"file_{message_id}"]
+
+        fetcher._process_message = process_message
+        results = fetcher.fetch(self.output_table, True, True, False)
+
+        with open(self.output_table.full_path, encoding="utf-8") as f:
+            self.assertEqual([r["uid"] for r in csv.DictReader(f)], [f"m{i}" for i in range(12)])
+        self.assertEqual(results[1:], [f"file_m{i}" for i in range(12)])
+        self.assertGreater(len(threads), 1)
+        self.assertIsNone(fetcher._executor)
+
+    def test_connection_pool_sized_to_concurrency(self):
+        fetcher = self._create_fetcher({"graph_concurrency": 16})
+        self.mock_component.get_access_token.return_value = "token"
+        fetcher._init_graph_session()
+
+        adapter = fetcher._graph_session.get_adapter(GRAPH_API_BASE)
+        self.assertEqual(adapter._pool_maxsize, 16)
+
+
+def _mock_http_response(status_code, body=None, headers=None):
+    """Build a requests.Response with a JSON body."""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body or {}).encode()
+    response._content_consumed = True
+    response.headers.update(headers or {})
+    return response
+
+
+class TestGraphThrottling(_GraphTestBase):
+    """Test retrying of throttled Graph API requests and adaptive concurrency."""
+
+    def setUp(self):
+        super().setUp()
+        delay_patcher = patch("graph_client.get_retry_delay", return_value=0)
+        self.get_retry_delay = delay_patcher.start()
+        self.addCleanup(delay_patcher.stop)
+
+    def test_throttled_request_is_retried(self):
+        fetcher = self._create_fetcher()
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.side_effect = [
+            _mock_http_response(429, headers={"Retry-After": "2"}),
+            _mock_http_response(503),
+            _mock_http_response(200, {"id": "abc"}),
+        ]
+
+        response = fetcher._request("GET", f"{GRAPH_API_BASE}/me/messages/abc")
+
+        self.assertEqual(response.json(), {"id": "abc"})
+        self.assertEqual(fetcher._graph_session.request.call_count, 3)
+        self.assertEqual(fetcher._rate_limiter.throttled_count, 2)
+        self.assertEqual(self.get_retry_delay.call_args_list[0].args[0]["Retry-After"], "2")
+
+    def test_gives_up_after_max_retries(self):
+        fetcher = self._create_fetcher()
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.return_value = _mock_http_response(
+            429, {"error": {"message": "Application is over its MailboxConcurrency limit."}}
+        )
+
+        with self.assertRaises(UserException) as cm:
+            fetcher._request("GET", f"{GRAPH_API_BASE}/me/messages/abc")
+        self.assertIn("HTTP 429", str(cm.exception))
+        self.assertEqual(fetcher._graph_session.request.call_count, GRAPH_MAX_RETRIES + 1)
+
+    def test_throttled_batch_sub_requests_are_resent(self):
+        fetcher = self._create_fetcher()
+        sent = []
+
+        def request(method, url, params=None, json_body=None, extra_headers=None):
+            ids = [r["id"] for r in json_body["requests"]]
+            sent.append(ids)
+            responses = [
+                {"id": i, "status": 429, "headers": {"Retry-After": "1"}}
+                if i == "1" and len(sent) == 1
+                else {"id": i, "status": 200, "body": {"n": i}}
+                for i in ids
+            ]
+            response = MagicMock()
+            response.json.return_value = {"responses": responses}
+            return response
+
+        fetcher._request = MagicMock(side_effect=request)
+        sub_requests = [{"method": "GET", "url": f"{GRAPH_API_BASE}/me/messages/{i}"} for i in range(3)]
+
+        self.assertEqual(fetcher._batch_request(sub_requests), [{"n": "0"}, {"n": "1"}, {"n": "2"}])
+        self.assertEqual(sent, [["0", "1", "2"], ["1"]])
+        self.assertEqual(fetcher._rate_limiter.throttled_count, 1)
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    """Test the throttling helpers."""
+
+    def test_retry_delay_honors_retry_after(self):
+        delay = get_retry_delay({"retry-after": "3"}, attempt=0)
+        self.assertGreaterEqual(delay, 3)
+        self.assertLessEqual(delay, 4)
+
+    def test_retry_delay_exponential_backoff(self):
+        for attempt in range(4):
+            self.assertLessEqual(get_retry_delay({}, attempt), 2**attempt)
+
+    def test_limit_decreases_on_throttling_and_recovers(self):
+        limiter = AdaptiveRateLimiter(max_limit=4)
+        limiter.throttled(0)
+        self.assertEqual(limiter.limit, 2)
+        limiter.throttled(0)
+        limiter.throttled(0)
+        self.assertEqual(limiter.limit, 1)
+
+        limiter.succeeded()
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(2 + 3):
+            limiter.succeeded()
+        self.assertEqual(limiter.limit, 4)
+        limiter.succeeded()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_requests_wait_for_retry_after(self):
+        limiter = AdaptiveRateLimiter()
+        limiter.throttled(0.05)
+        start = time.monotonic()
+        with limiter:
+            pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertGreaterEqual(limiter.wait_seconds, 0.04)
+
+
+class TestGraphLocalTextBody(_GraphTestBase):
+    """Test deriving the plain-text body locally from the HTML body."""
+
+    def test_single_request_per_message(self):
+        fetcher = self._create_fetcher({"graph_local_text_body": True})
+        requests = fetcher._message_detail_requests("abc")
+        self.assertEqual(len(requests), 1)
+        self.assertNotIn("extra_headers", requests[0])
+
+    def test_two_requests_per_message_by_default(self):
+        fetcher = self._create_fetcher()
+        self.assertEqual(len(fetcher._message_detail_requests("abc")), 2)
+
+    def test_text_body_converted_from_html(self):
+        fetcher = self._create_fetcher({"graph_local_text_body": True})
+        response = MagicMock()
+        response.json.return_value = dict(SAMPLE_GRAPH_MESSAGE, body={"contentType": "html", "content": "<p>Hi</p>"})
+        fetcher._request = MagicMock(return_value=response)
+
+        msg = fetcher._fetch_message_detail("abc")
+
+        fetcher._request.assert_called_once()
+        self.assertEqual(msg["_body_text"], "Hi")
+        self.assertEqual(fetcher._build_email_row(msg, [])["body_html"], "<p>Hi</p>")
+
+    def test_plain_text_message_kept_as_is(self):
+        msg = GraphEmailFetcher._merge_message_detail({"body": {"contentType": "text", "content": "a <b> c"}})
+        self.assertEqual(msg["_body_text"], "a <b> c")
+
+
+class TestGraphColumnProjection(_GraphTestBase):
+    """Test that only the data of the selected output columns is requested from the Graph API."""
+
+    def test_metadata_columns_skip_headers_and_text_body(self):
+        fetcher = self._create_fetcher({"columns": ["from", "subject", "date"]})
+
+        requests = fetcher._message_detail_requests("abc")
+
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(
+            requests[0]["params"],
+            {"$select": "id,subject,from,toRecipients,receivedDateTime,body,hasAttachments,isRead"},
+        )
+
+    def test_size_and_pk_do_not_depend_on_columns(self):
+        def fetch_row(columns):
+            fetcher = self._create_fetcher({"columns": columns})
+            message = {key: value for key, value in SAMPLE_GRAPH_MESSAGE.items() if not key.startswith("_")}
+            response = MagicMock()
+            response.json.side_effect = lambda: {
+                name: message[name]
+                for name in fetcher._message_detail_requests("abc")[0]["params"]["$select"].split(",")
+            }
+            with patch.object(fetcher, "_request", return_value=response):
+                return fetcher._build_email_row(fetcher._fetch_message_detail("abc"), [])
+
+        row, full_row = fetch_row(["subject", "size"]), fetch_row([])
+
+        self.assertEqual(row["size"], len(SAMPLE_GRAPH_MESSAGE["body"]["content"]))
+        self.assertEqual(row, {column: full_row[column] for column in row})
+
+    def test_text_body_column_requests_body(self):
+        fetcher = self._create_fetcher({"columns": ["subject", "body", "attachment_names"]})
+
+        requests = fetcher._message_detail_requests("abc")
+
+        self.assertEqual(len(requests), 2)
+        self.assertIn("body", requests[0]["params"]["$select"].split(","))
+        self.assertNotIn("internetMessageHeaders", requests[0]["params"]["$select"])
+        self.assertEqual(requests[0]["params"]["$expand"], GRAPH_ATTACHMENTS_EXPAND)
+
+    def test_row_has_only_selected_columns(self):
+        fetcher = self._create_fetcher({"columns": ["subject", "from"]})
+        msg = GraphEmailFetcher._merge_message_detail(dict(SAMPLE_GRAPH_MESSAGE))
+
+        row = fetcher._build_email_row(msg, [])
+
+        self.assertEqual(list(row), ["pk", "from", "subject"])
+        self.assertEqual(row["from"], SAMPLE_GRAPH_MESSAGE["from"]["emailAddress"]["address"])
+
+
+class TestHtmlToText(unittest.TestCase):
+    """Test the local HTML to text converter."""
+
+    def test_block_elements_and_entities(self):
+        html_body = (
+            "<html><head><title>T</title><style>p {color: red}</style></head>"
+            "<body><p>Hello&nbsp;<b>World</b></p>\n<div>a &amp; b<br>c</div><!-- hidden --></body></html>"
+        )
+        self.assertEqual(html_to_text(html_body), "Hello World\n\na & b\nc")
+
+    def test_table_cells_and_whitespace(self):
+        html_body = "<table><tr><td>a</td>\n   <td>b</td></tr><tr><td>c</td></tr></table>"
+        self.assertEqual(html_to_text(html_body), "a b\n\nc")
+
+    def test_empty(self):
+        self.assertEqual(html_to_text(""), "")
+
+
 class TestGraphApiFolderResolve(_GraphTestBase):
     """Test Graph API folder name resolution."""
 
@@ -281,6 +981,1484 @@ class TestGraphApiFolderResolve(_GraphTestBase):
         self.assertEqual(fetcher._resolve_graph_folder("Inbox"), "inbox")
 
 
+def _imap_string(value):
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _imap_params(params):
+    if not params:
+        return "NIL"
+    return "(" + " ".join(f"{_imap_string(k)} {_imap_string(v)}" for k, v in params) + ")"
+
+
+def _imap_body_structure(part):
+    """Serialize the IMAP BODYSTRUCTURE of an email.message.Message."""
+    if part.get_content_maintype() == "multipart":
+        children = "".join(_imap_body_structure(p) for p in part.get_payload())
+        return f"({children} {_imap_string(part.get_content_subtype())})"
+
+    body = _imap_part_content(part)
+    fields = [
+        _imap_string(part.get_content_maintype()),
+        _imap_string(part.get_content_subtype()),
+        _imap_params((part.get_params() or [])[1:]),
+        _imap_string(part.get("Content-ID")),
+        "NIL",
+        _imap_string(part.get("Content-Transfer-Encoding", "7BIT")),
+        str(len(body)),
+    ]
+    if part.get_content_type() == "message/rfc822":
+        fields += ["NIL", _imap_body_structure(part.get_payload(0)), str(body.count(b"\n"))]
+    elif part.get_content_maintype() == "text":
+        fields.append(str(body.count(b"\n")))
+    disposition = part.get_params(header="Content-Disposition")
+    fields += ["NIL", f"({_imap_string(disposition[0][0])} {_imap_params(disposition[1:])})" if disposition else "NIL"]
+    return "(" + " ".join(fields) + ")"
+
+
+def _imap_part_content(part):
+    if part.get_content_type() == "message/rfc822":
+        return part.get_payload(0).as_bytes(policy=email.policy.compat32.clone(linesep="\r\n"))
+    if part.get("Content-Transfer-Encoding", "7bit").lower() in ("7bit", "8bit", "binary"):
+        return part.get_payload(decode=True)
+    return part.get_payload().encode("ascii")
+
+
+class TestGraphTokenRefresh(_GraphTestBase):
+    """Test that Graph API requests send the current access token and recover from a rejected one."""
+
+    def test_unauthorized_request_retried_with_refreshed_token(self):
+        fetcher = self._create_fetcher()
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.side_effect = [
+            _mock_http_response(401, {"error": {"message": "Access token has expired."}}),
+            _mock_http_response(200, {"id": "abc"}),
+        ]
+        self.mock_component.get_access_token.side_effect = ["expired", "refreshed"]
+
+        response = fetcher._request("GET", f"{GRAPH_API_BASE}/me/messages/abc")
+
+        self.assertEqual(response.json(), {"id": "abc"})
+        self.assertEqual(
+            self.mock_component.get_access_token.call_args_list[1].kwargs["rejected_token"],
+            "expired",
+        )
+        sent_tokens = [c.kwargs["headers"]["Authorization"] for c in fetcher._graph_session.request.call_args_list]
+        self.assertEqual(sent_tokens, ["Bearer expired", "Bearer refreshed"])
+
+    def test_request_rejected_twice_fails(self):
+        fetcher = self._create_fetcher()
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.return_value = _mock_http_response(401)
+
+        with self.assertRaises(UserException):
+            fetcher._request("GET", f"{GRAPH_API_BASE}/me/messages/abc")
+        self.assertEqual(fetcher._graph_session.request.call_count, 2)
+
+
+class _FakeMsalApp:
+    """msal.ConfidentialClientApplication stand-in issuing numbered tokens into the real token cache."""
+
+    expires_in = 3600
+
+    def __init__(self, client_id, authority=None, client_credential=None, token_cache=None):
+        self.cache = token_cache
+        self.redeemed = []
+        self.issued = 0
+
+    def get_accounts(self):
+        return [{"username": "user"}] if list(self.cache.search(msal.TokenCache.CredentialType.REFRESH_TOKEN)) else []
+
+    def acquire_token_silent(self, scopes, account, force_refresh=False):
+        if force_refresh:
+            return self._issue(scopes)
+        token = list(self.cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN))[0]
+        return {"access_token": token["secret"], "expires_in": int(token["expires_on"]) - int(time.time())}
+
+    def acquire_token_by_refresh_token(self, refresh_token, scopes):
+        self.redeemed.append(refresh_token)
+        return self._issue(scopes)
+
+    def _issue(self, scopes):
+        self.issued += 1
+        response = {
+            "access_token": f"access-{self.issued}",
+            "refresh_token": f"refresh-{self.issued}",
+            "expires_in": self.expires_in,
+            "token_type": "Bearer",
+        }
+        self.cache.add(
+            {
+                "client_id": "app",
+                "scope": scopes,
+                "token_endpoint": "https://login.microsoftonline.com/common/oauth2/v2.0/token",
+                "response": dict(response),
+                "data": {},
+            }
+        )
+        return response
+
+
+class TestTokenManager(unittest.TestCase):
+    """Test the access tokens of the run and the MSAL token cache kept in the state."""
+
+    def setUp(self):
+        self.component = self._create_component({})
+        app_patcher = patch("token_manager.msal.ConfidentialClientApplication", side_effect=_FakeMsalApp)
+        app_patcher.start()
+        self.addCleanup(app_patcher.stop)
+
+    @staticmethod
+    def _create_component(state):
+        component = MagicMock()
+        component.state = state
+        component.state_lock = threading.RLock()
+        component.metrics = RunMetrics()
+        component.configuration.image_parameters = {}
+        component.get_refresh_token.return_value = "authorized-refresh"
+        return component
+
+    def test_refresh_token_redeemed_once_for_all_callers(self):
+        manager = TokenManager(self.component)
+
+        self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-1")
+        self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-1")
+
+        self.assertEqual(manager._app.redeemed, ["authorized-refresh"])
+        self.assertEqual(self.component.state[KEY_STATE_REFRESH_TOKEN], "refresh-1")
+        self.assertIn("access-1", self.component.state[KEY_STATE_TOKEN_CACHE])
+        self.component.write_state_checkpoint.assert_called_once()
+
+    def test_cached_token_of_previous_run_used_without_refresh(self):
+        TokenManager(self.component).get_access_token(MS_IMAP_SCOPE)
+
+        next_run = self._create_component(dict(self.component.state))
+        manager = TokenManager(next_run)
+
+        self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-1")
+        self.assertEqual(manager._app.redeemed, [])
+        self.assertEqual(manager._app.issued, 0)
+
+    def test_token_refreshed_ahead_of_expiry(self):
+        manager = TokenManager(self.component)
+        with patch("token_manager.time.monotonic", return_value=1000):
+            self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-1")
+        with patch("token_manager.time.monotonic", return_value=1000 + 3600 - TOKEN_REFRESH_MARGIN - 1):
+            self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-1")
+        with patch("token_manager.time.monotonic", return_value=1000 + 3600 - TOKEN_REFRESH_MARGIN + 1):
+            self.assertEqual(manager.get_access_token(MS_IMAP_SCOPE), "access-2")
+
+        self.assertEqual(manager._app.redeemed, ["authorized-refresh"])
+        self.assertEqual(self.component.state[KEY_STATE_REFRESH_TOKEN], "refresh-2")
+
+    def test_rejected_token_refreshed_once(self):
+        manager = TokenManager(self.component)
+        manager.get_access_token(MS_GRAPH_SCOPE)
+
+        self.assertEqual(manager.get_access_token(MS_GRAPH_SCOPE, rejected_token="access-1"), "access-2")
+        self.assertEqual(manager.get_access_token(MS_GRAPH_SCOPE, rejected_token="access-1"), "access-2")
+        self.assertEqual(manager._app.issued, 2)
+
+    def test_failed_redeem_raises_user_exception(self):
+        manager = TokenManager(self.component)
+        with patch.object(_FakeMsalApp, "acquire_token_by_refresh_token", return_value={"error": "invalid_grant"}):
+            with self.assertRaises(UserException) as cm:
+                manager.get_access_token(MS_IMAP_SCOPE)
+        self.assertIn("invalid_grant", str(cm.exception))
+
+
+class _FakeImapConnection:
+    """imaplib connection stand-in answering UID FETCH of whole messages, sizes, BODYSTRUCTURE and body parts."""
+
+    def __init__(self, messages):
+        self.messages = {uid: email.message_from_bytes(raw) for uid, raw in messages.items()}
+        self.raw = messages
+        self.fetch_commands = []
+        self.fetched_sections = []
+        self.downloaded_bytes = 0
+        self.stored = []
+
+    def uid(self, command, uid_set, *args):
+        if command == "STORE":
+            self.stored.append((uid_set, *args))
+            return "OK", [None]
+        self.fetch_commands.append((uid_set, args[0]))
+        data = []
+        for seq, uid in enumerate(uid_set.split(","), start=1):
+            message = self.messages[uid]
+            size = len(self.raw[uid])
+            if "[]" in args[0]:
+                self.downloaded_bytes += size
+                data += [
+                    (f"{seq} (UID {uid} FLAGS () RFC822.SIZE {size} BODY[] {{{size}}}".encode(), self.raw[uid]),
+                    b")",
+                ]
+                continue
+            if "BODY" not in args[0]:
+                data.append(f"{seq} (UID {uid} RFC822.SIZE {size})".encode())
+                continue
+            if "BODYSTRUCTURE" in args[0]:
+                section, header = _imap_header_section(self.raw[uid], args[0])
+                line = f"{seq} (UID {uid} RFC822.SIZE {size} BODYSTRUCTURE {_imap_body_structure(message)}"
+                data += [(f"{line} BODY[{section}] {{{len(header)}}}".encode(), header), b")"]
+                continue
+            sections = re.findall(r"BODY\.PEEK\[([\d.]+)\](?:<(\d+)\.(\d+)>)?", args[0])
+            prefix = f"{seq} (UID {uid}"
+            for section, offset, length in sections:
+                part = message
+                for index in section.split("."):
+                    if part.get_content_type() == "message/rfc822":
+                        part = part.get_payload(0)
+                    part = part.get_payload(int(index) - 1) if part.is_multipart() else part
+                content = _imap_part_content(part)
+                origin = ""
+                if offset:
+                    content = content[int(offset) : int(offset) + int(length)]
+                    origin = f"<{offset}>"
+                self.fetched_sections.append((uid, section + origin))
+                self.downloaded_bytes += len(content)
+                data.append((f"{prefix} BODY[{section}]{origin} {{{len(content)}}}".encode(), content))
+                prefix = ""
+            data.append(b")")
+        return "OK", data
+
+
+def _imap_header_section(raw, fetch_items):
+    """Return the requested header section name and content, only the listed fields for HEADER.FIELDS."""
+    header = raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+    match = re.search(r"BODY\.PEEK\[(HEADER\.FIELDS \(([^)]*)\))\]", fetch_items)
+    if not match:
+        return "HEADER", header
+    names = {name.lower() for name in match.group(2).split()}
+    # Folded lines belong to the preceding field
+    fields = re.split(rb"\r\n(?=[^ \t])", header.split(b"\r\n\r\n", 1)[0])
+    selected = [field for field in fields if field.split(b":", 1)[0].decode().strip().lower() in names]
+    return match.group(1), b"".join(field + b"\r\n" for field in selected) + b"\r\n"
+
+
+def _make_imap_message(uid, subject="Test Subject"):
+    """Build a (UID, raw message) pair of a simple message stored on the IMAP server."""
+    raw = (
+        "From: sender@example.com\r\n"
+        "To: recipient@example.com\r\n"
+        f"Subject: {subject}\r\n"
+        "Date: Mon, 15 Jan 2024 10:30:00 +0000\r\n"
+        "\r\n"
+        "Hello World\r\n"
+    ).encode()
+    return str(uid), raw
+
+
+class _ImapTestBase(unittest.TestCase):
+    """Base class that sets up an ImapEmailFetcher with a mocked IMAP client and component state."""
+
+    def setUp(self):
+        self.mock_component = MagicMock()
+        self.mock_component.state = {}
+        self.mock_component.state_lock = threading.RLock()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_table = MagicMock()
+        self.output_table.full_path = os.path.join(self.tmp_dir.name, "emails.csv")
+
+    def _create_fetcher(self, config_overrides=None, uid_validity=1, messages=()):
+        params = {
+            "user_name": "test@example.com",
+            "host": "imap.example.com",
+            "download_content": True,
+            "download_attachments": False,
+        }
+        if config_overrides:
+            params.update(config_overrides)
+        fetcher = ImapEmailFetcher(self.mock_component, Configuration(**params))
+        fetcher._imap_client = MagicMock()
+        fetcher._imap_client.folder.get.return_value = "INBOX"
+        fetcher._imap_client.folder.status.return_value = {"UIDVALIDITY": uid_validity}
+        fetcher._imap_client.uids.return_value = [uid for uid, _ in messages]
+        fetcher._imap_client.client = _FakeImapConnection(dict(messages))
+        fetcher._init_imap_client = MagicMock()
+        return fetcher
+
+    def _read_output(self):
+        with open(self.output_table.full_path, encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+
+class TestImapIncrementalSync(_ImapTestBase):
+    """Test UID based incremental IMAP sync."""
+
+    def test_first_run_fetches_all_and_stores_state(self):
+        fetcher = self._create_fetcher(
+            {"incremental_fetch": True}, uid_validity=7, messages=[_make_imap_message(3), _make_imap_message(5)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(fetcher._imap_client.uids.call_args.kwargs["criteria"], "(ALL)")
+        self.assertEqual(
+            self.mock_component.state["imap_sync"]["test@example.com"]["INBOX"], {"uid_validity": 7, "last_uid": 5}
+        )
+        self.assertEqual([r["uid"] for r in self._read_output()], ["3", "5"])
+
+    def test_next_run_fetches_only_new_uids(self):
+        self.mock_component.state = {"imap_sync": {"test@example.com": {"INBOX": {"uid_validity": 7, "last_uid": 5}}}}
+        # the server always returns the newest message for "UID n:*", even if it was processed already
+        fetcher = self._create_fetcher(
+            {"incremental_fetch": True}, uid_validity=7, messages=[_make_imap_message(5), _make_imap_message(9)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(fetcher._imap_client.uids.call_args.kwargs["criteria"], "(ALL) UID 6:*")
+        self.assertEqual([r["uid"] for r in self._read_output()], ["9"])
+        self.assertEqual(self.mock_component.state["imap_sync"]["test@example.com"]["INBOX"]["last_uid"], 9)
+
+    def test_no_new_messages_keeps_last_uid(self):
+        self.mock_component.state = {"imap_sync": {"test@example.com": {"INBOX": {"uid_validity": 7, "last_uid": 5}}}}
+        fetcher = self._create_fetcher({"incremental_fetch": True}, uid_validity=7, messages=[_make_imap_message(5)])
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(self._read_output(), [])
+        self.assertEqual(self.mock_component.state["imap_sync"]["test@example.com"]["INBOX"]["last_uid"], 5)
+
+    def test_uidvalidity_change_triggers_full_sync(self):
+        self.mock_component.state = {"imap_sync": {"test@example.com": {"INBOX": {"uid_validity": 7, "last_uid": 5}}}}
+        fetcher = self._create_fetcher({"incremental_fetch": True}, uid_validity=8, messages=[_make_imap_message(1)])
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(fetcher._imap_client.uids.call_args.kwargs["criteria"], "(ALL)")
+        self.assertEqual(
+            self.mock_component.state["imap_sync"]["test@example.com"]["INBOX"], {"uid_validity": 8, "last_uid": 1}
+        )
+
+    def test_disabled_does_not_touch_state(self):
+        fetcher = self._create_fetcher(messages=[_make_imap_message(3)])
+        fetcher.fetch(self.output_table, True, False, False)
+
+        fetcher._imap_client.folder.status.assert_not_called()
+        self.assertEqual(self.mock_component.state, {})
+
+
+class TestImapParallelFetch(_ImapTestBase):
+    """Test fetching UID ranges over parallel IMAP connections."""
+
+    def test_parallel_connections_fetch_all_messages_in_uid_order(self):
+        messages = [_make_imap_message(uid) for uid in range(1, 101)]
+        fetcher = self._create_fetcher({"imap_connections": 3}, messages=messages)
+        connections = []
+
+        def connect():
+            client = MagicMock()
+            client.client = _FakeImapConnection(dict(messages))
+            connections.append(client)
+            return client
+
+        fetcher._connect = MagicMock(side_effect=connect)
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual([r["uid"] for r in self._read_output()], [str(uid) for uid in range(1, 101)])
+        self.assertLessEqual(len(connections), 3)
+        # the main connection is used only for the search
+        self.assertEqual(fetcher._imap_client.client.fetch_commands, [])
+        fetched = sorted(
+            int(uid) for c in connections for uids, _ in c.client.fetch_commands for uid in uids.split(",")
+        )
+        self.assertEqual(fetched, list(range(1, 101)))
+        for client in connections:
+            client.logout.assert_called_once()
+
+    def test_oauth_connection_logs_in_again_after_token_refresh(self):
+        fetcher = self._create_fetcher()
+        self.mock_component.use_oauth_login = True
+        self.mock_component.get_access_token.side_effect = ["token-1", "token-2", "token-2", "token-2"]
+        mailboxes = []
+
+        def new_mailbox(host, port):
+            mailbox = MagicMock()
+            mailbox.xoauth2.return_value = mailbox
+            mailbox.client.uid.return_value = ("OK", [None])
+            mailboxes.append(mailbox)
+            return mailbox
+
+        with patch("imap_client.MailBox", side_effect=new_mailbox):
+            client = fetcher._init_client_from_oauth()
+            stale_connection = client.client
+            fetcher._uid_command(client, "STORE", "1", "+FLAGS", "(\\Seen)")
+            fetcher._uid_command(client, "STORE", "2", "+FLAGS", "(\\Seen)")
+
+        self.assertEqual([m.xoauth2.call_args.args[1] for m in mailboxes], ["token-1", "token-2"])
+        self.assertIs(client.client, mailboxes[1].client)
+        stale_connection.logout.assert_called_once()
+        stale_connection.uid.assert_not_called()
+        self.assertEqual(client.client.uid.call_count, 2)
+
+
+def _build_mime_message(subject="Report", attachments=(), forwarded=None):
+    message = EmailMessage()
+    message["From"] = "sender@example.com"
+    message["To"] = "recipient@example.com"
+    message["Subject"] = subject
+    message["Date"] = "Mon, 15 Jan 2024 10:30:00 +0000"
+    message.set_content("Hello plain \u017elu\u0165ou\u010dk\u00fd k\u016f\u0148\n")
+    message.add_alternative("<html><body><p>Hello <b>HTML</b></p></body></html>", subtype="html")
+    for filename, content in attachments:
+        message.add_attachment(content, maintype="application", subtype="octet-stream", filename=filename)
+    if forwarded is not None:
+        message.add_attachment(forwarded)
+    return message.as_bytes(policy=email.policy.SMTP)
+
+
+class TestFetchResponseParser(unittest.TestCase):
+    """Test parsing of IMAP FETCH responses."""
+
+    def test_literals_lists_and_strings(self):
+        data = [
+            (
+                b'1 (UID 7 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 5 1) BODY[HEADER] {8}',
+                b"A: 1\r\n\r\n",
+            ),
+            b")",
+            b'2 (UID 8 BODY[HEADER.FIELDS (FROM TO)] "a \\"quoted\\" value" FLAGS (\\Seen))',
+        ]
+        first, second = parse_fetch_response(data)
+
+        self.assertEqual(first["UID"], b"7")
+        self.assertEqual(
+            first["BODYSTRUCTURE"], [b"TEXT", b"PLAIN", [b"CHARSET", b"utf-8"], None, None, b"7BIT", b"5", b"1"]
+        )
+        self.assertEqual(first["BODY[HEADER]"], b"A: 1\r\n\r\n")
+        self.assertEqual(second["BODY[HEADER.FIELDS (FROM TO)]"], b'a "quoted" value')
+        self.assertEqual(second["FLAGS"], [b"\\Seen"])
+
+
+class TestImapSelectiveFetch(_ImapTestBase):
+    """Test the BODYSTRUCTURE driven download of message parts."""
+
+    def setUp(self):
+        super().setUp()
+        forwarded = EmailMessage()
+        forwarded["Subject"] = "Forwarded"
+        forwarded.set_content("Forwarded text\n")
+        self.raw = {
+            "3": _build_mime_message(attachments=[("report.pdf", os.urandom(300_000)), ("data.xml", b"<a>1</a>")]),
+            "4": _build_mime_message(subject="Forward", forwarded=forwarded),
+            "5": b"From: a@example.com\r\nTo: b@example.com\r\nSubject: Plain\r\n\r\nSingle part body\r\n",
+        }
+        self.connection = _FakeImapConnection(self.raw)
+
+    def _fetch_messages(self, **config_overrides):
+        fetcher = self._create_fetcher({"imap_selective_fetch": True, **config_overrides})
+        client = MagicMock()
+        client.client = self.connection
+        return fetcher, list(fetcher._fetch_uids(client, list(self.raw), config_overrides.get("mark_seen", False)))
+
+    def test_matches_full_message(self):
+        fetcher, messages = self._fetch_messages(download_attachments=True)
+
+        for msg in messages:
+            full = MailMessage([(f"UID {msg.uid}".encode(), self.raw[msg.uid])])
+            self.assertEqual(msg.text, full.text)
+            self.assertEqual(msg.html, full.html)
+            self.assertEqual(msg.headers, full.headers)
+            self.assertEqual([a.filename for a in msg.attachments], [a.filename for a in full.attachments])
+            self.assertEqual([a.payload for a in msg.attachments], [a.payload for a in full.attachments])
+            self.assertEqual(msg.size, len(self.raw[msg.uid]))
+            row, full_row = fetcher._build_email_row(msg), fetcher._build_email_row(full)
+            for column in ("uid", "date", "from", "to", "subject", "body", "body_html", "attachment_names"):
+                self.assertEqual(row[column], full_row[column])
+            # The pk differs from the whole message fetch only by the size, reported by the server (RFC822.SIZE)
+            self.assertNotEqual(msg.size, full.size)
+            self.assertNotEqual(row["pk"], full_row["pk"])
+            full.size = len(self.raw[msg.uid])
+            self.assertEqual(row["pk"], fetcher._build_email_pk(full))
+
+    def test_downloads_only_matching_attachments(self):
+        _, messages = self._fetch_messages(
+            download_content=False, download_attachments=True, attachment_pattern=r".+\.xml"
+        )
+
+        self.assertEqual(self.connection.fetched_sections, [("3", "3")])
+        self.assertLess(self.connection.downloaded_bytes, 100)
+        self.assertEqual(messages[0].attachments[1].payload, b"<a>1</a>")
+        self.assertEqual(messages[0].attachments[0].filename, "report.pdf")
+
+    def test_downloads_bodies_without_attachments(self):
+        self._fetch_messages(download_content=True, download_attachments=False)
+
+        self.assertEqual(
+            self.connection.fetched_sections,
+            [("3", "1.1"), ("3", "1.2"), ("4", "1.1"), ("4", "1.2"), ("4", "2.1"), ("5", "1")],
+        )
+
+    def test_mark_seen_stores_flag_per_chunk(self):
+        self._fetch_messages(mark_seen=True)
+
+        self.assertEqual(self.connection.stored, [("3,4,5", "+FLAGS", "(\\Seen)")])
+
+
+# Extracts a 256 MB base64 attachment served in slices and prints the peak RSS of the process in kB
+_LARGE_ATTACHMENT_SCRIPT = """
+import base64, os, re, resource, sys, tempfile
+from unittest.mock import MagicMock
+from configuration import Configuration
+from imap_client import ImapEmailFetcher
+
+LINE = base64.encodebytes(bytes(range(57))).replace(b"\\n", b"\\r\\n")
+ENCODED_SIZE = 256 * 1024 * 1024 // 57 * len(LINE)
+STRUCTURE = (
+    '(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 4 1)'
+    f'("APPLICATION" "OCTET-STREAM" ("NAME" "huge.bin") NIL NIL "BASE64" {ENCODED_SIZE} NIL'
+    ' ("ATTACHMENT" ("FILENAME" "huge.bin")) NIL NIL) "MIXED")'
+)
+
+class Connection:
+    def uid(self, command, uid_set, items):
+        if "BODYSTRUCTURE" in items:
+            header = b"Subject: Huge\\r\\n\\r\\n"
+            line = f"1 (UID 1 RFC822.SIZE {ENCODED_SIZE} BODYSTRUCTURE {STRUCTURE} BODY[HEADER] {{{len(header)}}}"
+            return "OK", [(line.encode(), header), b")"]
+        offset, length = map(int, re.search(r"<(\\d+)\\.(\\d+)>", items).groups())
+        length = max(0, min(length, ENCODED_SIZE - offset))
+        start = offset % len(LINE)
+        data = (LINE * (length // len(LINE) + 2))[start : start + length]
+        return "OK", [(f"1 (UID 1 BODY[2]<{offset}> {{{length}}}".encode(), data), b")"]
+
+out_dir = tempfile.mkdtemp()
+component = MagicMock()
+component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(full_path=os.path.join(out_dir, name))
+config = Configuration(
+    user_name="test@example.com", host="imap.example.com", download_content=False, download_attachments=True,
+    imap_selective_fetch=True, imap_memory_budget_mb=32,
+)
+fetcher = ImapEmailFetcher(component, config)
+client = MagicMock()
+client.client = Connection()
+for msg in fetcher._fetch_uids(client, ["1"], False):
+    (file_def,) = fetcher._write_message_attachments(msg)
+    msg.close()
+size = os.path.getsize(file_def.full_path)
+os.remove(file_def.full_path)
+print(size, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+class TestImapAttachmentMemoryBudget(_ImapTestBase):
+    """Test the bounded-memory extraction of IMAP attachments."""
+
+    def test_budget_requires_selective_fetch(self):
+        with self.assertRaises(UserException) as cm:
+            Configuration(user_name="test@example.com", host="imap.example.com", imap_memory_budget_mb=32)
+        self.assertIn("imap_selective_fetch", str(cm.exception))
+
+    def test_transfer_decoder_with_arbitrary_slices(self):
+        content = os.urandom(10_000)
+        # Quoted-printable keeps line breaks as they are, so bare CR bytes do not survive the round trip
+        text_content = content.replace(b"\r", b"")
+        for encoding, encoded, expected in (
+            ("base64", base64.encodebytes(content).replace(b"\n", b"\r\n"), content),
+            ("quoted-printable", quopri.encodestring(text_content), text_content),
+            ("8bit", content, content),
+        ):
+            for slice_size in (1, 7, 76, 1000):
+                decoder = TransferDecoder(encoding)
+                decoded = b"".join(
+                    decoder.decode(encoded[i : i + slice_size]) for i in range(0, len(encoded), slice_size)
+                )
+                self.assertEqual(decoded + decoder.flush(), expected, f"{encoding}, slices of {slice_size}")
+
+    def test_spool_spills_to_disk_over_budget(self):
+        budget = MemoryBudget(100)
+        in_memory, on_disk = AttachmentSpool(budget, 60), AttachmentSpool(budget, 60)
+        self.assertEqual(budget.used, 60)
+        for spool in (in_memory, on_disk):
+            spool.write(b"content")
+        self.assertFalse(in_memory._file._rolled)
+        self.assertTrue(on_disk._file._rolled)
+
+        in_memory.close()
+        on_disk.close()
+        self.assertEqual(budget.used, 0)
+
+    def test_attachments_downloaded_in_slices(self):
+        pdf, xml = os.urandom(300_000), b"<a>1</a>"
+        raw = {"3": _build_mime_message(attachments=[("report.pdf", pdf), ("data.xml", xml)])}
+        connection = _FakeImapConnection(raw)
+        fetcher = self._create_fetcher(
+            {"download_attachments": True, "imap_selective_fetch": True, "imap_memory_budget_mb": 1}
+        )
+        self.mock_component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(
+            full_path=os.path.join(self.tmp_dir.name, name)
+        )
+        client = MagicMock()
+        client.client = connection
+
+        (msg,) = fetcher._fetch_uids(client, ["3"], False)
+        file_defs = fetcher._write_message_attachments(msg)
+        msg.close()
+
+        # bodies in one command, the 400 kB base64 encoded PDF in slices of 256 kB
+        self.assertEqual(
+            connection.fetched_sections, [("3", "1.1"), ("3", "1.2"), ("3", "2<0>"), ("3", "2<262144>"), ("3", "3<0>")]
+        )
+        self.assertEqual(msg.text, MailMessage.from_bytes(raw["3"]).text)
+        for file_def, content in zip(file_defs, (pdf, xml), strict=True):
+            with open(file_def.full_path, "rb") as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(fetcher._memory_budget.used, 0)
+
+    def test_large_attachment_extracted_under_rss_cap(self):
+        env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+        result = subprocess.run(
+            [sys.executable, "-c", _LARGE_ATTACHMENT_SCRIPT], env=env, capture_output=True, text=True, check=True
+        )
+        size, max_rss_kb = map(int, result.stdout.split())
+
+        self.assertEqual(size, 256 * 1024 * 1024 // 57 * 57)
+        self.assertLess(max_rss_kb, 160 * 1024)
+
+
+class TestImapBulkFetch(_ImapTestBase):
+    """Test fetching whole messages in UID chunks."""
+
+    def _fetch_commands(self, fetcher):
+        return fetcher._imap_client.client.fetch_commands
+
+    def test_one_message_per_command_by_default(self):
+        fetcher = self._create_fetcher(messages=[_make_imap_message(uid) for uid in (1, 2)])
+        fetcher.fetch(self.output_table, True, False, True)
+
+        self.assertEqual(
+            self._fetch_commands(fetcher),
+            [("1", "(BODY[] UID FLAGS RFC822.SIZE)"), ("2", "(BODY[] UID FLAGS RFC822.SIZE)")],
+        )
+        self.assertEqual([r["uid"] for r in self._read_output()], ["1", "2"])
+
+    def test_messages_fetched_in_chunks(self):
+        fetcher = self._create_fetcher(
+            {"imap_fetch_chunk_size": 3}, messages=[_make_imap_message(uid) for uid in range(1, 8)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(
+            self._fetch_commands(fetcher),
+            [
+                ("1,2,3,4,5,6,7", "(UID RFC822.SIZE)"),
+                ("1,2,3", "(BODY.PEEK[] UID FLAGS RFC822.SIZE)"),
+                ("4,5,6", "(BODY.PEEK[] UID FLAGS RFC822.SIZE)"),
+                ("7", "(BODY.PEEK[] UID FLAGS RFC822.SIZE)"),
+            ],
+        )
+        self.assertEqual([r["uid"] for r in self._read_output()], [str(uid) for uid in range(1, 8)])
+
+    def test_chunk_limited_by_size(self):
+        large = b"Subject: Large\r\n\r\n" + b"x" * 700_000
+        messages = [_make_imap_message(1), ("2", large), ("3", large), _make_imap_message(4), _make_imap_message(5)]
+        fetcher = self._create_fetcher({"imap_fetch_chunk_size": 100, "imap_fetch_chunk_max_mb": 1}, messages=messages)
+
+        self.assertEqual(
+            fetcher._plan_fetch_chunks(fetcher._imap_client, ["1", "2", "3", "4", "5"]), [["1", "2"], ["3", "4", "5"]]
+        )
+
+    def test_split_fetch_items(self):
+        data = [(b"1 (UID 5 BODY[] {3}", b"abc"), b" FLAGS (\\Seen))", (b"2 (UID 6 BODY[] {3}", b"def"), b")"]
+
+        self.assertEqual(
+            ImapEmailFetcher._split_fetch_items(data),
+            [[(b"1 (UID 5 BODY[] {3}", b"abc"), b" FLAGS (\\Seen))"], [(b"2 (UID 6 BODY[] {3}", b"def"), b")"]],
+        )
+
+
+class TestImapMarkSeenAfterRun(_ImapTestBase):
+    """Test flagging the processed IMAP messages as seen after the run."""
+
+    def test_processed_messages_stored_as_uid_sets_after_run(self):
+        fetcher = self._create_fetcher(
+            {"mark_seen_after_run": True}, messages=[_make_imap_message(uid) for uid in (1, 2, 3, 5, 7, 8)]
+        )
+        fetcher.fetch(self.output_table, True, False, True)
+
+        connection = fetcher._imap_client.client
+        self.assertEqual(connection.stored, [])
+        self.assertTrue(all("PEEK" in items for _, items in connection.fetch_commands))
+
+        fetcher.mark_processed_as_seen()
+        self.assertEqual(connection.stored, [("1:3,5,7:8", "+FLAGS", "(\\Seen)")])
+
+    def test_nothing_stored_without_mark_seen(self):
+        fetcher = self._create_fetcher({"mark_seen_after_run": True}, messages=[_make_imap_message(1)])
+        fetcher.fetch(self.output_table, True, False, False)
+        fetcher.mark_processed_as_seen()
+
+        self.assertEqual(fetcher._imap_client.client.stored, [])
+
+    def test_uid_sets_limited_by_number_of_ranges(self):
+        uids = [str(uid) for uid in range(1, 2 * IMAP_UID_SET_MAX_RANGES + 2, 2)]
+        uid_sets = ImapEmailFetcher._build_uid_sets(uids)
+
+        self.assertEqual([len(uid_set.split(",")) for uid_set in uid_sets], [IMAP_UID_SET_MAX_RANGES, 1])
+
+
+class TestRunMetrics(_ImapTestBase):
+    """Test the collection of per-phase run metrics."""
+
+    def test_phase_histogram_and_counters(self):
+        metrics = RunMetrics()
+        for seconds in (0.0005, 0.003, 0.004, 20):
+            metrics.record("graph_request", seconds)
+        metrics.count("messages", 3)
+        metrics.count("messages")
+
+        result = metrics.to_dict()
+        phase = result["phases"]["graph_request"]
+        self.assertEqual(phase["count"], 4)
+        self.assertEqual(phase["max_ms"], 20000)
+        self.assertEqual(phase["histogram"], {"<=1ms": 1, "<=5ms": 2, ">10000ms": 1})
+        self.assertEqual(result["counters"], {"messages": 4})
+
+        path = os.path.join(self.tmp_dir.name, "metrics.json")
+        metrics.write(path)
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["phases"]["graph_request"]["count"], 4)
+
+    def test_imap_fetch_phases_recorded(self):
+        self.mock_component.metrics = RunMetrics()
+        fetcher = self._create_fetcher(messages=[_make_imap_message(uid) for uid in (1, 2)])
+        fetcher.fetch(self.output_table, True, False, False)
+
+        result = self.mock_component.metrics.to_dict()
+        self.assertEqual(
+            {name: stats["count"] for name, stats in result["phases"].items()},
+            {"imap_search": 1, "imap_fetch": 2, "mime_parse": 2, "row_build": 2, "csv_write": 2},
+        )
+        self.assertEqual(result["counters"]["messages"], 2)
+        self.assertGreater(result["counters"]["bytes_downloaded"], 2 * len(_make_imap_message(1)[1]))
+
+    def test_graph_requests_and_retries_recorded(self):
+        self.mock_component.metrics = RunMetrics()
+        config = Configuration(user_name="test@example.com", connection_method=CONNECTION_METHOD_GRAPH)
+        fetcher = GraphEmailFetcher(self.mock_component, config)
+        fetcher._graph_session = MagicMock()
+        fetcher._graph_session.request.side_effect = [_mock_http_response(429), _mock_http_response(200, {"id": "a"})]
+
+        with patch("graph_client.get_retry_delay", return_value=0):
+            fetcher._request("GET", f"{GRAPH_API_BASE}/me/messages/a")
+
+        result = self.mock_component.metrics.to_dict()
+        self.assertEqual(result["phases"]["graph_request"]["count"], 2)
+        self.assertEqual(result["counters"], {"bytes_downloaded": len(b'{"id": "a"}'), "graph_retries": 1})
+
+
+class TestAttachmentDedup(_ImapTestBase):
+    """Test the content-addressed deduplication of attachments."""
+
+    def setUp(self):
+        super().setUp()
+        self.files_dir = os.path.join(self.tmp_dir.name, "files")
+        os.makedirs(self.files_dir)
+        self.mock_component.files_out_path = self.files_dir
+        self.mock_component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(
+            full_path=os.path.join(self.files_dir, name), tags=tags
+        )
+        self.logo = os.urandom(5000)
+        self.messages = [
+            ("1", _build_mime_message(attachments=[("logo.png", self.logo), ("report.pdf", b"report 1")])),
+            ("2", _build_mime_message(subject="Other", attachments=[("logo.png", self.logo)])),
+        ]
+
+    def _fetch(self, config_overrides=None):
+        fetcher = self._create_fetcher(
+            {"download_attachments": True, **(config_overrides or {})}, messages=self.messages
+        )
+        fetcher._attachment_store = AttachmentStore(self.mock_component)
+        results = fetcher.fetch(self.output_table, True, True, False)
+        return fetcher, results[1:]
+
+    def test_duplicate_content_written_once(self):
+        fetcher, file_defs = self._fetch()
+        store = fetcher._attachment_store
+
+        logo_hash = hashlib.sha256(self.logo).hexdigest()
+        self.assertEqual(sorted(os.listdir(self.files_dir)), sorted(os.path.basename(f.full_path) for f in file_defs))
+        self.assertEqual(len(file_defs), 2)
+        self.assertEqual(file_defs[0].tags, [f"content_hash: {logo_hash}"])
+        with open(os.path.join(self.files_dir, f"{logo_hash}.png"), "rb") as f:
+            self.assertEqual(f.read(), self.logo)
+        self.assertEqual(
+            [(r["attachment_id"], r["attachment_name"], r["content_hash"]) for r in store.rows],
+            [
+                ("0", "logo.png", logo_hash),
+                ("1", "report.pdf", hashlib.sha256(b"report 1").hexdigest()),
+                ("0", "logo.png", logo_hash),
+            ],
+        )
+        self.assertEqual(store.rows[0]["email_pk"], self._read_output()[0]["pk"])
+        self.assertEqual((store.written_count, store.duplicate_count, store.skipped_count), (2, 1, 0))
+
+    def test_known_attachments_not_downloaded_in_next_run(self):
+        self._fetch({"imap_selective_fetch": True})
+        for name in os.listdir(self.files_dir):
+            os.remove(os.path.join(self.files_dir, name))
+
+        fetcher, file_defs = self._fetch({"imap_selective_fetch": True})
+        store = fetcher._attachment_store
+
+        self.assertEqual(file_defs, [])
+        self.assertEqual(os.listdir(self.files_dir), [])
+        # only the text and HTML bodies are downloaded
+        self.assertEqual(
+            fetcher._imap_client.client.fetched_sections, [("1", "1.1"), ("1", "1.2"), ("2", "1.1"), ("2", "1.2")]
+        )
+        self.assertEqual(len(store.rows), 3)
+        self.assertEqual((store.written_count, store.duplicate_count, store.skipped_count), (0, 0, 3))
+
+    def test_graph_known_attachment_skipped(self):
+        config = Configuration(user_name="test@example.com", connection_method=CONNECTION_METHOD_GRAPH)
+        store = AttachmentStore(self.mock_component)
+        fetcher = GraphEmailFetcher(self.mock_component, config, attachment_store=store)
+        fetcher._request = MagicMock()
+        fetcher._request.return_value.iter_content.return_value = [b"col_a,", b"col_b\n"]
+
+        first = fetcher._download_and_write_attachments("m1", SAMPLE_GRAPH_MESSAGE, [SAMPLE_GRAPH_ATTACHMENT])
+        second = fetcher._download_and_write_attachments("m1", SAMPLE_GRAPH_MESSAGE, [SAMPLE_GRAPH_ATTACHMENT])
+
+        self.assertEqual(len(first), 1)
+        self.assertEqual(second, [])
+        fetcher._request.assert_called_once()
+        self.assertEqual([r["attachment_id"] for r in store.rows], ["att_123", "att_123"])
+        self.assertEqual(store.rows[0]["content_hash"], hashlib.sha256(b"col_a,col_b\n").hexdigest())
+
+    @patch("attachment_store.ATTACHMENT_STATE_MAX_ENTRIES", 100)
+    def test_state_size_is_bounded(self):
+        store = AttachmentStore(self.mock_component)
+        attachment_ids = [f"AAMkAGI2TG93AAA{i:08d}" + "A" * 130 for i in range(150)]
+        for i, attachment_id in enumerate(attachment_ids):
+            store.write("pk", attachment_id, "report.pdf", [str(i).encode()])
+
+        state = self.mock_component.state["attachment_dedup"]
+        self.assertEqual((len(state["attachments"]), len(state["files"])), (100, 100))
+        # an attachment and its file take less than 250 bytes of the state, i.e. less than 2.5 MB at the default cap
+        self.assertLess(len(json.dumps(self.mock_component.state)), 100 * 250)
+        self.assertTrue(store.is_known("pk", attachment_ids[-1]))
+        self.assertFalse(store.is_known("pk", attachment_ids[0]))
+
+
+class TestMultiMailbox(_ImapTestBase):
+    """Test extraction of several mailboxes in a single run."""
+
+    def test_mailboxes_written_to_single_output_with_own_state(self):
+        mailboxes = ["test@example.com", "shared1@example.com", "shared2@example.com"]
+        fetchers = [
+            self._create_fetcher(
+                {"user_name": user_name, "incremental_fetch": True},
+                messages=[_make_imap_message(uid) for uid in range(1, i + 2)],
+            )
+            for i, user_name in enumerate(mailboxes)
+        ]
+        config = fetchers[0].config.model_copy(update={"mailbox_concurrency": 2})
+
+        results = Component._fetch_mailboxes(self.mock_component, fetchers, self.output_table, config)
+
+        self.assertEqual(results, [self.output_table])
+        rows = self._read_output()
+        self.assertEqual(
+            sorted(r["mail_box"] for r in rows),
+            sorted(["test@example.com"] + ["shared1@example.com"] * 2 + ["shared2@example.com"] * 3),
+        )
+        self.assertEqual(
+            {
+                user_name: state["INBOX"]["last_uid"]
+                for user_name, state in self.mock_component.state["imap_sync"].items()
+            },
+            {"test@example.com": 1, "shared1@example.com": 2, "shared2@example.com": 3},
+        )
+
+    def test_mailbox_configs(self):
+        config = Configuration(
+            user_name="test@example.com",
+            **{"#password": "secret"},
+            host="imap.example.com",
+            mailboxes=[{"user_name": "shared@example.com", "#password": "shared_secret"}],
+        )
+        configs = config.mailbox_configs()
+
+        self.assertEqual(
+            [(c.user_name, c.password) for c in configs],
+            [("test@example.com", "secret"), ("shared@example.com", "shared_secret")],
+        )
+        self.assertEqual(configs[1].host, "imap.example.com")
+
+    def test_duplicate_mailboxes_are_rejected(self):
+        with self.assertRaises(UserException) as cm:
+            Configuration(
+                user_name="test@example.com",
+                host="imap.example.com",
+                mailboxes=[{"user_name": "shared@example.com"}, {"user_name": "Test@example.com"}],
+            )
+        self.assertIn("listed more than once: test@example.com", str(cm.exception))
+
+    def test_graph_shared_mailbox_uses_users_endpoints(self):
+        config = Configuration(user_name="shared@example.com", connection_method=CONNECTION_METHOD_GRAPH)
+        own = GraphEmailFetcher(self.mock_component, config)
+        shared = GraphEmailFetcher(self.mock_component, config, shared_mailbox=True)
+
+        self.assertEqual(own._mark_as_read_request("m1")["url"], f"{GRAPH_API_BASE}/me/messages/m1")
+        self.assertEqual(
+            shared._mark_as_read_request("m1")["url"], f"{GRAPH_API_BASE}/users/shared@example.com/messages/m1"
+        )
+        self.assertEqual(
+            GraphEmailFetcher._build_batch_sub_request("1", shared._mark_as_read_request("m1"))["url"],
+            "/users/shared@example.com/messages/m1",
+        )
+
+
+class TestSlicedOutput(_ImapTestBase):
+    """Test the emails table written as gzip compressed slices."""
+
+    def _read_slices(self):
+        rows = []
+        for name in sorted(os.listdir(self.output_table.full_path)):
+            with gzip.open(os.path.join(self.output_table.full_path, name), "rt", encoding="utf-8") as f:
+                rows.extend(csv.DictReader(f, fieldnames=RESULT_COLUMNS, dialect="kbc"))
+        return rows
+
+    def test_fetch_writes_header_less_gzip_slice(self):
+        fetcher = self._create_fetcher(
+            {"output_slice_size_mb": 1}, messages=[_make_imap_message(3), _make_imap_message(5)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(os.listdir(self.output_table.full_path), ["part-00001.csv.gz"])
+        self.assertEqual([r["uid"] for r in self._read_slices()], ["3", "5"])
+
+    def test_rolls_to_new_slice_at_slice_size(self):
+        writer = SlicedGzipWriter(self.output_table.full_path, RESULT_COLUMNS, slice_size_mb=1)
+        # barely compressible bodies of 120 kB (about 90 kB compressed), 11 or 12 fit in a slice
+        bodies = [base64.b64encode(os.urandom(90 * 1024)).decode() for _ in range(30)]
+        for i, body in enumerate(bodies):
+            writer.writerow({"pk": str(i), "body": body})
+        writer.close()
+
+        self.assertEqual(writer.slice_count, 3)
+        self.assertEqual(len(os.listdir(self.output_table.full_path)), 3)
+        for name in os.listdir(self.output_table.full_path):
+            self.assertLess(os.path.getsize(os.path.join(self.output_table.full_path, name)), 1.5 * 1024 * 1024)
+        self.assertEqual([r["body"] for r in self._read_slices()], bodies)
+
+    def test_empty_output_has_single_empty_slice(self):
+        fetcher = self._create_fetcher({"output_slice_size_mb": 1})
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(os.listdir(self.output_table.full_path), ["part-00001.csv.gz"])
+        self.assertEqual(self._read_slices(), [])
+
+
+class TestSeparateBodies(_ImapTestBase):
+    """Test the message bodies written to a separate table."""
+
+    def setUp(self):
+        super().setUp()
+        self.bodies_table = MagicMock()
+        self.bodies_table.full_path = os.path.join(self.tmp_dir.name, "email_bodies.csv")
+        uid, raw = _make_imap_message(7)
+        self.messages = [_make_imap_message(3), (uid, raw.replace(b"Hello World", b"x" * 3000))]
+
+    def _fetch(self, body_min_size_kb):
+        fetcher = self._create_fetcher(messages=self.messages)
+        with open_output_writer(
+            self.output_table, bodies_table=self.bodies_table, body_min_size_kb=body_min_size_kb
+        ) as writer:
+            fetcher.fetch(self.output_table, True, False, False, writer=writer)
+        with open(self.bodies_table.full_path, encoding="utf-8") as f:
+            return self._read_output(), list(csv.DictReader(f))
+
+    def test_bodies_above_threshold_are_moved(self):
+        rows, bodies = self._fetch(body_min_size_kb=2)
+
+        self.assertEqual([(r["uid"], r["body"].strip()) for r in rows], [("3", "Hello World"), ("7", "")])
+        self.assertGreater(int(rows[1]["size"]), 3000)
+        self.assertEqual([(b["pk"], b["body"].strip()) for b in bodies], [(rows[1]["pk"], "x" * 3000)])
+
+    def test_all_bodies_are_moved_without_threshold(self):
+        rows, bodies = self._fetch(body_min_size_kb=0)
+
+        self.assertEqual([r["body"] for r in rows], ["", ""])
+        self.assertEqual([b["pk"] for b in bodies], [r["pk"] for r in rows])
+
+
+class TestColumnProjection(_ImapTestBase):
+    """Test that only the data of the selected output columns is fetched over IMAP and written."""
+
+    def setUp(self):
+        super().setUp()
+        self.messages = [
+            ("3", _build_mime_message(attachments=[("report.pdf", os.urandom(50_000))])),
+            _make_imap_message(4, subject="Second"),
+        ]
+
+    def _fetch(self, columns, **config_overrides):
+        fetcher = self._create_fetcher({"columns": columns, **config_overrides}, messages=self.messages)
+        fetcher.fetch(self.output_table, True, False, False)
+        return fetcher._imap_client.client, self._read_output()
+
+    def test_metadata_columns_fetch_only_header_fields(self):
+        connection, rows = self._fetch(["subject", "from", "date", "attachment_names"], imap_selective_fetch=True)
+        _, full_rows = self._fetch([], imap_selective_fetch=True)
+
+        self.assertEqual(list(rows[0]), ["pk", "date", "from", "subject", "attachment_names"])
+        self.assertEqual(len(connection.fetch_commands), 1)
+        self.assertIn(
+            "BODY.PEEK[HEADER.FIELDS (DATE FROM TO SUBJECT MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING"
+            " CONTENT-DISPOSITION)]",
+            connection.fetch_commands[0][1],
+        )
+        self.assertEqual(connection.downloaded_bytes, 0)
+        for row, full_row in zip(rows, full_rows, strict=True):
+            self.assertEqual(row, {column: full_row[column] for column in row})
+
+    def test_whole_messages_fetched_without_selective_fetch(self):
+        connection, rows = self._fetch(["subject", "size"])
+        _, full_rows = self._fetch([])
+
+        self.assertIn("BODY.PEEK[]", connection.fetch_commands[0][1])
+        self.assertEqual(list(rows[0]), ["pk", "subject", "size"])
+        for row, full_row in zip(rows, full_rows, strict=True):
+            self.assertEqual(row, {column: full_row[column] for column in row})
+
+    def test_body_column_downloads_only_text_parts(self):
+        connection, rows = self._fetch(["subject", "body"], imap_selective_fetch=True)
+
+        self.assertEqual(connection.fetched_sections, [("3", "1.1"), ("4", "1")])
+        self.assertEqual(rows[1]["body"].strip(), "Hello World")
+        self.assertNotIn("body_html", rows[0])
+
+    def test_transfer_encoded_single_part_body_is_decoded(self):
+        self.messages = [
+            (
+                "6",
+                b"From: a@example.com\r\nTo: b@example.com\r\nSubject: Price\r\nMIME-Version: 1.0\r\n"
+                b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n"
+                b"\r\nCaf=C3=A9 =E2=82=AC price\r\n",
+            )
+        ]
+        for overrides in ({"columns": ["subject", "body"]}, {"header_fields": ["subject"]}):
+            with self.subTest(**overrides):
+                connection, rows = self._fetch(overrides.pop("columns", []), imap_selective_fetch=True, **overrides)
+
+                self.assertIn("HEADER.FIELDS", connection.fetch_commands[0][1])
+                self.assertEqual(rows[0]["body"].strip(), "Caf\u00e9 \u20ac price")
+
+    def test_separate_bodies_with_selected_body_columns(self):
+        bodies_table = MagicMock()
+        bodies_table.full_path = os.path.join(self.tmp_dir.name, "email_bodies.csv")
+        fetcher = self._create_fetcher({"columns": ["body"]}, messages=self.messages)
+        with open_output_writer(self.output_table, bodies_table=bodies_table, columns=["pk", "body"]) as writer:
+            fetcher.fetch(self.output_table, True, False, False, writer=writer)
+
+        with open(bodies_table.full_path, encoding="utf-8") as f:
+            bodies = list(csv.DictReader(f))
+        self.assertEqual(list(bodies[1]), ["pk", "body"])
+        self.assertEqual(bodies[1]["body"].strip(), "Hello World")
+        self.assertEqual([r["body"] for r in self._read_output()], ["", ""])
+
+    def test_unknown_column_is_rejected(self):
+        with self.assertRaises(UserException) as cm:
+            Configuration(user_name="test@example.com", host="imap.example.com", columns=["subject", "cc"])
+        self.assertIn("Unknown output columns: cc", str(cm.exception))
+
+    def test_output_columns_keep_table_order_with_pk(self):
+        config = Configuration(user_name="test@example.com", host="imap.example.com", columns=["subject", "uid"])
+        self.assertEqual(config.output_columns, ["pk", "uid", "subject"])
+
+
+class TestHeaderFields(_ImapTestBase):
+    """Test the header_fields allow-list of the headers column."""
+
+    def setUp(self):
+        super().setUp()
+        uid, raw = _make_imap_message(5)
+        raw = b"X-Mailer: Mutt\r\nX-MS-Has-Attach: no\r\nReceived: from a by b\r\n" + raw
+        self.messages = [(uid, raw)]
+
+    def _fetch(self, header_fields):
+        fetcher = self._create_fetcher(
+            {"header_fields": header_fields, "imap_selective_fetch": True}, messages=self.messages
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+        return fetcher._imap_client.client.fetch_commands[0][1], self._read_output()[0]
+
+    def test_plain_field_names_are_fetched_with_header_fields(self):
+        command, row = self._fetch(["Subject", "x-mailer"])
+
+        self.assertIn(
+            "BODY.PEEK[HEADER.FIELDS (DATE FROM TO SUBJECT MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING"
+            " CONTENT-DISPOSITION X-MAILER)]",
+            command,
+        )
+        self.assertEqual(json.loads(row["headers"]), {"x-mailer": ["Mutt"], "subject": ["Test Subject"]})
+
+    def test_glob_patterns_filter_the_whole_header(self):
+        command, row = self._fetch(["x-*"])
+
+        self.assertIn("BODY.PEEK[HEADER]", command)
+        self.assertEqual(json.loads(row["headers"]), {"x-mailer": ["Mutt"], "x-ms-has-attach": ["no"]})
+
+    def test_graph_headers_filtered_by_pattern(self):
+        config = Configuration(
+            user_name="test@example.com", connection_method=CONNECTION_METHOD_GRAPH, header_fields=["SUBJ*", "to"]
+        )
+        fetcher = GraphEmailFetcher(MagicMock(), config)
+
+        row = fetcher._build_email_row(dict(SAMPLE_GRAPH_MESSAGE), [])
+
+        self.assertEqual(row["headers"], '{"To": "recipient1@example.com", "Subject": "Test Subject"}')
+
+    def test_headers_serialized_as_before_without_allow_list(self):
+        headers = {"subject": ["Zpráva"], "x-mailer": ["Mutt"]}
+
+        self.assertEqual(HeaderFieldFilter([]).serialize(headers), json.dumps(headers))
+
+    def test_filter_field_names(self):
+        self.assertEqual(HeaderFieldFilter(["Subject", "X-Mailer"]).field_names, ["subject", "x-mailer"])
+        self.assertIsNone(HeaderFieldFilter(["subject", "x-ms-*"]).field_names)
+        self.assertIsNone(HeaderFieldFilter([]).field_names)
+
+    def test_invalid_field_is_rejected(self):
+        with self.assertRaises(UserException) as cm:
+            Configuration(user_name="test@example.com", host="imap.example.com", header_fields=["Subject:"])
+        self.assertIn("Invalid header fields: 'Subject:'", str(cm.exception))
+
+
+class TestAttachmentLimits(_ImapTestBase):
+    """Test the attachment size and content type limits evaluated on the attachment metadata."""
+
+    def setUp(self):
+        super().setUp()
+        self.files_dir = os.path.join(self.tmp_dir.name, "files")
+        os.makedirs(self.files_dir)
+        self.mock_component.create_out_file_definition.side_effect = lambda name, tags: MagicMock(
+            full_path=os.path.join(self.files_dir, name), tags=tags
+        )
+        message = EmailMessage()
+        message["From"] = "sender@example.com"
+        message["To"] = "recipient@example.com"
+        message["Subject"] = "Limits"
+        message.set_content("Body\n")
+        message.add_attachment(os.urandom(1_500_000), maintype="video", subtype="mp4", filename="video.mp4")
+        message.add_attachment(b"a,b\n1,2\n", maintype="text", subtype="csv", filename="data.csv")
+        message.add_attachment(os.urandom(900_000), maintype="image", subtype="png", filename="logo.png")
+        self.messages = [("9", message.as_bytes(policy=email.policy.SMTP))]
+
+    def _fetch(self, **config_overrides):
+        fetcher = self._create_fetcher({"download_attachments": True, **config_overrides}, messages=self.messages)
+        results = fetcher.fetch(self.output_table, True, True, False)
+        return fetcher, sorted(os.path.basename(f.full_path).split("_", 1)[1] for f in results[1:])
+
+    def test_imap_skips_attachments_before_download(self):
+        fetcher, written = self._fetch(
+            attachment_max_size_mb=1, attachment_excluded_content_types=["image/*"], imap_selective_fetch=True
+        )
+        connection = fetcher._imap_client.client
+
+        self.assertEqual(written, ["data.csv"])
+        self.assertNotIn(("9", "2"), connection.fetched_sections)
+        self.assertNotIn(("9", "4"), connection.fetched_sections)
+        self.assertLess(connection.downloaded_bytes, 1000)
+        self.assertEqual(fetcher._attachment_limits.skipped, ["video.mp4", "logo.png"])
+        row = self._read_output()[0]
+        self.assertEqual(row["number_of_attachments"], "3")
+        self.assertEqual(row["attachment_names"], "['video.mp4', 'data.csv', 'logo.png']")
+
+    def test_imap_whole_message_fetch_skips_attachments_when_written(self):
+        fetcher, written = self._fetch(attachment_max_size_mb=1, attachment_excluded_content_types=["image/*"])
+        connection = fetcher._imap_client.client
+
+        self.assertEqual(written, ["data.csv"])
+        self.assertEqual(connection.fetched_sections, [])
+        self.assertGreater(connection.downloaded_bytes, 2_400_000)
+        self.assertEqual(fetcher._attachment_limits.skipped, ["video.mp4", "logo.png"])
+        self.assertEqual(self._read_output()[0]["number_of_attachments"], "3")
+
+    def test_imap_allowed_content_types(self):
+        _, written = self._fetch(attachment_content_types=["text/*", "IMAGE/PNG"])
+
+        self.assertEqual(written, ["data.csv", "logo.png"])
+
+    def test_graph_limits_use_attachment_metadata(self):
+        config = Configuration(
+            user_name="test@example.com",
+            connection_method=CONNECTION_METHOD_GRAPH,
+            attachment_max_size_mb=1,
+            attachment_excluded_content_types=["application/x-msdownload"],
+        )
+        fetcher = GraphEmailFetcher(self.mock_component, config)
+        attachments = [
+            {"id": "1", "name": "video.mp4", "contentType": "video/mp4", "size": 500 * 1024 * 1024},
+            {"id": "2", "name": "setup.exe", "contentType": "application/x-msdownload", "size": 1000},
+            {"id": "3", "name": "report.pdf", "contentType": "application/pdf", "size": 1000},
+        ]
+
+        self.assertEqual([a["id"] for a in fetcher._filter_attachments(attachments)], ["3"])
+        self.assertEqual(fetcher._attachment_limits.skipped, ["video.mp4", "setup.exe"])
+        row = fetcher._build_email_row(dict(SAMPLE_GRAPH_MESSAGE), attachments)
+        self.assertEqual(row["attachment_names"], ["video.mp4", "setup.exe", "report.pdf"])
+
+    def test_skip_reasons(self):
+        limits = AttachmentLimits(1, ["application/*"], ["application/zip"])
+
+        self.assertIsNone(limits.skip_reason("application/pdf; name=a.pdf", 1000))
+        self.assertIn("size limit", limits.skip_reason("application/pdf", 2 * 1024 * 1024))
+        self.assertIn("excluded", limits.skip_reason("Application/ZIP", 1000))
+        self.assertIn("not allowed", limits.skip_reason("image/png", 1000))
+        self.assertFalse(AttachmentLimits().enabled)
+
+    def test_skipped_attachments_counted_and_logged(self):
+        metrics = MagicMock()
+        limits = AttachmentLimits(excluded_content_types=["video/*"], metrics=metrics)
+
+        self.assertFalse(limits.is_skipped("data.csv", "text/csv", 1000))
+        self.assertTrue(limits.is_skipped("video.mp4", "video/mp4", 1000))
+        with self.assertLogs(level="INFO") as logs:
+            limits.log_summary()
+
+        self.assertEqual(limits.skipped, ["video.mp4"])
+        metrics.count.assert_called_once_with("attachments_skipped")
+        self.assertIn("Skipped 1 attachments", logs.output[0])
+
+
+class TestImapCheckpoints(_ImapTestBase):
+    """Test checkpoints of IMAP runs and resuming interrupted runs."""
+
+    def _create_interrupted_fetcher(self, config_overrides, fail_uid, error=None):
+        fetcher = self._create_fetcher(config_overrides, messages=[_make_imap_message(uid) for uid in range(1, 6)])
+        write_message_content = fetcher._write_message_content
+
+        def write(writer, msg):
+            if msg.uid == fail_uid:
+                raise error or ConnectionResetError("connection reset by peer")
+            write_message_content(writer, msg)
+
+        fetcher._write_message_content = write
+        return fetcher
+
+    def test_checkpoints_written_and_cleared_on_completion(self):
+        fetcher = self._create_fetcher(
+            {"checkpoint_interval": 2}, messages=[_make_imap_message(uid) for uid in range(1, 6)]
+        )
+        checkpoints = []
+        self.mock_component.write_state_checkpoint.side_effect = lambda: checkpoints.append(
+            dict(self.mock_component.state["checkpoint"]["test@example.com"])
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual([c["last_uid"] for c in checkpoints], [2, 4])
+        self.assertEqual(checkpoints[0], {"folder": "INBOX", "query": "(ALL)", "uid_validity": 1, "last_uid": 2})
+        self.assertEqual(self.mock_component.state["checkpoint"], {})
+        self.assertTrue(fetcher.completed)
+
+    def test_resumes_after_checkpoint(self):
+        self.mock_component.state = {
+            "checkpoint": {"test@example.com": {"folder": "INBOX", "query": "(ALL)", "uid_validity": 1, "last_uid": 3}}
+        }
+        fetcher = self._create_fetcher(
+            {"checkpoint_interval": 2}, messages=[_make_imap_message(uid) for uid in range(1, 6)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual([r["uid"] for r in self._read_output()], ["4", "5"])
+
+    def test_checkpoint_of_other_folder_state_is_ignored(self):
+        self.mock_component.state = {
+            "checkpoint": {"test@example.com": {"folder": "INBOX", "query": "(ALL)", "uid_validity": 2, "last_uid": 3}}
+        }
+        fetcher = self._create_fetcher(
+            {"checkpoint_interval": 2}, messages=[_make_imap_message(uid) for uid in range(1, 6)]
+        )
+        fetcher.fetch(self.output_table, True, False, False)
+
+        self.assertEqual(len(self._read_output()), 5)
+
+    def test_interrupted_run_keeps_output_and_checkpoint(self):
+        fetcher = self._create_interrupted_fetcher({"checkpoint_interval": 2}, fail_uid="5")
+
+        with self.assertLogs(level="ERROR") as logs:
+            results = Component._fetch_all(self.mock_component, [fetcher], self.output_table, None, fetcher.config)
+
+        self.assertEqual(results, [self.output_table])
+        self.assertIn("The extraction was interrupted: connection reset by peer", logs.output[0])
+        self.assertIsInstance(logs.records[0].exc_info[1], ConnectionResetError)
+        self.assertEqual([r["uid"] for r in self._read_output()], ["1", "2", "3", "4"])
+        self.assertEqual(self.mock_component.state["checkpoint"]["test@example.com"]["last_uid"], 4)
+
+    def test_interrupted_run_with_transient_errors_keeps_output(self):
+        wrapped = UserException("Failed to connect to Microsoft Graph API.")
+        wrapped.__cause__ = requests.exceptions.ConnectionError("connection aborted")
+        for error in (TimeoutError("timed out"), wrapped, GraphRequestError("Throttled", 429)):
+            with self.subTest(error=error):
+                self.mock_component.state = {}
+                fetcher = self._create_interrupted_fetcher({"checkpoint_interval": 2}, fail_uid="5", error=error)
+
+                with self.assertLogs(level="ERROR"):
+                    Component._fetch_all(self.mock_component, [fetcher], self.output_table, None, fetcher.config)
+
+    def test_interrupted_run_with_other_error_fails(self):
+        for error in (KeyError("uid"), UserException("Access denied"), GraphRequestError("Bad request", 400)):
+            with self.subTest(error=error):
+                self.mock_component.state = {}
+                fetcher = self._create_interrupted_fetcher({"checkpoint_interval": 2}, fail_uid="5", error=error)
+
+                with self.assertRaises(type(error)):
+                    Component._fetch_all(self.mock_component, [fetcher], self.output_table, None, fetcher.config)
+                self.assertTrue(fetcher.checkpointed)
+
+    def test_dropped_connection_interrupts_fetch(self):
+        fetcher = self._create_fetcher(
+            {"checkpoint_interval": 2, "incremental_fetch": True},
+            messages=[_make_imap_message(uid) for uid in range(1, 6)],
+        )
+        connection = fetcher._imap_client.client
+        fetch_uid = connection.uid
+
+        def uid(command, uid_set, *args):
+            if command == "FETCH" and uid_set == "5":
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            return fetch_uid(command, uid_set, *args)
+
+        connection.uid = uid
+
+        with self.assertLogs(level="ERROR"):
+            Component._fetch_all(self.mock_component, [fetcher], self.output_table, None, fetcher.config)
+
+        self.assertFalse(fetcher.completed)
+        self.assertEqual(self.mock_component.state["checkpoint"]["test@example.com"]["last_uid"], 4)
+        self.assertEqual(self.mock_component.state["imap_sync"]["test@example.com"], {})
+        self.assertEqual([r["uid"] for r in self._read_output()], ["1", "2", "3", "4"])
+
+    def test_dropped_connection_in_search_fails(self):
+        fetcher = self._create_fetcher({"checkpoint_interval": 2}, messages=[_make_imap_message(1)])
+        fetcher._imap_client.uids.side_effect = imaplib.IMAP4.abort("socket error: EOF")
+
+        with self.assertRaises(imaplib.IMAP4.abort):
+            fetcher.fetch(self.output_table, True, False, False)
+        self.assertFalse(fetcher.completed)
+
+    def test_invalid_search_query_is_user_error(self):
+        fetcher = self._create_fetcher(messages=[_make_imap_message(1)])
+        fetcher._imap_client.uids.side_effect = imaplib.IMAP4.error("SEARCH command error: BAD [b'parse error']")
+
+        with self.assertRaises(UserException) as cm:
+            fetcher.fetch(self.output_table, True, False, False)
+        self.assertIn("Invalid search query", str(cm.exception))
+
+    def test_interrupted_run_without_new_checkpoint_fails(self):
+        fetcher = self._create_interrupted_fetcher({"checkpoint_interval": 2}, fail_uid="2")
+
+        with self.assertRaises(ConnectionResetError):
+            Component._fetch_all(self.mock_component, [fetcher], self.output_table, None, fetcher.config)
+
+    def test_state_file_written_at_checkpoint(self):
+        os.makedirs(os.path.join(self.tmp_dir.name, "out"))
+        self.mock_component.configuration.data_dir = self.tmp_dir.name
+        self.mock_component.state = {"checkpoint": {"test@example.com": {"last_uid": 4}}}
+
+        Component.write_state_checkpoint(self.mock_component)
+
+        with open(os.path.join(self.tmp_dir.name, "out", "state.json")) as f:
+            self.assertEqual(json.load(f), self.mock_component.state)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir.name, "out")), ["state.json"])
+
+    def test_state_file_waits_for_state_changes(self):
+        os.makedirs(os.path.join(self.tmp_dir.name, "out"))
+        self.mock_component.configuration.data_dir = self.tmp_dir.name
+        fetcher = self._create_fetcher({"incremental_fetch": True})
+        writer = threading.Thread(target=Component.write_state_checkpoint, args=(self.mock_component,))
+
+        with self.mock_component.state_lock:
+            writer.start()
+            writer.join(0.1)
+            self.assertTrue(writer.is_alive())
+            fetcher._save_sync_state("INBOX", 1, 5)
+        writer.join()
+
+        with open(os.path.join(self.tmp_dir.name, "out", "state.json")) as f:
+            self.assertEqual(json.load(f)["imap_sync"]["test@example.com"]["INBOX"]["last_uid"], 5)
+
+
+class TestGraphCheckpoints(_GraphTestBase):
+    """Test checkpoints of Graph API runs and resuming interrupted runs."""
+
+    MESSAGES_URL = "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages"
+
+    def setUp(self):
+        super().setUp()
+        self.mock_component.state = {}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.output_table = MagicMock()
+        self.output_table.full_path = os.path.join(self.tmp_dir.name, "emails.csv")
+        self.pages = {
+            self.MESSAGES_URL: {"value": [{"id": "m1"}, {"id": "m2"}], "@odata.nextLink": "page_2"},
+            "page_2": {"value": [{"id": "m3"}], "@odata.nextLink": "page_3"},
+            "page_3": {"value": [{"id": "m4"}]},
+        }
+
+    def _fetch(self, failing_id=None):
+        fetcher = self._create_fetcher({"checkpoint_interval": 2, "mark_seen": False})
+        fetcher._init_graph_session = MagicMock()
+
+        def fetch_message_detail(msg_id):
+            if msg_id == failing_id:
+                raise UserException("Failed to connect to Microsoft Graph API.")
+            return dict(SAMPLE_GRAPH_MESSAGE, id=msg_id)
+
+        fetcher._fetch_message_detail = MagicMock(side_effect=fetch_message_detail)
+
+        def request(method, url, **kwargs):
+            if isinstance(self.pages[url], Exception):
+                raise self.pages[url]
+            return MagicMock(json=lambda: self.pages[url])
+
+        fetcher._request = MagicMock(side_effect=request)
+        fetcher.fetch(self.output_table, True, False, False)
+        with open(self.output_table.full_path, encoding="utf-8") as f:
+            return [r["uid"] for r in csv.DictReader(f)]
+
+    def test_checkpoint_between_pages(self):
+        with self.assertRaises(UserException):
+            self._fetch(failing_id="m4")
+
+        self.assertEqual(self.mock_component.state["checkpoint"]["test@example.com"]["next_link"], "page_2")
+        self.mock_component.write_state_checkpoint.assert_called_once()
+
+    def test_resumes_from_next_link(self):
+        with self.assertRaises(UserException):
+            self._fetch(failing_id="m3")
+
+        self.assertEqual(self._fetch(), ["m3", "m4"])
+        self.assertEqual(self.mock_component.state["checkpoint"], {})
+
+    def _store_stale_checkpoint(self):
+        with self.assertRaises(UserException):
+            self._fetch(failing_id="m3")
+        self.mock_component.state["checkpoint"]["test@example.com"]["next_link"] = "stale"
+
+    def test_rejected_next_link_falls_back_to_fresh_listing(self):
+        for status_code in (400, 404, 410):
+            with self.subTest(status_code=status_code):
+                self._store_stale_checkpoint()
+                self.pages["stale"] = GraphRequestError("Invalid skip token", status_code)
+
+                self.assertEqual(self._fetch(), ["m1", "m2", "m3", "m4"])
+                self.assertEqual(self.mock_component.state["checkpoint"], {})
+
+    def test_next_link_other_errors_are_raised(self):
+        self._store_stale_checkpoint()
+        self.pages["stale"] = GraphRequestError("Access denied", 403)
+
+        with self.assertRaises(UserException):
+            self._fetch()
+        self.assertEqual(self.mock_component.state["checkpoint"]["test@example.com"]["next_link"], "stale")
+
+
 class TestConnectionMethodProperty(unittest.TestCase):
     """Test connection method detection properties."""
 